@@ -0,0 +1,114 @@
+import hashlib
+import json
+import re
+from functools import wraps
+
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_etags, quote_etag
+
+# 成功的 JSON 响应以 {"code": 0 开头
+SUCCESS_PATTERN = re.compile(rb'^\{"code":\s*0[,}]')
+
+
+def conditional(data_version, resolve_project_id=None):
+    """
+    为查询接口增加 ETag / Last-Modified，If-None-Match 与 ETag 相同时返回 304，不执行查询
+
+    版本号由 data_version(project_id) 通过索引查询得到，ETag 同时包含接口、请求参数和返回格式；
+    方案编号取自路由参数或请求体中的 project_id，为空时使用最新的方案。
+    接口按其他规则选择方案时传入 resolve_project_id，与接口使用同一个方案计算版本号
+
+    Args:
+        data_version(callable): data_version(project_id) 返回 (版本号, 最后修改时间)，方案不存在时返回 None
+        resolve_project_id(callable): resolve_project_id(project_id) 返回接口实际查询的方案编号，
+            返回 None 时不使用条件请求
+
+    Example:
+        @api_view(['POST'])
+        @conditional(service.data_version)
+        def export_map_controller(request):
+            ...
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            try:
+                version = request_version(request, kwargs, data_version, resolve_project_id)
+            except Exception:
+                version = None
+            if version is None:
+                return view(request, *args, **kwargs)
+
+            token, updated_at = version
+            etag = quote_etag(make_etag(view.__name__, request, kwargs, token))
+            last_modified = int(updated_at.timestamp())
+            if not_modified(request, etag):
+                response = HttpResponseNotModified()
+            else:
+                response = view(request, *args, **kwargs)
+                if not is_success(response):
+                    return response
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            response['Vary'] = 'Accept'
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def request_project_id(request, kwargs):
+    if 'project_id' in kwargs:
+        return kwargs['project_id']
+    if not request.body:
+        return None
+    body = json.loads(request.body.decode('utf-8'))
+    return body.get('project_id') if isinstance(body, dict) else None
+
+
+def request_version(request, kwargs, data_version, resolve_project_id=None):
+    project_id = request_project_id(request, kwargs)
+    if resolve_project_id is not None:
+        project_id = resolve_project_id(project_id)
+        if project_id is None:
+            return None
+    return data_version(project_id)
+
+
+def make_etag(name, request, kwargs, token):
+    """
+    ETag：接口 + 路由参数 + 查询参数 + 请求体 + 返回格式 + 数据版本
+    """
+    digest = hashlib.sha1()
+    digest.update(name.encode('utf-8'))
+    digest.update(json.dumps(kwargs, sort_keys=True, default=str).encode('utf-8'))
+    digest.update(request.META.get('QUERY_STRING', '').encode('utf-8'))
+    digest.update(request.body)
+    renderer = getattr(request, 'accepted_renderer', None)
+    digest.update((renderer.format if renderer else '').encode('utf-8'))
+    return f'{token}-{digest.hexdigest()[:16]}'
+
+
+def not_modified(request, etag):
+    """
+    只按 If-None-Match 判断，忽略 If-Modified-Since：删除最新的方案后，不指定方案的接口改用较早的方案，
+    最后修改时间反而变早，只比较时间会把另一个方案的数据当作未修改；ETag 包含数据版本，不会出现这种情况
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    return '*' in etags or any(tag.removeprefix('W/') == etag for tag in etags)
+
+
+def is_success(response):
+    """
+    只有成功的响应才返回 ETag，避免客户端缓存错误信息
+    """
+    if response.status_code != 200:
+        return False
+    if response.streaming or response.get('Content-Type') != 'application/json':
+        return True
+    return SUCCESS_PATTERN.match(response.content) is not None
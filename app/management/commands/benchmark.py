@@ -0,0 +1,183 @@
+import json
+import time
+import tracemalloc
+from decimal import Decimal
+
+import numpy as np
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.management.base import BaseCommand
+from django.http import JsonResponse
+
+from app.models import Project
+from app.renderers import streaming_json_response, get_serializer, iter_json
+from app.repository.app_repository import AppRepository
+from app.request import ExportHistoryMapRequest
+from app.service.app_service import AppService
+from app.service.mesh import FaceGeometry
+from app.service.reader import wet_face_rows
+from app.tools import timestamp_to_datetime, iter_map_data_json, convert_map_data_to_json, to_timestamp
+
+BENCHMARK_TIME = '2021-07-30 00:00:00'
+
+
+class Command(BaseCommand):
+    help = '性能基准测试，数据写入临时方案，结束后删除'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=['write', 'export', 'serialize'], help='测试项目')
+        parser.add_argument('--rows', type=int, default=5000, help='测试数据行数')
+        parser.add_argument('--times', type=int, default=24, help='测试数据时刻数(export、serialize)')
+
+    def handle(self, *args, **options):
+        project = Project.objects.create(name='benchmark', description='benchmark', type=1)
+        try:
+            getattr(self, f'benchmark_{options["target"]}')(project, options)
+        finally:
+            project.delete()
+
+    def report(self, name, rows, seconds):
+        self.stdout.write(f'{name:<32} {rows:>8} rows {seconds:>8.3f}s {rows / seconds:>12.0f} rows/s')
+
+    def benchmark_write(self, project, options):
+        """
+        逐行 upsert 与批量写入的对比
+        """
+        rows = options['rows']
+        geometry = synthetic_geometry(rows)
+        water_depths = np.round(np.linspace(0.1, 2.0, rows), 2)
+        risks = np.minimum(water_depths // 0.5 + 1, 4).astype(int)
+
+        start = time.perf_counter()
+        for face in range(rows):
+            lon, lat = geometry.coordinates(face)
+            AppRepository.upsert_map(project, lon, lat, water_depths[face], risks[face], BENCHMARK_TIME)
+        self.report('upsert_map', rows, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        AppRepository.insert_map_rows(map_rows(project, water_depths, risks, '2021-07-30 01:00:00'))
+        self.report('insert_map_rows', rows, time.perf_counter() - start)
+
+        station_rows = [
+            (f'S{i}', 119.0 + i * 1e-4, 32.0, water_depths[i], 3.0, 0.5, BENCHMARK_TIME) for i in range(rows)
+        ]
+        start = time.perf_counter()
+        for row in station_rows:
+            AppRepository.upsert_station(project, *row)
+        self.report('upsert_station', rows, time.perf_counter() - start)
+
+        names = [f'S{i}' for i in range(rows)]
+        lon = 119.0 + np.arange(rows) * 1e-4
+        lat = np.full(rows, 32.0)
+        start = time.perf_counter()
+        AppRepository.bulk_upsert_station(
+            project, names, lon, lat, water_depths[None, :], np.full((1, rows), 3.0), np.full((1, rows), 0.5),
+            ['2021-07-30 01:00:00'])
+        self.report('bulk_upsert_station', rows, time.perf_counter() - start)
+
+    def benchmark_export(self, project, options):
+        """
+        网格时段数据导出：JsonResponse 与流式输出的首字节时间和内存峰值对比
+        """
+        rows, times = options['rows'], options['times']
+        geometry = synthetic_geometry(rows)
+        mesh = AppRepository.insert_mesh(f'benchmark-{project.id}', geometry)
+        try:
+            AppRepository.update_project_mesh(project, mesh)
+            water_depths = np.round(np.linspace(0.1, 2.0, rows), 2)
+            risks = np.minimum(water_depths // 0.5 + 1, 4).astype(int)
+            for hour in range(times):
+                AppRepository.insert_map_rows(
+                    map_rows(project, water_depths, risks, f'2021-07-30 {hour % 24:02d}:00:00'))
+            # 网格坐标缓存在进程中，预先生成，不计入对比
+            AppRepository.get_mesh_geometry(mesh.id).lat_lon(0)
+
+            service = AppService()
+            req = ExportHistoryMapRequest(project_id=project.id)
+            self.measure_export('JsonResponse', rows * times,
+                                lambda: JsonResponse({'code': 0, 'data': service.export_history_map(req)}))
+            self.measure_export('StreamingHttpResponse', rows * times,
+                                lambda: streaming_json_response(service.stream_history_map(req)))
+        finally:
+            mesh.delete()
+
+    def measure_export(self, name, rows, build):
+        """
+        首字节时间：从开始查询到响应输出第一块数据；内存峰值由 tracemalloc 统计
+        """
+        tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            chunks = iter(build())
+            size = len(next(chunks))
+            first_byte = time.perf_counter() - start
+            for chunk in chunks:
+                size += len(chunk)
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.stdout.write(f'{name:<24} {rows:>8} rows ttfb {first_byte:>8.3f}s total {seconds:>8.3f}s '
+                          f'peak {peak / 2 ** 20:>8.1f} MB {size / 2 ** 20:>8.1f} MB sent')
+
+    def benchmark_serialize(self, project, options):
+        """
+        网格数据转换为 JSON 的 CPU 时间：原实现（逐行格式化时间 + 标准库 json）与缓存时间格式 + 各序列化器的对比
+        """
+        rows, times = options['rows'], options['times']
+        geometry = synthetic_geometry(rows)
+        geometry.lat_lon(0)
+        data = [
+            (hour * rows + face, face, Decimal(f'{0.1 + face % 190 / 100:.2f}'), face % 4 + 1, 649382400 + hour * 3600)
+            for hour in range(times) for face in range(rows)
+        ]
+
+        def legacy():
+            arr = []
+            for elem in data:
+                arr.append({
+                    'id': elem[0],
+                    'coordinates': geometry.lat_lon(elem[1]),
+                    'waterDepth': elem[2],
+                    'risk': elem[3],
+                    'time': timestamp_to_datetime.__wrapped__(elem[4])
+                })
+            return json.dumps({'code': 0, 'data': arr}, cls=DjangoJSONEncoder).encode('utf-8')
+
+        baseline = self.measure_cpu('legacy json', len(data), legacy)
+        for name in ('json', 'orjson'):
+            serializer = get_serializer(name)
+            if serializer.name != name:
+                self.stdout.write(f'{name:<24} 未安装，跳过')
+                continue
+            self.measure_cpu(f'{name}', len(data), lambda: serializer.dumps(
+                {'code': 0, 'data': convert_map_data_to_json(data, geometry)}), baseline)
+            self.measure_cpu(f'{name} stream', len(data), lambda: b''.join(iter_json(
+                {'code': 0, 'data': iter_map_data_json(data, geometry)}, serializer)), baseline)
+
+    def measure_cpu(self, name, rows, encode, baseline=None):
+        timestamp_to_datetime.cache_clear()
+        start = time.process_time()
+        size = len(encode())
+        seconds = time.process_time() - start
+        speedup = f'{baseline / seconds:>6.1f}x' if baseline else ''
+        self.stdout.write(f'{name:<24} {rows:>8} rows cpu {seconds:>8.3f}s {size / 2 ** 20:>8.1f} MB {speedup}')
+        return seconds
+
+
+def synthetic_geometry(count):
+    """
+    生成 count 个互不重叠的三角网格
+    """
+    node_x = np.repeat(119.0 + np.arange(count) * 1e-3, 3) + np.tile([0, 5e-4, 0], count)
+    node_y = np.full(count * 3, 32.0) + np.tile([0, 0, 5e-4], count)
+    nodes = np.arange(count * 3).reshape(count, 3)
+    return FaceGeometry(node_x=node_x, node_y=node_y, nodes=nodes, counts=np.full(count, 3))
+
+
+def map_rows(project, water_depths, risks, timestamp):
+    """
+    同一时刻所有网格的 app_mapdata 行，用于 insert_map_rows
+    """
+    count = len(water_depths)
+    return wet_face_rows(water_depths[None, :], risks[None, :], 0, np.ones(count, dtype=bool), project.id,
+                         [to_timestamp(timestamp)])[0]
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from app.service.app_service import AppService
+
+
+class Command(BaseCommand):
+    help = '将按行存储坐标的历史网格数据转换为网格拓扑 + 网格序号'
+
+    def handle(self, *args, **options):
+        service = AppService()
+        for project in service.repository.get_legacy_map_projects():
+            count = service.convert_legacy_map_data(project)
+            self.stdout.write(f'项目方案 {project.id}：转换 {count} 行网格数据')
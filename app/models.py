@@ -2,6 +2,18 @@
 from django.db import models
 
 
+class Mesh(models.Model):
+    """
+    网格拓扑数据，由 mesh2d_node_x/y 和 mesh2d_face_nodes 生成，相同网格的方案共用
+    """
+    signature = models.CharField(max_length=64, unique=True)
+    node_x = models.BinaryField()
+    node_y = models.BinaryField()
+    face_nodes = models.BinaryField()
+    face_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
 class Project(models.Model):
     """
     项目方案数据
@@ -13,6 +25,7 @@ class Project(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     type = models.IntegerField(default=0)
+    mesh = models.ForeignKey(Mesh, null=True, on_delete=models.SET_NULL)
 
 
 class MapData(models.Model):
@@ -20,13 +33,40 @@ class MapData(models.Model):
     地图网格数据
     """
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
-    longitude = models.JSONField(blank=True, default=list)
-    latitude = models.JSONField(blank=True, default=list)
+    face_index = models.IntegerField(null=True)
+    # 历史数据的网格坐标，转换为 face_index 后置空
+    longitude = models.JSONField(null=True, blank=True, default=None)
+    latitude = models.JSONField(null=True, blank=True, default=None)
     water_depth = models.DecimalField(max_digits=5, decimal_places=2, default=0)
     risk = models.IntegerField(default=0)
     timestamp = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['project', 'face_index', 'timestamp'], name='unique_map_data'),
+        ]
+        indexes = [
+            models.Index(fields=['project', 'timestamp'], name='map_data_time_idx'),
+            # 按风险等级、水深筛选和排序预警数据
+            models.Index(fields=['project', 'risk', 'water_depth'], name='map_data_risk_idx'),
+        ]
+
+
+class MapRiskSummary(models.Model):
+    """
+    网格风险等级统计：每个方案每个时刻各风险等级的网格数，处理网格数据时生成
+    """
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    timestamp = models.IntegerField()
+    risk = models.IntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['project', 'timestamp', 'risk'], name='unique_map_risk_summary'),
+        ]
+
 
 class StationData(models.Model):
     """
@@ -34,6 +74,8 @@ class StationData(models.Model):
     """
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     station_name = models.CharField(max_length=30, blank=True)
+    # 站点在 his.nc 中的序号
+    station_index = models.IntegerField(null=True)
     longitude = models.FloatField()
     latitude = models.FloatField()
     water_depth = models.DecimalField(max_digits=5, decimal_places=2, default=0)
@@ -42,6 +84,34 @@ class StationData(models.Model):
     timestamp = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['project', 'station_name', 'timestamp'], name='unique_station_data'),
+        ]
+        indexes = [
+            models.Index(fields=['project', 'station_index', 'timestamp'], name='station_data_index_idx'),
+            models.Index(fields=['project', 'timestamp'], name='station_data_time_idx'),
+        ]
+
+
+class StationSummary(models.Model):
+    """
+    站点代表数据：每个方案每个时刻所有站点的最大水深和最大流速，处理站点数据时生成
+
+    station_data_id 和 station_name 为流速最大的站点
+    """
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    timestamp = models.IntegerField()
+    station_data_id = models.IntegerField(null=True)
+    station_name = models.CharField(max_length=30, blank=True)
+    water_depth = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+    velocity_magnitude = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['project', 'timestamp'], name='unique_station_summary'),
+        ]
+
 
 class Rainfall(models.Model):
     """
@@ -52,6 +122,11 @@ class Rainfall(models.Model):
     data = models.DecimalField(max_digits=10, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['station', 'datetime'], name='unique_rainfall'),
+        ]
+
 
 class UpstreamWaterLevel(models.Model):
     """
@@ -62,6 +137,11 @@ class UpstreamWaterLevel(models.Model):
     data = models.DecimalField(max_digits=10, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['station', 'datetime'], name='unique_upstream_water_level'),
+        ]
+
 
 class DownstreamWaterLevel(models.Model):
     """
@@ -72,6 +152,11 @@ class DownstreamWaterLevel(models.Model):
     data = models.DecimalField(max_digits=10, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['station', 'datetime'], name='unique_downstream_water_level'),
+        ]
+
 
 class RainfallSeries(models.Model):
     """
@@ -80,3 +165,41 @@ class RainfallSeries(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     rainfall = models.DecimalField(max_digits=10, decimal_places=2)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['project', 'rainfall'], name='unique_rainfall_series'),
+        ]
+
+
+class ProjectJob(models.Model):
+    """
+    模型运行任务
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+
+    status = models.CharField(max_length=10, default=STATUS_PENDING)
+    request = models.JSONField(default=dict)
+    project = models.ForeignKey(Project, null=True, on_delete=models.SET_NULL)
+    stage = models.CharField(max_length=20, blank=True, default='')
+    stages = models.JSONField(default=dict)
+    output = models.TextField(blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+
+class ModelRunCache(models.Model):
+    """
+    模型运行结果缓存，按边界条件文件和模型配置的摘要索引
+    """
+    signature = models.CharField(max_length=64, unique=True)
+    project = models.ForeignKey(Project, null=True, on_delete=models.SET_NULL)
+    path = models.CharField(max_length=255, blank=True, default='')
+    size = models.BigIntegerField(default=0)
+    output = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,346 @@
+import json
+import logging
+import struct
+from collections.abc import Iterator
+from decimal import Decimal
+from functools import lru_cache
+
+import numpy as np
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer, JSONRenderer, BrowsableAPIRenderer
+
+from hydrologic_forecasting.settings import config
+
+# 列式数据包：b'HFC1' + 头部长度(uint32, 小端) + 头部JSON + 8字节对齐的各列数据
+COLUMNS_MAGIC = b'HFC1'
+COLUMNS_ALIGNMENT = 8
+# 流式 JSON 每次输出的字节数
+STREAM_CHUNK_SIZE = 64 * 1024
+# 流式 JSON 每次编码的元素数
+STREAM_BATCH_SIZE = 500
+
+
+class ColumnsRenderer(BaseRenderer):
+    """
+    小端二进制列式数据包，Accept: application/octet-stream
+    """
+    media_type = 'application/octet-stream'
+    format = 'columns'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+class ArrowRenderer(BaseRenderer):
+    """
+    Apache Arrow IPC 数据流，Accept: application/vnd.apache.arrow.stream，需要安装 pyarrow
+    """
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+class TileRenderer(BaseRenderer):
+    """
+    Mapbox 矢量切片，Accept: application/vnd.mapbox-vector-tile
+    """
+    media_type = 'application/vnd.mapbox-vector-tile'
+    format = 'mvt'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+# 导出接口支持的返回格式
+EXPORT_RENDERERS = [JSONRenderer, BrowsableAPIRenderer, ColumnsRenderer, ArrowRenderer]
+# 网格的各列长度不同，不支持 Arrow
+MESH_RENDERERS = [JSONRenderer, BrowsableAPIRenderer, ColumnsRenderer]
+# 矢量切片，出错时返回 JSON
+TILE_RENDERERS = [TileRenderer, JSONRenderer]
+
+
+def encode_columns(columns, meta=None):
+    """
+    编码列式数据包
+
+    Args:
+        columns(dict): {列名: ndarray}
+        meta(dict): 写入头部的其他信息
+
+    Returns:
+        bytes
+    """
+    arrays = {name: np.ascontiguousarray(array).astype(array.dtype.newbyteorder('<'), copy=False)
+              for name, array in columns.items()}
+    header = {'columns': [], **(meta or {})}
+    offset = 0
+    for name, array in arrays.items():
+        header['columns'].append({
+            'name': name,
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'offset': offset,
+            'length': array.nbytes,
+        })
+        offset += padded(array.nbytes)
+
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    prefix = COLUMNS_MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes
+    parts = [prefix, b'\0' * (padded(len(prefix)) - len(prefix))]
+    for array in arrays.values():
+        parts.append(array.tobytes())
+        parts.append(b'\0' * (padded(array.nbytes) - array.nbytes))
+    return b''.join(parts)
+
+
+def encode_arrow(columns, meta=None):
+    """
+    编码 Arrow IPC 数据流，meta 写入 schema 的元数据
+
+    Returns:
+        bytes
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise RuntimeError('导出Arrow格式需要安装pyarrow')
+
+    table = pa.table({name: array.ravel() for name, array in columns.items()})
+    if meta:
+        table = table.replace_schema_metadata({key: json.dumps(value, ensure_ascii=False) for key, value in meta.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def padded(length):
+    return (length + COLUMNS_ALIGNMENT - 1) // COLUMNS_ALIGNMENT * COLUMNS_ALIGNMENT
+
+
+def is_binary(request):
+    """
+    客户端是否要求二进制格式
+    """
+    return request.accepted_renderer.format in (ColumnsRenderer.format, ArrowRenderer.format)
+
+
+def binary_response(request, columns, meta=None):
+    """
+    按照协商的格式返回列式数据
+    """
+    renderer = request.accepted_renderer
+    if renderer.format == ArrowRenderer.format:
+        content = encode_arrow(columns, meta)
+    else:
+        content = encode_columns(columns, meta)
+    return HttpResponse(content, content_type=renderer.media_type)
+
+
+# 不需要增量编码的类型，直接跳过检查
+PLAIN_TYPES = frozenset([str, int, float, bool, type(None), Decimal, list, tuple])
+
+
+def is_lazy(value):
+    """
+    是否需要增量编码：迭代器、可调用对象，或包含它们的字典
+    """
+    if type(value) in PLAIN_TYPES:
+        return False
+    if isinstance(value, dict):
+        for item in value.values():
+            if type(item) not in PLAIN_TYPES and is_lazy(item):
+                return True
+        return False
+    return isinstance(value, Iterator) or callable(value)
+
+
+def iter_json(value, serializer=None):
+    """
+    增量编码 JSON，与一次性编码的结果等价
+
+    迭代器编码为数组，逐项编码，同一时间只有一项在内存中；
+    字典中的迭代器和可调用对象在编码到该键时才求值，可调用对象的返回值再按本规则编码
+
+    Args:
+        value: 待编码的数据
+        serializer: JSON 序列化器，默认读取配置 response.serializer
+
+    Yields:
+        bytes: JSON 片段
+    """
+    if serializer is None:
+        serializer = get_serializer()
+    if isinstance(value, dict) and is_lazy(value):
+        yield b'{'
+        for i, (key, item) in enumerate(value.items()):
+            if i:
+                yield serializer.item_separator
+            yield serializer.dumps(str(key)) + serializer.key_separator
+            if callable(item):
+                item = item()
+            yield from iter_json(item, serializer)
+        yield b'}'
+    elif isinstance(value, Iterator):
+        # 连续的普通元素合并为一个列表编码，减少序列化器的调用次数
+        yield b'['
+        batch = []
+        first = True
+        for item in value:
+            if not is_lazy(item):
+                batch.append(item)
+                if len(batch) < STREAM_BATCH_SIZE:
+                    continue
+                item = None
+            if batch:
+                if not first:
+                    yield serializer.item_separator
+                yield serializer.dumps(batch)[1:-1]
+                batch = []
+                first = False
+            if item is not None:
+                if not first:
+                    yield serializer.item_separator
+                yield from iter_json(item, serializer)
+                first = False
+        if batch:
+            if not first:
+                yield serializer.item_separator
+            yield serializer.dumps(batch)[1:-1]
+        yield b']'
+    else:
+        yield serializer.dumps(value)
+
+
+def iter_json_bytes(value, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    把 JSON 片段合并为较大的块输出，避免逐行写入
+    """
+    buffer = []
+    length = 0
+    for chunk in iter_json(value):
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= chunk_size:
+            yield b''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def iter_response_chunks(chunks):
+    """
+    输出响应体的分块，出错时中断输出
+    """
+    try:
+        yield from chunks
+    except Exception as e:
+        # 响应头已经发出，只能中断输出，客户端会收到不完整的 JSON
+        logging.exception("流式输出JSON失败：%s", e)
+
+
+def streaming_json_response(data):
+    """
+    流式返回 {'code': 0, 'data': data}，data 可以是迭代器，边查询边输出
+    """
+    return streaming_bytes_response(iter_json_bytes({'code': 0, 'data': data}))
+
+
+def streaming_bytes_response(chunks):
+    """
+    流式返回已编码的 JSON 分块，如 iter_json_bytes 或接口缓存的结果
+    """
+    return StreamingHttpResponse(iter_response_chunks(chunks), content_type='application/json')
+
+
+def json_response(data, status=200):
+    """
+    使用配置的序列化器返回 JSON，替代 JsonResponse
+    """
+    return HttpResponse(get_serializer().dumps(data), content_type='application/json', status=status)
+
+
+class StdlibSerializer:
+    """
+    标准库 json，与 JsonResponse 的输出一致
+    """
+    name = 'json'
+    item_separator = b', '
+    key_separator = b': '
+
+    def __init__(self):
+        self.encoder = DjangoJSONEncoder()
+
+    def dumps(self, value):
+        return self.encoder.encode(value).encode('utf-8')
+
+
+class OrjsonSerializer:
+    """
+    orjson，原生支持 NumPy 数组和标量，输出不含空格的 UTF-8
+
+    Decimal 与 DjangoJSONEncoder 一致编码为字符串，日期时间交给 DjangoJSONEncoder 处理
+    """
+    name = 'orjson'
+    item_separator = b','
+    key_separator = b':'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+        self.option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        self.encoder = DjangoJSONEncoder()
+
+    def default(self, value):
+        if isinstance(value, Decimal):
+            return str(value)
+        if isinstance(value, np.generic):
+            return value.item()
+        return self.encoder.default(value)
+
+    def dumps(self, value):
+        return self.orjson.dumps(value, default=self.default, option=self.option)
+
+
+SERIALIZERS = {
+    StdlibSerializer.name: StdlibSerializer,
+    OrjsonSerializer.name: OrjsonSerializer,
+}
+
+
+@lru_cache(maxsize=None)
+def get_serializer(name=None):
+    """
+    获取 JSON 序列化器
+
+    Args:
+        name(str): auto、orjson 或 json，默认读取配置 response.serializer；
+            auto 在安装了 orjson 时使用 orjson，否则使用标准库
+
+    Returns:
+        StdlibSerializer or OrjsonSerializer
+    """
+    if name is None:
+        name = config['response']['serializer']
+    if name == 'auto':
+        try:
+            return OrjsonSerializer()
+        except ImportError:
+            return StdlibSerializer()
+    if name not in SERIALIZERS:
+        raise ValueError(f'不支持的JSON序列化器：{name}')
+    try:
+        return SERIALIZERS[name]()
+    except ImportError:
+        logging.warning("未安装%s，使用标准库json", name)
+        return StdlibSerializer()
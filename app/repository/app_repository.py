@@ -1,8 +1,20 @@
+from functools import lru_cache
+from itertools import groupby, repeat
+from operator import itemgetter
+
+import numpy as np
 from django.core.paginator import Paginator
-from django.db import connection
+from django.db import connection, transaction
+from django.db.models import FloatField, Value, Max, Count, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast, Coalesce
+from django.utils import timezone
 
-from app.models import StationData, MapData, Project, UpstreamWaterLevel, DownstreamWaterLevel, Rainfall, RainfallSeries
-from app.tools import timestamp_to_datetime, convert_map_data_to_json, datetime_to_timestamp
+from app.models import StationData, MapData, Project, UpstreamWaterLevel, DownstreamWaterLevel, Rainfall, \
+    RainfallSeries, Mesh, ProjectJob, ModelRunCache, MapRiskSummary, StationSummary
+from app.service.mesh import build_geometry
+from app.tools import timestamp_to_datetime, convert_map_data_to_json, datetime_to_timestamp, to_timestamp
+from hydrologic_forecasting.settings import config
 
 
 class AppRepository:
@@ -22,10 +34,7 @@ class AppRepository:
         Returns
             int
         """
-        if timestamp is float:
-            converted_timestamp = int(timestamp)
-        else:
-            converted_timestamp = datetime_to_timestamp(timestamp)
+        converted_timestamp = to_timestamp(timestamp)
         count = MapData.objects.filter(
             project=project,
             longitude=lon,
@@ -48,6 +57,148 @@ class AppRepository:
         data.save()
         return data.id
 
+    @staticmethod
+    def insert_map_rows(rows):
+        """
+        一条 executemany 写入同一时刻的网格数据，通过唯一约束(project, face_index, timestamp)去重
+
+        Args:
+            rows(list): [(方案编号, 网格序号, 水深, 风险等级, 时间戳)]，由 wet_face_rows 生成
+
+        Returns:
+            int: 实际写入的行数，不包括重复的行
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(
+                "insert or ignore into app_mapdata (project_id, face_index, water_depth, risk, timestamp, created_at) "
+                "values (%s, %s, %s, %s, %s, strftime('%%Y-%%m-%%d %%H:%%M:%%f', 'now'))",
+                rows,
+            )
+            return cursor.rowcount
+
+    @staticmethod
+    def replace_map_rows(project, timestamp, rows):
+        """
+        替换方案一个时刻的网格数据，再由写入后的网格数据重新统计该时刻的风险等级；
+        重新处理网格文件时不会留下上一次的网格，两张表的数据保持一致
+
+        Args:
+            project
+            timestamp(int): 时间戳
+            rows(list): [(方案编号, 网格序号, 水深, 风险等级, 时间戳)]，由 wet_face_rows 生成
+
+        Returns:
+            int: 写入的行数
+        """
+        with transaction.atomic():
+            MapData.objects.filter(project=project, timestamp=timestamp).delete()
+            count = AppRepository.insert_map_rows(rows)
+            AppRepository.rebuild_map_risk_summary(project, timestamp)
+        return count
+
+    @staticmethod
+    def get_mesh_by_signature(signature):
+        return Mesh.objects.filter(signature=signature).first()
+
+    @staticmethod
+    def insert_mesh(signature, geometry):
+        """
+        保存网格拓扑，顶点坐标和顶点序号以小端二进制存储
+
+        Args:
+            signature(str): 网格摘要
+            geometry(FaceGeometry): 网格几何数据
+
+        Returns:
+            Mesh
+        """
+        mesh = Mesh(
+            signature=signature,
+            node_x=np.ascontiguousarray(geometry.node_x, dtype='<f8').tobytes(),
+            node_y=np.ascontiguousarray(geometry.node_y, dtype='<f8').tobytes(),
+            face_nodes=np.ascontiguousarray(geometry.nodes, dtype='<i4').tobytes(),
+            face_count=len(geometry.counts),
+        )
+        mesh.save()
+        AppRepository.index_mesh_faces(mesh.id, geometry)
+        return mesh
+
+    @staticmethod
+    def index_mesh_faces(mesh_id, geometry):
+        """
+        保存每个网格的外接矩形到 R*Tree 索引，替换该网格拓扑已有的索引
+
+        Args:
+            mesh_id(int): 网格拓扑编号
+            geometry(FaceGeometry): 网格几何数据
+        """
+        faces, min_x, max_x, min_y, max_y = geometry.bounds()
+        rows = zip((faces + mesh_id * MESH_FACE_STRIDE).tolist(), repeat(mesh_id), repeat(mesh_id),
+                   min_x.tolist(), max_x.tolist(), min_y.tolist(), max_y.tolist())
+        with transaction.atomic(), connection.cursor() as cursor:
+            create_mesh_face_rtree(cursor)
+            # 删除网格拓扑后编号可能被复用
+            cursor.execute(f'delete from {MESH_FACE_RTREE} where min_mesh <= %s and max_mesh >= %s', [mesh_id, mesh_id])
+            cursor.executemany(f'insert into {MESH_FACE_RTREE} values (%s, %s, %s, %s, %s, %s, %s)', rows)
+        ensure_mesh_face_index.cache_clear()
+
+    @staticmethod
+    def filter_map_data(project, timestamp=None, bbox=None):
+        """
+        查询方案的网格数据，bbox 不为空时只返回与范围相交的网格
+
+        按范围查询时先由 R*Tree 索引找出网格，再按 (project, face_index, timestamp) 唯一索引读取；
+        子查询用 cross join 固定连接顺序，否则 SQLite 会选择 (project, timestamp) 索引扫描整个时刻。
+        R*Tree 的坐标按 float32 向外取整，可能多返回与范围边界相距 1 米以内的网格
+
+        Args:
+            project
+            timestamp(int): 时刻，为空时查询所有时刻
+            bbox(tuple): (最小经度, 最小纬度, 最大经度, 最大纬度)
+
+        Returns:
+            QuerySet
+        """
+        if bbox is None:
+            rows = MapData.objects.filter(project=project)
+            if timestamp is not None:
+                rows = rows.filter(timestamp=timestamp)
+            return rows
+        if project.mesh_id is None:
+            raise ValueError('项目方案没有网格数据，请先处理网格文件或转换历史数据')
+        ensure_mesh_face_index(project.mesh_id)
+        min_x, min_y, max_x, max_y = bbox
+        query = f"""
+        select m.id
+        from {MESH_FACE_RTREE} r cross join app_mapdata m
+        where r.min_mesh <= %s and r.max_mesh >= %s and r.max_x >= %s and r.min_x <= %s and r.max_y >= %s and r.min_y <= %s
+          and m.project_id = %s and m.face_index = r.id - %s
+        """
+        params = [project.mesh_id, project.mesh_id, min_x, max_x, min_y, max_y, project.id,
+                  project.mesh_id * MESH_FACE_STRIDE]
+        if timestamp is not None:
+            query += ' and m.timestamp = %s'
+            params.append(timestamp)
+        return MapData.objects.filter(id__in=RawSQL(query, params))
+
+    @staticmethod
+    def update_project_mesh(project, mesh):
+        if project.mesh_id != mesh.id:
+            project.mesh = mesh
+            project.save(update_fields=['mesh'])
+
+    @staticmethod
+    def get_mesh_geometry(mesh_id):
+        """
+        读取网格几何数据，网格数据不会变化，读取后缓存在内存中
+
+        Returns:
+            FaceGeometry
+        """
+        if mesh_id is None:
+            raise ValueError('项目方案没有网格数据，请先处理网格文件或转换历史数据')
+        return load_mesh_geometry(mesh_id)
+
     @staticmethod
     def upsert_station(project, station_name, lon, lat, water_depth, water_level, velocity_magnitude, timestamp):
         if timestamp is float:
@@ -76,12 +227,46 @@ class AppRepository:
         return data.pk
 
     @staticmethod
-    def get_map_by_project_and_timestamp(project, timestamp):
-        data = (MapData.objects
-                .filter(project=project, timestamp=timestamp)
-                .values_list('id', 'longitude', 'latitude', 'water_depth', 'risk', 'timestamp')
-                )
-        return list(data)
+    def bulk_upsert_station(project, station_names, lon, lat, water_depths, water_levels, velocity_magnitudes,
+                            timestamps, batch_size=None):
+        """
+        批量保存所有站点多个时刻的数据，通过唯一约束(project, station_name, timestamp)去重
+
+        Args:
+            project
+            station_names(list): [S] 站点名称，序号即 station_index
+            lon(ndarray): [S] 站点经度
+            lat(ndarray): [S] 站点纬度
+            water_depths(ndarray): [T*S] 水深
+            water_levels(ndarray): [T*S] 水位
+            velocity_magnitudes(ndarray): [T*S] 流速
+            timestamps(list): [T] 时刻
+            batch_size(int): 每批写入的行数
+
+        Returns
+            int: 实际写入的行数，不包括重复的行
+        """
+        lon = lon.tolist()
+        lat = lat.tolist()
+        water_depths = water_depths.tolist()
+        water_levels = water_levels.tolist()
+        velocity_magnitudes = velocity_magnitudes.tolist()
+        rows = []
+        for i, timestamp in enumerate(timestamps):
+            converted_timestamp = to_timestamp(timestamp)
+            for j, station_name in enumerate(station_names):
+                rows.append(StationData(
+                    project=project,
+                    station_name=station_name,
+                    station_index=j,
+                    longitude=lon[j],
+                    latitude=lat[j],
+                    water_depth=water_depths[i][j],
+                    water_level=water_levels[i][j],
+                    velocity_magnitude=velocity_magnitudes[i][j],
+                    timestamp=converted_timestamp,
+                ))
+        return bulk_insert(StationData, rows, batch_size)
 
     @staticmethod
     def get_latest_project():
@@ -110,23 +295,169 @@ class AppRepository:
         data = {
             'items': list(
                 items.object_list.values_list(
-                    'id', 'longitude', 'latitude', 'water_depth', 'risk', 'timestamp', 'created_at')),
+                    'id', 'face_index', 'water_depth', 'risk', 'timestamp', 'created_at')),
             'page': items.number,
             'size': size,
             'total': paginator.count
         }
         return data
 
+    @staticmethod
+    def project_keyset(before_id, size):
+        """
+        按 id 倒序查询 before_id 之前的方案，多查询一条用于判断是否还有下一页
+        """
+        projects = Project.objects.all()
+        if before_id is not None:
+            projects = projects.filter(id__lt=before_id)
+        return list(
+            projects.order_by('-id')
+            .values_list('id', 'name', 'description', 'created_at', 'forecast_period', 'type')[:size + 1]
+        )
+
+    @staticmethod
+    def count_projects():
+        return Project.objects.count()
+
+    @staticmethod
+    def forewarning_keyset(project, before_id, size, min_risk=None, min_water_depth=None):
+        """
+        按 id 倒序查询 before_id 之前的预警数据，走 project_id 索引，耗时与页码无关
+        """
+        rows = filter_forewarning(project, min_risk, min_water_depth)
+        if before_id is not None:
+            rows = rows.filter(id__lt=before_id)
+        return list(
+            rows.order_by('-id')
+            .values_list('id', 'face_index', 'water_depth', 'risk', 'timestamp', 'created_at')[:size + 1]
+        )
+
+    @staticmethod
+    def forewarning_severity(project, before, size, min_risk=None, min_water_depth=None):
+        """
+        按严重程度（风险等级、水深、id 倒序）查询预警数据，走 (project, risk, water_depth) 索引
+
+        Args:
+            project
+            before(tuple): 上一页最后一行的 (risk, water_depth, id)，为空时查询第一页
+            size(int): 每页条数，多查询一条用于判断是否还有下一页
+            min_risk(int): 最小风险等级
+            min_water_depth(float): 最小水深
+        """
+        rows = filter_forewarning(project, min_risk, min_water_depth)
+        if before is not None:
+            risk, water_depth, pk = int(before[0]), float(before[1]), int(before[2])
+            # 展开 (risk, water_depth, id) < 上一页最后一行；risk__lte 限定索引的扫描范围
+            rows = rows.filter(risk__lte=risk).filter(
+                Q(risk__lt=risk)
+                | Q(risk=risk, water_depth__lt=water_depth)
+                | Q(risk=risk, water_depth=water_depth, id__lt=pk)
+            )
+        return list(
+            rows.order_by('-risk', '-water_depth', '-id')
+            .values_list('id', 'face_index', 'water_depth', 'risk', 'timestamp', 'created_at')[:size + 1]
+        )
+
+    @staticmethod
+    def count_map_data(project, min_risk=None, min_water_depth=None):
+        return filter_forewarning(project, min_risk, min_water_depth).count()
+
+    @staticmethod
+    def rebuild_map_risk_summary(project, timestamp=None):
+        """
+        由网格数据重新统计方案的风险等级：写入网格数据后统计该时刻，或用于生成统计表之前处理的方案
+
+        Args:
+            project
+            timestamp(int): 时间戳，为空时统计所有时刻
+        """
+        summaries = MapRiskSummary.objects.filter(project=project)
+        if timestamp is None:
+            rows = (
+                MapData.objects.filter(project=project)
+                .values_list('timestamp', 'risk')
+                .annotate(count=Count('id'))
+                .order_by()
+            )
+        else:
+            summaries = summaries.filter(timestamp=timestamp)
+            # 没有统计信息时 SQLite 会选择 (project, risk, water_depth) 索引扫描整个方案来避免排序，这里固定使用时刻索引
+            query = """
+            select timestamp, risk, count(*)
+            from app_mapdata indexed by map_data_time_idx
+            where project_id = %s and timestamp = %s
+            group by risk
+            """
+            with connection.cursor() as cursor:
+                cursor.execute(query, [project.id, timestamp])
+                rows = cursor.fetchall()
+        with transaction.atomic():
+            summaries.delete()
+            bulk_insert(MapRiskSummary, [
+                MapRiskSummary(project=project, timestamp=time, risk=risk, count=count)
+                for time, risk, count in rows
+            ])
+
+    @staticmethod
+    def get_map_risk_summary(project, min_risk=None):
+        """
+        查询方案每个时刻各风险等级的网格数
+
+        Returns:
+            list: [(timestamp, risk, count)]，按时间、风险等级排序
+        """
+        rows = MapRiskSummary.objects.filter(project=project)
+        if min_risk is not None:
+            rows = rows.filter(risk__gte=min_risk)
+        return list(rows.order_by('timestamp', 'risk').values_list('timestamp', 'risk', 'count'))
+
+    @staticmethod
+    def get_map_timestamps(project):
+        """
+        方案的所有时刻，读取统计表，不扫描网格数据
+
+        Returns:
+            list: [timestamp]，按时间排序
+        """
+        return list(
+            MapRiskSummary.objects.filter(project=project)
+            .order_by('timestamp').values_list('timestamp', flat=True).distinct()
+        )
+
+    @staticmethod
+    def get_map_face_series(project, face):
+        """
+        查询一个网格所有时刻的数据，走 (project, face_index, timestamp) 唯一索引
+
+        Returns:
+            list: [(timestamp, water_depth, risk)]，按时间排序
+        """
+        return list(
+            MapData.objects.filter(project=project, face_index=face)
+            .order_by('timestamp').values_list('timestamp', 'water_depth', 'risk')
+        )
+
+    @staticmethod
+    def has_map_risk_summary(project):
+        return MapRiskSummary.objects.filter(project=project).exists()
+
+    @staticmethod
+    def has_map_data(project):
+        return MapData.objects.filter(project=project).exists()
+
     @staticmethod
     def representation_station(project_id):
+        """
+        查询方案每个时刻的站点代表数据，读取处理站点数据时生成的统计表，走 (project, timestamp) 唯一索引
+
+        Returns:
+            list: [{'id', 'station_name', 'water_depth', 'velocity_magnitude', 'timestamp'}]，按时间排序
+        """
         query = """
-        select id, station_name, max(water_depth) as water_depth, max(velocity_magnitude) as velocity_magnitude, timestamp
-        from (select *
-              from app_stationdata
-              where project_id = %s
-              order by id desc
-              limit 480)
-        group by timestamp;
+        select station_data_id as id, station_name, water_depth, velocity_magnitude, timestamp
+        from app_stationsummary
+        where project_id = %s
+        order by timestamp;
         """
         with connection.cursor() as cursor:
             cursor.execute(query, [project_id])
@@ -138,18 +469,60 @@ class AppRepository:
         return data
 
     @staticmethod
-    def trend_station(name):
+    def rebuild_station_summary(project):
+        """
+        统计方案每个时刻所有站点的最大水深和最大流速，与原来的 group by 一致，
+        站点取流速最大的站点，流速相同时取 id 最大的站点
+        """
+        rows = (
+            StationData.objects.filter(project=project)
+            .order_by('timestamp', '-id')
+            .values_list('id', 'station_name', 'water_depth', 'velocity_magnitude', 'timestamp')
+        )
+        summaries = []
+        for timestamp, group in groupby(rows, key=itemgetter(4)):
+            group = list(group)
+            station = max(group, key=itemgetter(3))
+            summaries.append(StationSummary(
+                project=project,
+                timestamp=timestamp,
+                station_data_id=station[0],
+                station_name=station[1],
+                water_depth=max(row[2] for row in group),
+                velocity_magnitude=station[3],
+            ))
+        with transaction.atomic():
+            StationSummary.objects.filter(project=project).delete()
+            bulk_insert(StationSummary, summaries)
+
+    @staticmethod
+    def has_station_summary(project):
+        return StationSummary.objects.filter(project=project).exists()
+
+    @staticmethod
+    def has_station_data(project):
+        return StationData.objects.filter(project=project).exists()
+
+    @staticmethod
+    def get_latest_station_project_id():
+        """
+        最近写入站点数据的方案，按主键倒序只读取一行
+        """
+        return StationData.objects.order_by('-id').values_list('project_id', flat=True).first()
+
+    @staticmethod
+    def trend_station(project_id, name):
+        """
+        查询方案中一个站点的所有时刻，走 (project, station_name, timestamp) 唯一索引
+        """
         query = """
         select id, station_name, water_depth, water_level, velocity_magnitude, timestamp
-        from (select *
-              from app_stationdata
-              order by id desc
-              limit 480)
-        where station_name = %s
+        from app_stationdata
+        where project_id = %s and station_name = %s
         order by timestamp;
-                """
+        """
         with connection.cursor() as cursor:
-            cursor.execute(query, [name])
+            cursor.execute(query, [project_id, name])
             columns = [col[0] for col in cursor.description]
             data = [
                 dict(zip(columns, row))
@@ -157,6 +530,39 @@ class AppRepository:
             ]
         return data
 
+    @staticmethod
+    def get_data_version(project_id=None):
+        """
+        查询方案数据的版本，只使用主键和 project_id 索引，不读取数据本身
+
+        Args:
+            project_id(int): 方案编号，为空时使用最新的方案
+
+        Returns:
+            dict: {'project_id', 'updated_at', 'map_id', 'station_id'}，方案不存在时返回 None
+        """
+        projects = Project.objects.all()
+        if project_id is None:
+            projects = projects.order_by('-id')
+        else:
+            projects = projects.filter(pk=project_id)
+        project = projects.values('id', 'updated_at').first()
+        if project is None:
+            return None
+        return {
+            'project_id': project['id'],
+            'updated_at': project['updated_at'],
+            'map_id': MapData.objects.filter(project_id=project['id']).aggregate(value=Max('id'))['value'],
+            'station_id': StationData.objects.filter(project_id=project['id']).aggregate(value=Max('id'))['value'],
+        }
+
+    @staticmethod
+    def touch_project(project_id):
+        """
+        更新方案的 updated_at，写入方案数据后调用
+        """
+        Project.objects.filter(pk=project_id).update(updated_at=timezone.now())
+
     @staticmethod
     def get_project_by_id(project_id):
         try:
@@ -222,6 +628,45 @@ class AppRepository:
         model_data.save()
         return model_data.id
 
+    @staticmethod
+    def bulk_upsert_upstream_water_level(station_name, rows, batch_size=None):
+        """
+        批量保存上游水位，通过唯一约束(station, datetime)去重
+
+        Args:
+            station_name(str)
+            rows(list): [(datetime, data)]
+            batch_size(int): 每批写入的行数
+        """
+        data = [UpstreamWaterLevel(station=station_name, datetime=datetime, data=value) for datetime, value in rows]
+        return bulk_insert(UpstreamWaterLevel, data, batch_size)
+
+    @staticmethod
+    def bulk_upsert_downstream_water_level(station_name, rows, batch_size=None):
+        """
+        批量保存下游水位，通过唯一约束(station, datetime)去重
+
+        Args:
+            station_name(str)
+            rows(list): [(datetime, data)]
+            batch_size(int): 每批写入的行数
+        """
+        data = [DownstreamWaterLevel(station=station_name, datetime=datetime, data=value) for datetime, value in rows]
+        return bulk_insert(DownstreamWaterLevel, data, batch_size)
+
+    @staticmethod
+    def bulk_upsert_rainfall(station_name, rows, batch_size=None):
+        """
+        批量保存降水数据，通过唯一约束(station, datetime)去重
+
+        Args:
+            station_name(str)
+            rows(list): [(datetime, data)]
+            batch_size(int): 每批写入的行数
+        """
+        data = [Rainfall(station=station_name, datetime=datetime, data=value) for datetime, value in rows]
+        return bulk_insert(Rainfall, data, batch_size)
+
     @staticmethod
     def get_latest_upstream_water_level(start_time=None):
         if start_time is None:
@@ -261,24 +706,168 @@ class AppRepository:
     def get_map_by_project_and_timestamp(project, timestamp):
         data = (
             MapData.objects.filter(project=project, timestamp=timestamp)
-            .values_list('id', 'longitude', 'latitude', 'water_depth',
-                         'risk', 'timestamp')
+            .values_list('id', 'face_index', 'water_depth', 'risk', 'timestamp')
         )
         return list(data)
 
     @staticmethod
-    def get_history_map(project):
-        times = AppRepository.get_map_times(project)
-        arr = []
-        for time in times:
-            data = AppRepository.get_map_by_project_and_timestamp(project, time['timestamp'])
-            datetime = timestamp_to_datetime(time['timestamp'])
-            arr.append({
-                'time': datetime,
-                'data': convert_map_data_to_json(data)
-            })
+    def iter_map_by_project_and_timestamp(project, timestamp, bbox=None):
+        """
+        与 get_map_by_project_and_timestamp 相同，分批读取，不一次性加载所有行；bbox 不为空时只返回与范围相交的网格
+        """
+        return (
+            AppRepository.filter_map_data(project, timestamp, bbox)
+            .values_list('id', 'face_index', 'water_depth', 'risk', 'timestamp')
+            .iterator(chunk_size=config['database']['batch_size'])
+        )
+
+    @staticmethod
+    def iter_map_by_timestamp(project, *fields, bbox=None):
+        """
+        用一次查询按时间倒序读取方案的所有网格数据，逐个时刻返回
+
+        Args:
+            project
+            fields: 查询的字段，不包含 timestamp
+            bbox(tuple): 范围，为空时返回所有网格
+
+        Yields:
+            tuple: (timestamp, [(fields...)])
+        """
+        rows = (
+            AppRepository.filter_map_data(project, bbox=bbox)
+            .order_by('-timestamp', '-id')
+            .values_list('timestamp', *fields)
+            .iterator(chunk_size=config['database']['batch_size'])
+        )
+        for timestamp, group in groupby(rows, key=itemgetter(0)):
+            yield timestamp, [row[1:] for row in group]
+
+    @staticmethod
+    def get_history_map(project, bbox=None):
+        return list(AppRepository.iter_history_map(project, bbox))
+
+    @staticmethod
+    def iter_history_map(project, bbox=None):
+        """
+        逐个时刻返回网格时段数据，同一时间只有一个时刻的数据在内存中
+        """
+        geometry = AppRepository.get_mesh_geometry(project.mesh_id)
+        fields = ('id', 'face_index', 'water_depth', 'risk', 'timestamp')
+        for timestamp, data in AppRepository.iter_map_by_timestamp(project, *fields, bbox=bbox):
+            yield {
+                'time': timestamp_to_datetime(timestamp),
+                'data': convert_map_data_to_json(data, geometry)
+            }
+
+    @staticmethod
+    def get_legacy_map_projects():
+        """
+        查询存在历史格式网格数据（按行存储坐标）的方案
+        """
+        project_ids = MapData.objects.filter(face_index__isnull=True).values('project_id').distinct()
+        return Project.objects.filter(id__in=project_ids).order_by('id')
+
+    @staticmethod
+    def get_legacy_map_rows(project):
+        return (
+            MapData.objects.filter(project=project, face_index__isnull=True)
+            .order_by('id')
+            .values_list('id', 'longitude', 'latitude', 'timestamp')
+            .iterator(chunk_size=config['database']['batch_size'])
+        )
+
+    @staticmethod
+    def update_map_faces(rows, batch_size=None):
+        """
+        批量回填网格序号，并清除按行存储的坐标
+
+        Args:
+            rows(list): [(id, face_index)]
+            batch_size(int): 每批写入的行数
+        """
+        if batch_size is None:
+            batch_size = config['database']['batch_size']
+        data = [MapData(id=pk, face_index=face, longitude=None, latitude=None) for pk, face in rows]
+        with transaction.atomic():
+            MapData.objects.bulk_update(data, ['face_index', 'longitude', 'latitude'], batch_size=batch_size)
+
+    @staticmethod
+    def delete_map_data(ids):
+        MapData.objects.filter(id__in=ids).delete()
+
+    @staticmethod
+    def get_history_map_indexed(project, bbox=None):
+        """
+        查询网格时段数据，网格坐标只返回一次
+
+        Returns:
+            dict: {
+                'geometry': {'faces': [网格序号], 'coordinates': [[[纬度, 经度], ...]]},
+                'times': [{'time': 时间, 'faces': [网格序号], 'waterDepth': [水深], 'risk': [风险等级]}]
+            }
+        """
+        data = AppRepository.iter_history_map_indexed(project, bbox)
+        times = list(data['times'])
+        return {'geometry': data['geometry'](), 'times': times}
+
+    @staticmethod
+    def iter_history_map_indexed(project, bbox=None):
+        """
+        流式版本的 get_history_map_indexed：times 为逐个时刻返回的迭代器，
+        geometry 为函数，在 times 读取完后调用，返回出现过的网格坐标
+
+        Returns:
+            dict: {'times': 迭代器, 'geometry': 函数}
+        """
+        geometry = AppRepository.get_mesh_geometry(project.mesh_id)
+        used = set()
+
+        def iter_times():
+            rows_by_time = AppRepository.iter_map_by_timestamp(project, 'face_index', 'water_depth', 'risk', bbox=bbox)
+            for timestamp, rows in rows_by_time:
+                faces, water_depths, risks = [], [], []
+                for face, water_depth, risk in rows:
+                    faces.append(face)
+                    water_depths.append(float(water_depth))
+                    risks.append(risk)
+                used.update(faces)
+                yield {
+                    'time': timestamp_to_datetime(timestamp),
+                    'faces': faces,
+                    'waterDepth': water_depths,
+                    'risk': risks,
+                }
+
+        def used_geometry():
+            faces = sorted(used)
+            return {
+                'faces': faces,
+                'coordinates': [geometry.lat_lon(face) for face in faces],
+            }
+
+        return {'times': iter_times(), 'geometry': used_geometry}
+
+    @staticmethod
+    def get_map_columns(project, timestamp=None, bbox=None):
+        """
+        按列查询网格数据，不生成逐行的字典
+
+        Args:
+            project
+            timestamp(int): 时刻，为空时查询所有时刻（按时间倒序）
+            bbox(tuple): 范围，为空时返回所有网格
 
-        return arr
+        Returns:
+            dict: {'face': int32, 'waterDepth': float32, 'risk': int32, 'timestamp': int64}
+        """
+        rows = (
+            AppRepository.filter_map_data(project, timestamp, bbox)
+            .order_by('-timestamp', '-id')
+            # 未转换的历史数据没有网格序号，记为-1
+            .values_list(Coalesce('face_index', Value(-1)), Cast('water_depth', FloatField()), 'risk', 'timestamp')
+        )
+        return to_columns(rows.iterator(chunk_size=config['database']['batch_size']), MAP_COLUMNS)
 
     @staticmethod
     def get_station_times(project):
@@ -300,10 +889,49 @@ class AppRepository:
         )
         return list(data)
 
+    @staticmethod
+    def iter_station_by_project_and_timestamp(project, timestamp):
+        """
+        与 get_station_by_project_and_timestamp 相同，分批读取
+        """
+        return (
+            StationData.objects.filter(project=project, timestamp=timestamp)
+            .values_list('id',
+                         'longitude',
+                         'latitude',
+                         'water_depth',
+                         'water_level',
+                         'velocity_magnitude',
+                         'station_name',
+                         'timestamp')
+            .iterator(chunk_size=config['database']['batch_size'])
+        )
+
+    @staticmethod
+    def get_station_index(project):
+        """
+        查询方案的站点序号
+
+        Returns:
+            dict: {站点名称: station_index}
+        """
+        rows = (
+            StationData.objects.filter(project=project, station_index__isnull=False)
+            .values_list('station_name', 'station_index')
+            .distinct()
+        )
+        return dict(rows)
+
     @staticmethod
     def get_station_by_project_and_station_name(project, station_name):
+        station_index = AppRepository.get_station_index(project).get(station_name)
+        rows = StationData.objects.filter(project=project)
+        if station_index is None:
+            rows = rows.filter(station_name=station_name)
+        else:
+            rows = rows.filter(station_index=station_index)
         data = (
-            StationData.objects.filter(project=project, station_name=station_name)
+            rows
             .order_by('-timestamp')
             .values_list('id',
                          'longitude',
@@ -316,6 +944,40 @@ class AppRepository:
         )
         return list(data)
 
+    @staticmethod
+    def get_station_columns(project, timestamp=None):
+        """
+        按列查询站点数据
+
+        Args:
+            project
+            timestamp(int): 时刻，为空时查询所有时刻（按时间倒序）
+
+        Returns:
+            tuple: (站点名称列表, {'station': int32, 'waterDepth': float32, ...})，station 为站点名称列表中的序号
+        """
+        rows = StationData.objects.filter(project=project)
+        if timestamp is not None:
+            rows = rows.filter(timestamp=timestamp)
+        rows = (
+            rows.order_by('-timestamp', 'id')
+            .values_list('station_name',
+                         'longitude',
+                         'latitude',
+                         Cast('water_depth', FloatField()),
+                         Cast('water_level', FloatField()),
+                         Cast('velocity_magnitude', FloatField()),
+                         'timestamp')
+        )
+        names = {}
+
+        def encode(rows):
+            for name, *values in rows:
+                yield names.setdefault(name, len(names)), *values
+
+        columns = to_columns(encode(rows.iterator(chunk_size=config['database']['batch_size'])), STATION_COLUMNS)
+        return list(names), columns
+
     @staticmethod
     def project_list():
         data = (
@@ -338,6 +1000,14 @@ class AppRepository:
         data.save()
         return data.id
 
+    @staticmethod
+    def bulk_upsert_rainfall_series(project, rainfall_arr, batch_size=None):
+        """
+        批量保存降雨序列，通过唯一约束(project, rainfall)去重
+        """
+        data = [RainfallSeries(project=project, rainfall=rainfall) for rainfall in rainfall_arr]
+        return bulk_insert(RainfallSeries, data, batch_size)
+
     @staticmethod
     def get_rainfall_series(project):
         data = RainfallSeries.objects.filter(project=project).values_list('id', 'rainfall')
@@ -349,6 +1019,198 @@ class AppRepository:
             })
         return json_arr
 
+    @staticmethod
+    def insert_job(request):
+        job = ProjectJob(request=request)
+        job.save()
+        return job.id
+
+    @staticmethod
+    def update_job(job_id, **fields):
+        ProjectJob.objects.filter(pk=job_id).update(**fields)
+
+    @staticmethod
+    def fail_unfinished_jobs(created_before, error):
+        """
+        将 created_before 之前创建的等待中、运行中的任务标记为失败
+
+        Returns:
+            int: 更新的任务数
+        """
+        return ProjectJob.objects.filter(
+            status__in=[ProjectJob.STATUS_PENDING, ProjectJob.STATUS_RUNNING], created_at__lt=created_before
+        ).update(status=ProjectJob.STATUS_FAILED, error=error, finished_at=timezone.now())
+
+    @staticmethod
+    def get_job_by_id(job_id):
+        try:
+            return ProjectJob.objects.get(pk=job_id)
+        except ProjectJob.DoesNotExist:
+            raise ValueError(f'任务 {job_id} 不存在，请检查参数是否正确')
+
+    @staticmethod
+    def job_list(size):
+        return list(ProjectJob.objects.order_by('-id')[:size])
+
+    @staticmethod
+    def get_run_cache(signature):
+        return ModelRunCache.objects.filter(signature=signature).first()
+
+    @staticmethod
+    def upsert_run_cache(signature, project_id, path, size, output):
+        """
+        一条 INSERT ... ON CONFLICT 语句写入缓存，不在事务中先查询再插入，避免 SQLite 锁冲突
+        """
+        ModelRunCache.objects.bulk_create(
+            [ModelRunCache(signature=signature, project_id=project_id, path=path, size=size, output=output)],
+            update_conflicts=True,
+            unique_fields=['signature'],
+            update_fields=['project', 'path', 'size', 'output', 'last_used_at'],
+        )
+
+    @staticmethod
+    def touch_run_cache(entry, **fields):
+        """
+        更新缓存的使用时间
+        """
+        for name, value in fields.items():
+            setattr(entry, name, value)
+        entry.save()
+
+    @staticmethod
+    def delete_run_cache(entry):
+        entry.delete()
+
+    @staticmethod
+    def run_cache_list():
+        """
+        有缓存文件的记录，按最近使用时间从早到晚排序
+        """
+        return list(ModelRunCache.objects.filter(size__gt=0).order_by('last_used_at'))
+
+    @staticmethod
+    def clone_project_data(source_id, target_id):
+        """
+        复制方案的网格数据和站点数据
+
+        Args:
+            source_id(int): 源方案
+            target_id(int): 目标方案
+        """
+        source = Project.objects.get(pk=source_id)
+        Project.objects.filter(pk=target_id).update(mesh_id=source.mesh_id)
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in (MapData, StationData, MapRiskSummary):
+                columns = [
+                    field.column for field in model._meta.concrete_fields
+                    if field.name not in ('id', 'project', 'created_at')
+                ]
+                column_sql = ', '.join(columns)
+                if any(field.name == 'created_at' for field in model._meta.concrete_fields):
+                    target_sql = f'project_id, created_at, {column_sql}'
+                    select_sql = f'%s, %s, {column_sql}'
+                    params = [target_id, connection.ops.adapt_datetimefield_value(timezone.now()), source_id]
+                else:
+                    target_sql = f'project_id, {column_sql}'
+                    select_sql = f'%s, {column_sql}'
+                    params = [target_id, source_id]
+                cursor.execute(
+                    f"""
+                    insert into {model._meta.db_table} ({target_sql})
+                    select {select_sql}
+                    from {model._meta.db_table}
+                    where project_id = %s
+                    """,
+                    params
+                )
+        AppRepository.rebuild_station_summary(Project.objects.get(pk=target_id))
+
+
+def filter_forewarning(project, min_risk=None, min_water_depth=None):
+    rows = MapData.objects.filter(project=project)
+    if min_risk is not None:
+        rows = rows.filter(risk__gte=min_risk)
+    if min_water_depth is not None:
+        rows = rows.filter(water_depth__gte=min_water_depth)
+    return rows
+
+
+@lru_cache(maxsize=8)
+def load_mesh_geometry(mesh_id):
+    mesh = Mesh.objects.get(pk=mesh_id)
+    node_x = np.frombuffer(mesh.node_x, dtype='<f8')
+    node_y = np.frombuffer(mesh.node_y, dtype='<f8')
+    nodes = np.frombuffer(mesh.face_nodes, dtype='<i4').reshape(mesh.face_count, -1)
+    return build_geometry(node_x, node_y, nodes)
+
+
+# 网格外接矩形的 R*Tree 索引，mesh 维度为网格拓扑编号，按范围查询时只搜索一个网格拓扑；
+# id = mesh_id * MESH_FACE_STRIDE + face_index
+MESH_FACE_RTREE = 'app_mesh_face_rtree'
+MESH_FACE_STRIDE = 1 << 32
+
+
+def create_mesh_face_rtree(cursor):
+    cursor.execute(f'create virtual table if not exists {MESH_FACE_RTREE} '
+                   'using rtree(id, min_mesh, max_mesh, min_x, max_x, min_y, max_y)')
+
+
+@lru_cache(maxsize=None)
+def ensure_mesh_face_index(mesh_id):
+    """
+    之前保存的网格拓扑没有 R*Tree 索引，第一次按范围查询时生成
+    """
+    with connection.cursor() as cursor:
+        create_mesh_face_rtree(cursor)
+        cursor.execute(f'select 1 from {MESH_FACE_RTREE} where min_mesh <= %s and max_mesh >= %s limit 1',
+                       [mesh_id, mesh_id])
+        exists = cursor.fetchone() is not None
+    if not exists:
+        AppRepository.index_mesh_faces(mesh_id, load_mesh_geometry(mesh_id))
+
+
+# 列式导出的列名和类型
+MAP_COLUMNS = [('face', '<i4'), ('waterDepth', '<f4'), ('risk', '<i4'), ('timestamp', '<i8')]
+STATION_COLUMNS = [('station', '<i4'), ('lon', '<f8'), ('lat', '<f8'), ('waterDepth', '<f4'), ('waterLevel', '<f4'),
+                   ('velocityMagnitude', '<f4'), ('timestamp', '<i8')]
+
+
+def to_columns(rows, dtype):
+    """
+    把查询结果直接读入结构化数组，再拆分为各列
+
+    Returns:
+        dict: {列名: ndarray}
+    """
+    array = np.fromiter(rows, dtype=dtype)
+    return {name: np.ascontiguousarray(array[name]) for name, _ in dtype}
+
+
+def bulk_insert(model, rows, batch_size=None):
+    """
+    在一个事务内分批写入，依赖数据库唯一约束忽略重复数据
+
+    bulk_create 使用 insert or ignore，返回的实例不区分是否写入，
+    SQLite 由连接的 total_changes 计算实际写入的行数，其他数据库无法区分，返回提交的行数
+
+    Args:
+        model: 模型类
+        rows(list): 模型实例
+        batch_size(int): 每批写入的行数，默认读取配置 database.batch_size
+
+    Returns:
+        int: 实际写入的行数，不包括重复的行
+    """
+    if batch_size is None:
+        batch_size = config['database']['batch_size']
+    with transaction.atomic():
+        if connection.vendor != 'sqlite':
+            model.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+            return len(rows)
+        before = connection.connection.total_changes
+        model.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+        return connection.connection.total_changes - before
+
 
 def convert_to_json(result):
     json_arr = []
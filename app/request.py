@@ -18,6 +18,11 @@ class RepresentationStationRequest:
     project_id: Optional[int] = field(default=None)
 
 
+@dataclass
+class TrendStationRequest:
+    project_id: Optional[int] = field(default=None)
+
+
 @dataclass
 class RunProjectRequest:
     name: str
@@ -27,6 +32,7 @@ class RunProjectRequest:
     upstream_water_level: Optional[list] = field(default=None)
     downstream_water_level: Optional[list] = field(default=None)
     type: Optional[int] = field(default=1)
+    use_cache: Optional[bool] = field(default=True)
 
 
 @dataclass
@@ -40,6 +46,26 @@ class UpdateProjectRequest:
 @dataclass
 class ExportMapRequest:
     project_id: Optional[int] = field(default=None)
+    # 范围 [最小经度, 最小纬度, 最大经度, 最大纬度]，只返回与范围相交的网格
+    bbox: Optional[list] = field(default=None)
+    # 细节层级，0为原始网格，层级越高合并的网格越多，格子取最大水深和最大风险等级
+    lod: Optional[int] = field(default=0)
+
+
+@dataclass
+class MapPointRequest:
+    lon: float
+    lat: float
+    project_id: Optional[int] = field(default=None)
+
+
+@dataclass
+class MapExtentRequest:
+    project_id: Optional[int] = field(default=None)
+    # 时刻，2001-01-01 起的秒数或 2021-07-30 00:00:00 格式的时间，为空时使用最新的时刻
+    time: Optional[str] = field(default=None)
+    # 最小风险等级，为空时返回所有风险等级
+    min_risk: Optional[int] = field(default=None)
 
 
 @dataclass
@@ -56,3 +82,9 @@ class ExportHistoryStationRequest:
 @dataclass
 class ExportHistoryMapRequest:
     project_id: Optional[int] = field(default=None)
+    # faces: 每个时刻返回完整的网格列表；indexed: 网格坐标只返回一次，每个时刻只返回网格序号、水深和风险等级
+    format: Optional[str] = field(default='faces')
+    # 范围 [最小经度, 最小纬度, 最大经度, 最大纬度]，只返回与范围相交的网格
+    bbox: Optional[list] = field(default=None)
+    # 细节层级，0为原始网格，层级越高合并的网格越多，格子取最大水深和最大风险等级
+    lod: Optional[int] = field(default=0)
@@ -10,8 +10,8 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from bs4 import BeautifulSoup
 from django.utils import timezone
 
-from app.models import Rainfall
 from app.repository.app_repository import AppRepository
+from app.service.cache import response_cache, TAG_WATER
 from app.tools import download_png, datetime_to_timestamp, is_two_decimal_number
 from hydrologic_forecasting.settings import config
 
@@ -32,19 +32,13 @@ def pull_data_from_dan_yang():
         if response['code'] == 0:
             data = response['data']
             passed_chart = data['passedchart']
+            current_tz = pytz.timezone('Asia/Shanghai')
+            rows = []
             for chart in passed_chart:
-                # first
                 time = datetime.strptime(chart['time'], '%Y-%m-%d %H:%M')
-                current_tz = pytz.timezone('Asia/Shanghai')
-                aware_datetime = current_tz.localize(time)
-                result = Rainfall.objects.filter(station='丹阳', datetime=aware_datetime)[:1]
-                if result.count() == 0:
-                    rainfall = Rainfall(
-                        station='丹阳',
-                        datetime=aware_datetime,
-                        data=chart['rain1h']
-                    )
-                    rainfall.save()
+                rows.append((current_tz.localize(time), chart['rain1h']))
+            AppRepository.bulk_upsert_rainfall('丹阳', rows)
+            response_cache.invalidate(TAG_WATER)
 
 
 def pull_data_from_jian_bi_zha_png():
@@ -69,10 +63,15 @@ def pull_data_from_jian_bi_zha_png():
         upstream_water_level = parse_string_numbers(upstream_water_level)
         downstream_water_level = parse_string_numbers(downstream_water_level)
 
+        upstream_rows = []
+        downstream_rows = []
         for i in range(24):
             time = timestamp_to_datetime(start_timestamp - i * 60 * 60)
-            AppRepository.upsert_upstream_water_level('谏壁闸', time, upstream_water_level[i])
-            AppRepository.upsert_downstream_water_level('谏壁闸', time, downstream_water_level[i])
+            upstream_rows.append((time, upstream_water_level[i]))
+            downstream_rows.append((time, downstream_water_level[i]))
+        AppRepository.bulk_upsert_upstream_water_level('谏壁闸', upstream_rows)
+        AppRepository.bulk_upsert_downstream_water_level('谏壁闸', downstream_rows)
+        response_cache.invalidate(TAG_WATER)
 
 
 def parse_string_numbers(water_level_arr):
@@ -1,48 +1,35 @@
 import logging
 import os
 import subprocess
+from contextlib import nullcontext
+from dataclasses import asdict
+from decimal import Decimal
+from itertools import groupby
+from operator import itemgetter
 
 import netCDF4 as nc
 import numpy as np
-from shapely import MultiPoint
 import pandas as pd
 
 from app.models import Project
-from app.repository.app_repository import AppRepository
+from app.renderers import iter_json_bytes
+from app.repository.app_repository import AppRepository, MAP_COLUMNS
 from app.request import HandleMapRequest, HandleStationRequest
-from app.tools import search_file, convert_map_data_to_json, convert_station_data_to_json
-from app.tools import timestamp_to_datetime
+from app.service.mesh import resolve_faces, sort_vertices, mesh_signature, build_geometry, tile_lod
+from app.service.extent import extent_feature_collection
+from app.service.cache import response_cache, tile_cache, TAG_PROJECT, TAG_WATER
+from app.service.job import job_runner
+from app.service.reader import MapReader, StationReader, first_time_index, iter_wet_face_rows
+from app.service.run_cache import run_signature, store_outputs, remove_outputs
+from app.service.tiles import check_tile, tile_bounds, encode_tile
+from app.service.workspace import Workspace
+from app.tools import search_file, convert_station_data_to_json, iter_map_data_json, iter_station_data_json, \
+    convert_map_data_to_json
+from app.tools import timestamp_to_datetime, encode_cursor, decode_cursor, parse_bbox, datetime_to_timestamp, \
+    to_timestamp
 from hydrologic_forecasting.settings import config
 
 
-def sort_vertices(lon, lat):
-    """
-    排序四角网格的顶点
-
-    Args:
-        lon(ndarray): 经度数组
-        lat(ndarray): 纬度数组
-
-    Returns:
-        ndarray: [3 0 1 2]
-
-    Example:
-        sort_vertices([22.52566799 22.52892391 22.52876978 22.52475916], [113.86085031 113.86083196 113.85659267 113.8577512 ])
-    """
-    # 计算质心
-    centroid = MultiPoint(list(zip(lon, lat))).centroid
-    cx, cy = centroid.x, centroid.y
-
-    # 计算每个顶点相对于质心的角度
-    angles = np.arctan2(lat - cy, lon - cx)
-
-    # 根据角度排序顶点
-    sort_order = np.argsort(angles)
-
-    # 返回排序后的顶点索引
-    return sort_order
-
-
 class AppService:
     # private var
     _app_repository_instance = None
@@ -52,40 +39,164 @@ class AppService:
             self._app_repository_instance = AppRepository()
         self.repository = self._app_repository_instance
 
-    def run_project(self, req):
+    def run_project(self, req, timer=None):
         """
         创建项目，并运行模型
+
+        Args:
+            req(RunProjectRequest)
+            timer(StageTimer): 记录各阶段耗时，为空时不记录
+
+        Returns:
+            tuple: (项目编号, 模型输出)
         """
-        # write input data
-        # WaterLevel.bc Discharge.bc
+        if timer is None:
+            timer = no_timer
+
         if req.upstream_water_level is None or req.downstream_water_level is None:
             res = self.latest_water_information(req.start_time)
             req.upstream_water_level = res['upstreamWaterLevel']
             req.downstream_water_level = res['downstreamWaterLevel']
             if len(req.upstream_water_level) < 48 or len(req.downstream_water_level) < 48:
                 raise RuntimeError('模型输入时间不足48小时')
-        write_upstream_water_level(req.upstream_water_level)
-        write_downstream_water_level(req.downstream_water_level)
 
         date_times = []
         for v in req.upstream_water_level:
             date_times.append(v['datetime'])
 
-        # execute bat
-        bat_path = config['model']['script']['bat_path']
-        bat_workspace = config['model']['script']['bat_workspace']
-        result = subprocess.run([bat_path], cwd=bat_workspace, capture_output=True, text=True)
-        print(f"执行bat脚本结束，返回结果：{result}")
-        if result.returncode != 0:
-            raise RuntimeError(result.stderr)
-        else:
+        # 每次运行使用独立的工作空间，结束后自动清理
+        with Workspace() as workspace:
+            # write input data
+            # WaterLevel.bc Discharge.bc
+            with timer('input'):
+                write_upstream_water_level(req.upstream_water_level, workspace.input_dir)
+                write_downstream_water_level(req.downstream_water_level, workspace.input_dir)
+                signature = run_signature(workspace.input_dir, date_times, req.type)
+
+            # 相同输入的模型已经运行过，直接复用结果
+            if req.use_cache:
+                cached = self.run_project_from_cache(req, signature, date_times, timer)
+                if cached is not None:
+                    return cached
+
+            # execute bat
+            with timer('model'):
+                result = subprocess.run([workspace.bat_path], cwd=workspace.work_dir, env=workspace.env,
+                                        capture_output=True, text=True)
+                print(f"执行bat脚本结束，返回结果：{result}")
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr)
+
             # 执行成功
-            project_id = self.repository.insert_project(req)
-            self.handle_map(HandleMapRequest(project_id=project_id), date_times)
-            self.handle_station(HandleStationRequest(project_id=project_id), date_times)
-            return result.stdout
+            project_id = self.create_project(req, timer)
+            with timer('map'):
+                self.handle_map(HandleMapRequest(project_id=project_id), date_times, workspace.output_dir)
+            with timer('station'):
+                self.handle_station(HandleStationRequest(project_id=project_id), date_times, workspace.output_dir)
+            with timer('cache'):
+                self.save_run_cache(signature, project_id, workspace.output_dir, result.stdout)
+        response_cache.invalidate(TAG_PROJECT)
+        return project_id, result.stdout
+
+    def create_project(self, req, timer):
+        """
+        创建方案，并立即记录到任务中
+        """
+        project_id = self.repository.insert_project(req)
+        timer.set_project(project_id)
+        return project_id
+
+    def run_project_from_cache(self, req, signature, date_times, timer):
+        """
+        从缓存中复用模型运行结果：源方案存在时复制数据，否则从缓存的输出文件处理
+
+        Returns:
+            tuple: (项目编号, 模型输出)，没有可用缓存时返回 None
+        """
+        entry = self.repository.get_run_cache(signature)
+        if entry is None:
+            return None
+
+        if entry.project_id is not None:
+            with timer('cache'):
+                project_id = self.create_project(req, timer)
+                self.repository.clone_project_data(entry.project_id, project_id)
+                self.repository.touch_project(project_id)
+            self.touch_run_cache(entry)
+            response_cache.invalidate(TAG_PROJECT)
+            return project_id, entry.output
+
+        if entry.path and os.path.isdir(entry.path):
+            project_id = self.create_project(req, timer)
+            with timer('map'):
+                self.handle_map(HandleMapRequest(project_id=project_id), date_times, entry.path)
+            with timer('station'):
+                self.handle_station(HandleStationRequest(project_id=project_id), date_times, entry.path)
+            self.touch_run_cache(entry, project_id=project_id)
+            response_cache.invalidate(TAG_PROJECT)
+            return project_id, entry.output
+
+        self.repository.delete_run_cache(entry)
+        return None
+
+    def touch_run_cache(self, entry, **fields):
+        """
+        更新缓存的使用时间，失败时只记录日志，方案已经生成，不影响运行结果
+        """
+        try:
+            self.repository.touch_run_cache(entry, **fields)
+        except Exception as e:
+            logging.exception("更新模型运行缓存失败：%s", e)
+
+    def save_run_cache(self, signature, project_id, output_dir, output):
+        """
+        保存模型运行结果，失败时只记录日志，方案已经生成，不影响运行结果
+        """
+        try:
+            self.store_run_cache(signature, project_id, output_dir, output)
+        except Exception as e:
+            logging.exception("保存模型运行缓存失败：%s", e)
+
+    def store_run_cache(self, signature, project_id, output_dir, output):
+        """
+        保存模型运行结果，缓存文件超过 model.cache.max_bytes 时删除最久未使用的缓存文件
+        """
+        path, size = store_outputs(signature, output_dir)
+        self.repository.upsert_run_cache(signature, project_id, path, size, output)
+
+        entries = self.repository.run_cache_list()
+        total = sum(entry.size for entry in entries)
+        for entry in entries:
+            if total <= config['model']['cache']['max_bytes']:
+                break
+            remove_outputs(entry.path)
+            total -= entry.size
+            if entry.project_id is None:
+                self.repository.delete_run_cache(entry)
+            else:
+                self.repository.touch_run_cache(entry, path='', size=0)
+
+    def submit_project(self, req):
+        """
+        提交模型运行任务，在后台创建项目并运行模型
+
+        Returns:
+            int: 任务编号
+        """
+        return job_runner.submit(asdict(req), lambda timer: self.run_project(req, timer))
+
+    def get_job(self, job_id):
+        job_runner.recover()
+        return convert_job_to_json(self.repository.get_job_by_id(job_id))
+
+    def job_list(self, size):
+        job_runner.recover()
+        return [convert_job_to_json(job) for job in self.repository.job_list(size)]
 
     def project_list(self):
+        return response_cache.get_or_set('project_list', {}, TAG_PROJECT, self.query_project_list)
+
+    def query_project_list(self):
         data = self.repository.project_list()
         json_arr = []
         for item in data:
@@ -102,15 +213,118 @@ class AppService:
 
     def update_project(self, req):
         self.repository.update_project(req)
+        response_cache.invalidate(TAG_PROJECT)
 
     def delete_project(self, project_id):
         self.repository.delete_project(project_id)
+        response_cache.invalidate(TAG_PROJECT)
+        tile_cache.invalidate(project_id)
 
-    def handle_map(self, req, date_times=None):
+    def handle_map(self, req, date_times=None, output_dir=None):
         """
         处理网格数据
+
+        Args:
+            req(HandleMapRequest)
+            date_times(list): 各时刻对应的时间，为空时使用文件中的时间
+            output_dir(str): 模型输出目录，为空时使用配置的目录
+        """
+        if output_dir is None:
+            output_dir = config['model']['script']['output']
+        nc_file = search_file(output_dir, '_map.nc')
+        risk_nc_file = search_file(output_dir, 'Modified_FlowFM_clm.nc')
+        ingestion = config['model']['ingestion']
+
+        project = self.repository.get_project_by_id(req.project_id)
+        with MapReader(nc_file, risk_nc_file) as reader:
+            # 网格拓扑只保存一次，所有时刻共用
+            mesh = self.save_mesh(*reader.mesh())
+            times = reader.times()
+        self.repository.update_project_mesh(project, mesh)
+        valid = self.repository.get_mesh_geometry(mesh.id).valid
+        if date_times is not None:
+            times = date_times
+
+        # 筛掉不满足水深条件的网格，按时间顺序逐个时刻替换已有的数据；ingestion.workers 大于 1 时在进程池中生成行
+        timestamps = [to_timestamp(time) for time in times]
+        rows = iter_wet_face_rows(nc_file, risk_nc_file, first_time_index(project.type), req.min_water_depth, valid,
+                                  project.id, timestamps, ingestion['chunk_size'], ingestion['workers'])
+        for timestamp, map_rows in rows:
+            self.repository.replace_map_rows(project, timestamp, map_rows)
+        self.repository.touch_project(project.id)
+        response_cache.invalidate(TAG_PROJECT)
+        tile_cache.invalidate(project.id)
+
+    def save_mesh(self, node_x, node_y, face_nodes):
+        """
+        保存网格拓扑，已存在相同网格时直接复用
+
+        Returns:
+            Mesh
+        """
+        signature = mesh_signature(node_x, node_y, face_nodes)
+        mesh = self.repository.get_mesh_by_signature(signature)
+        if mesh is None:
+            mesh = self.repository.insert_mesh(signature, resolve_faces(node_x, node_y, face_nodes))
+        return mesh
+
+    def convert_legacy_map_data(self, project):
+        """
+        将按行存储坐标的历史网格数据转换为网格拓扑 + 网格序号
+
+        历史数据没有原始的 mesh2d_face_nodes，按坐标去重还原出网格和格点
+
+        Returns:
+            int: 转换的行数
+        """
+        polygons = {}
+        points = {}
+        faces = []
+        rows = []
+        duplicates = []
+        seen = set()
+        for pk, lon, lat, timestamp in self.repository.get_legacy_map_rows(project):
+            key = (tuple(lon), tuple(lat))
+            face = polygons.get(key)
+            if face is None:
+                face = polygons[key] = len(faces)
+                faces.append([points.setdefault(point, len(points)) for point in zip(lon, lat)])
+            if (face, timestamp) in seen:
+                duplicates.append(pk)
+                continue
+            seen.add((face, timestamp))
+            rows.append((pk, face))
+        if not rows:
+            return 0
+
+        coordinates = np.array(list(points.keys()), dtype=np.float64)
+        nodes = np.full((len(faces), max(len(face) for face in faces)), -1, dtype=np.int32)
+        for i, face in enumerate(faces):
+            nodes[i, :len(face)] = face
+        geometry = build_geometry(coordinates[:, 0], coordinates[:, 1], nodes)
+
+        # 历史网格没有原始文件，直接以转换后的拓扑计算摘要
+        signature = mesh_signature(geometry.node_x, geometry.node_y, geometry.nodes)
+        mesh = self.repository.get_mesh_by_signature(signature)
+        if mesh is None:
+            mesh = self.repository.insert_mesh(signature, geometry)
+        if project.mesh_id is not None and project.mesh_id != mesh.id:
+            raise RuntimeError(f'项目方案 {project.id} 已有网格数据，无法转换历史数据')
+        self.repository.update_project_mesh(project, mesh)
+        self.repository.update_map_faces(rows)
+        self.repository.delete_map_data(duplicates)
+        self.repository.rebuild_map_risk_summary(project)
+        self.repository.touch_project(project.id)
+        response_cache.invalidate(TAG_PROJECT)
+        tile_cache.invalidate(project.id)
+        return len(rows)
+
+    def handle_map_legacy(self, req, date_times=None, output_dir=None):
         """
-        output_dir = config['model']['script']['output']
+        逐网格处理网格数据（旧实现），仅作为 handle_map 等价性验证的参考
+        """
+        if output_dir is None:
+            output_dir = config['model']['script']['output']
         nc_file = search_file(output_dir, '_map.nc')
         risk_nc_file = search_file(output_dir, 'Modified_FlowFM_clm.nc')
 
@@ -148,8 +362,8 @@ class AppService:
                         project,
                         [lon[node[0] - 1], lon[node[1] - 1], lon[node[2] - 1]],
                         [lat[node[0] - 1], lat[node[1] - 1], lat[node[2] - 1]],
-                        water_depth[i],
-                        risk[i],
+                        float(water_depth[i]),
+                        int(risk[i]),
                         time
                     )
                 elif len(node) == 4:
@@ -163,105 +377,481 @@ class AppService:
                          lon[node[sorted_nodes[3]] - 1]],
                         [lat[node[sorted_nodes[0]] - 1], lat[node[sorted_nodes[1]] - 1], lat[node[sorted_nodes[2]] - 1],
                          lat[node[sorted_nodes[3]] - 1]],
-                        water_depth[i],
-                        risk[i],
+                        float(water_depth[i]),
+                        int(risk[i]),
                         time
                     )
                 else:
                     continue
 
-    def handle_station(self, req, date_times=None):
+    def handle_station(self, req, date_times=None, output_dir=None):
         """
         处理站点数据
+
+        Args:
+            req(HandleStationRequest)
+            date_times(list): 各时刻对应的时间，为空时使用文件中的时间
+            output_dir(str): 模型输出目录，为空时使用配置的目录
         """
-        output_dir = config['model']['script']['output']
+        if output_dir is None:
+            output_dir = config['model']['script']['output']
         nc_file = search_file(output_dir, '_his.nc')
-        dataset = nc.Dataset(nc_file)
-
-        lon = dataset.variables['station_x_coordinate'][:]
-        lat = dataset.variables['station_y_coordinate'][:]
-        station_names = dataset.variables['station_name'][:]
-        times = dataset.variables['time'][:]
-        if date_times is not None:
-            times = date_times
-        water_depth = dataset.variables['waterdepth'][:]
-        water_level = dataset.variables['waterlevel'][:]
-        velocity_magnitude = dataset.variables['velocity_magnitude'][:]
 
         project = self.repository.get_project_by_id(req.project_id)
-        for i, time in enumerate(times):
-            # 计算好的模型只需要最后1个小时
-            if project.type == 0 and i < 23:
-                continue
-            # 实时计算的模型需要取[24:47]
-            if project.type == 1 and i < 24:
-                continue
-            for j in range(lon.size):
-                station_name = ''.join([name.strip() for name in station_names[j].compressed().astype(str) if name])
-                self.repository.upsert_station(
-                    project, station_name, lon[j], lat[j], water_depth[i, j], water_level[i, j],
-                    velocity_magnitude[i, j], time)
+        with StationReader(nc_file) as reader:
+            station_names, lon, lat = reader.stations()
+            times = reader.times()
+            if date_times is not None:
+                times = date_times
+            start = first_time_index(project.type)
+            stop = min(len(times), reader.time_count)
+            water_depth, water_level, velocity_magnitude = reader.read(start, stop)
+
+        self.repository.bulk_upsert_station(
+            project, station_names, lon, lat, water_depth, water_level, velocity_magnitude, list(times[start:stop]))
+        self.repository.rebuild_station_summary(project)
+        self.repository.touch_project(project.id)
+        response_cache.invalidate(TAG_PROJECT)
+
+    def export_cache_params(self, req):
+        """
+        导出接口的缓存参数：方案、数据版本和查询条件
+
+        写入数据时缓存按分组失效；参数中带上数据版本，其他进程写入数据后也不会读到旧的结果
+        """
+        if req.project_id is None:
+            req.project_id = self.repository.get_latest_project().id
+        version = self.data_version(req.project_id)
+        return dict(asdict(req), version=version[0] if version else None)
 
     def export_map(self, req):
         """
         导出网格数据
         """
+        return response_cache.get_or_set('export_map', self.export_cache_params(req), TAG_PROJECT,
+                                         lambda: self.query_map(req))
+
+    def stream_map(self, req):
+        """
+        导出网格数据，用于流式输出
+
+        Returns:
+            编码后的 {'code': 0, 'data': [...]} 分块，缓存完整输出后的响应体
+        """
+        return response_cache.get_or_stream('stream_map', self.export_cache_params(req), TAG_PROJECT,
+                                            lambda: iter_json_bytes({'code': 0, 'data': self.query_map(req)}))
+
+    def query_map(self, req):
+        """
+        查询网格数据，返回逐行生成的迭代器
+        """
         if req.project_id is None:
             req.project_id = self.repository.get_latest_project().id
         project = self.repository.get_project_by_id(req.project_id)
 
         times = self.repository.get_map_times(project)
-        data = self.repository.get_map_by_project_and_timestamp(project, times[0]['timestamp'])
-        return convert_map_data_to_json(data)
+        geometry = self.repository.get_mesh_geometry(project.mesh_id)
+        if req.lod:
+            level = geometry.level(req.lod)
+            columns = self.repository.get_map_columns(project, times[0]['timestamp'], parse_bbox(req.bbox))
+            return iter_map_data_json(iter_map_columns(aggregate_map_columns(level, columns)), level.geometry)
+        data = self.repository.iter_map_by_project_and_timestamp(project, times[0]['timestamp'], parse_bbox(req.bbox))
+        return iter_map_data_json(data, geometry)
 
     def export_history_map(self, req):
         if req.project_id is None:
             req.project_id = self.repository.get_latest_project().id
         project = Project.objects.get(pk=req.project_id)
-        return self.repository.get_history_map(project)
+        bbox = parse_bbox(req.bbox)
+        if req.lod:
+            data = self.history_map_level(project, bbox, req.lod, req.format == 'indexed')
+            return {'geometry': data['geometry'](), 'times': list(data['times'])} if req.format == 'indexed' else list(data)
+        if req.format == 'indexed':
+            return self.repository.get_history_map_indexed(project, bbox)
+        return self.repository.get_history_map(project, bbox)
+
+    def stream_history_map(self, req):
+        """
+        导出网格时段数据，逐个时刻生成，用于流式输出
+        """
+        if req.project_id is None:
+            req.project_id = self.repository.get_latest_project().id
+        project = Project.objects.get(pk=req.project_id)
+        # 在开始输出前检查网格，出错时仍然可以返回错误信息
+        self.repository.get_mesh_geometry(project.mesh_id)
+        bbox = parse_bbox(req.bbox)
+        if req.lod:
+            return self.history_map_level(project, bbox, req.lod, req.format == 'indexed')
+        if req.format == 'indexed':
+            return self.repository.iter_history_map_indexed(project, bbox)
+        return self.repository.iter_history_map(project, bbox)
+
+    def history_map_level(self, project, bbox, lod, indexed=False):
+        """
+        按细节层级导出网格时段数据，每个时刻的网格合并为格子，格式与原始网格相同，id 和网格序号为格子序号
+
+        Returns:
+            indexed 为 False 时返回逐个时刻的迭代器，否则返回 {'times': 迭代器, 'geometry': 函数}
+        """
+        level = self.repository.get_mesh_geometry(project.mesh_id).level(lod)
+        columns = aggregate_map_columns(level, self.repository.get_map_columns(project, bbox=bbox))
+        rows_by_time = groupby(iter_map_columns(columns), key=itemgetter(4))
+        if not indexed:
+            return ({'time': timestamp_to_datetime(timestamp), 'data': convert_map_data_to_json(rows, level.geometry)}
+                    for timestamp, rows in rows_by_time)
+
+        def iter_times():
+            for timestamp, rows in rows_by_time:
+                _, faces, water_depths, risks, _ = zip(*rows)
+                yield {
+                    'time': timestamp_to_datetime(timestamp),
+                    'faces': list(faces),
+                    'waterDepth': [float(water_depth) for water_depth in water_depths],
+                    'risk': list(risks),
+                }
+
+        def used_geometry():
+            faces = np.unique(columns['face']).tolist()
+            return {'faces': faces, 'coordinates': [level.geometry.lat_lon(face) for face in faces]}
+
+        return {'times': iter_times(), 'geometry': used_geometry}
 
     def export_station(self, req):
         """
         导出站点数据
         """
+        return response_cache.get_or_set('export_station', self.export_cache_params(req), TAG_PROJECT,
+                                         lambda: self.query_station(req))
+
+    def stream_station(self, req):
+        """
+        导出站点数据，用于流式输出
+
+        Returns:
+            编码后的 {'code': 0, 'data': [...]} 分块，缓存完整输出后的响应体
+        """
+        return response_cache.get_or_stream('stream_station', self.export_cache_params(req), TAG_PROJECT,
+                                            lambda: iter_json_bytes({'code': 0, 'data': self.query_station(req)}))
+
+    def query_station(self, req):
+        """
+        查询站点数据，返回逐行生成的迭代器
+        """
         if req.project_id is None:
             req.project_id = self.repository.get_latest_project().id
         project = Project.objects.get(pk=req.project_id)
 
         times = self.repository.get_station_times(project)
-        data = self.repository.get_station_by_project_and_timestamp(project, times[0]['timestamp'])
-        return convert_station_data_to_json(data)
+        data = self.repository.iter_station_by_project_and_timestamp(project, times[0]['timestamp'])
+        return iter_station_data_json(data)
+
+    def export_map_columns(self, req):
+        """
+        按列导出网格数据，用于二进制格式
+
+        Returns:
+            tuple: ({列名: ndarray}, 元数据)
+        """
+        return response_cache.get_or_set('export_map_columns', self.export_cache_params(req), TAG_PROJECT,
+                                         lambda: self.query_map_columns(req))
+
+    def query_map_columns(self, req):
+        project = self.repository.get_project_by_id(req.project_id)
+
+        times = self.repository.get_map_times(project)
+        columns = self.repository.get_map_columns(project, times[0]['timestamp'], parse_bbox(req.bbox))
+        if req.lod:
+            level = self.repository.get_mesh_geometry(project.mesh_id).level(req.lod)
+            return aggregate_map_columns(level, columns), dict(column_meta(project), lod=req.lod)
+        return columns, column_meta(project)
+
+    def export_history_map_columns(self, req):
+        """
+        按列导出网格时段数据，按时间倒序排列
+        """
+        if req.project_id is None:
+            req.project_id = self.repository.get_latest_project().id
+        project = Project.objects.get(pk=req.project_id)
+        columns = self.repository.get_map_columns(project, bbox=parse_bbox(req.bbox))
+        if req.lod:
+            level = self.repository.get_mesh_geometry(project.mesh_id).level(req.lod)
+            return aggregate_map_columns(level, columns), dict(column_meta(project), lod=req.lod)
+        return columns, column_meta(project)
+
+    def export_station_columns(self, req):
+        """
+        按列导出站点数据，station 列为 stations 中的序号
+        """
+        return response_cache.get_or_set('export_station_columns', self.export_cache_params(req), TAG_PROJECT,
+                                         lambda: self.query_station_columns(req))
+
+    def query_station_columns(self, req):
+        project = Project.objects.get(pk=req.project_id)
+
+        times = self.repository.get_station_times(project)
+        stations, columns = self.repository.get_station_columns(project, times[0]['timestamp'])
+        return columns, dict(column_meta(project), stations=stations)
+
+    def map_tile(self, project_id, time, z, x, y):
+        """
+        网格数据的矢量切片，切片缓存在磁盘上，方案数据变化后失效
+
+        Args:
+            project_id(int): 方案编号
+            time(str): 时刻，2001-01-01 起的秒数或 2021-07-30 00:00:00 格式的时间
+            z, x, y: 切片
+
+        Returns:
+            bytes: Mapbox 矢量切片，图层 flood，属性 waterDepth、risk
+        """
+        check_tile(z, x, y)
+        timestamp = int(time) if time.isdigit() else datetime_to_timestamp(time)
+        version = self.data_version(project_id)
+        if version is None:
+            raise ValueError(f'项目方案 {project_id} 不存在')
+        return tile_cache.get_or_set(project_id, version[0], f'{timestamp}/{z}/{x}/{y}',
+                                     lambda: self.render_map_tile(project_id, timestamp, z, x, y))
+
+    def render_map_tile(self, project_id, timestamp, z, x, y):
+        """
+        通过 R*Tree 索引查询与切片相交的网格，编码为矢量切片
+        """
+        project = self.repository.get_project_by_id(project_id)
+        geometry = self.repository.get_mesh_geometry(project.mesh_id)
+        # 缩放级别较小时网格小于像素，合并为格子后输出
+        level = geometry.level(tile_lod(geometry, z))
+        columns = aggregate_map_columns(level, self.repository.get_map_columns(project, timestamp, tile_bounds(z, x, y)))
+        return encode_tile(level.geometry, columns['face'], columns['waterDepth'], columns['risk'], z, x, y)
+
+    def export_mesh(self, project_id, lod=None):
+        """
+        导出方案的网格，face 列对应 faceNodes 的行；lod 不为空时导出该细节层级的格子
+
+        Returns:
+            tuple: ({'nodeX': [M], 'nodeY': [M], 'faceNodes': [N*K]}, 元数据)，faceNodes 从0开始，缺省为-1
+        """
+        project = self.repository.get_project_by_id(project_id)
+        geometry = self.repository.get_mesh_geometry(project.mesh_id)
+        meta = column_meta(project)
+        if lod:
+            geometry = geometry.level(lod).geometry
+            meta['lod'] = lod
+        columns = {
+            'nodeX': geometry.node_x,
+            'nodeY': geometry.node_y,
+            'faceNodes': geometry.nodes.astype(np.int32),
+        }
+        return columns, meta
+
+    def data_version(self, project_id=None):
+        """
+        方案数据的版本，用于 ETag 和 Last-Modified
+
+        Args:
+            project_id(int): 方案编号，为空时使用最新的方案
+
+        Returns:
+            tuple: (版本号, 最后修改时间)，方案不存在时返回 None
+        """
+        version = self.repository.get_data_version(project_id)
+        if version is None:
+            return None
+        token = '{}-{}-{}-{}'.format(version['project_id'], version['map_id'] or 0, version['station_id'] or 0,
+                                     int(version['updated_at'].timestamp() * 1000000))
+        return token, version['updated_at']
 
     def project_pagination(self, page, size):
         return self.repository.project_pagination(page, size)
 
     def forewarning_pagination(self, page, size):
         project = self.repository.get_latest_project()
+        geometry = self.repository.get_mesh_geometry(project.mesh_id)
         data = self.repository.forewarning_pagination(project, page, size)
-        json_array = []
-        for elem in data['items']:
-            json_data = {
-                'id': elem[0],
-                'coordinates': [[y, x] for x, y in zip(elem[1], elem[2])],
-                'waterDepth': elem[3],
-                'riskLevel': elem[4],
-                'warningLevel': WARNING_RISK_DICT[elem[4]],
-                'time': timestamp_to_datetime(elem[5]),
-                'createdAt': elem[6].strftime('%Y-%m-%d %H:%M:%S'),
-            }
-            json_array.append(json_data)
-
         return {
-            'items': json_array,
+            'items': [convert_forewarning_to_json(elem, geometry) for elem in data['items']],
             'page': data['page'],
             'size': data['size'],
             'total': data['total'],
         }
 
+    def forewarning_cursor(self, size, cursor=None, total=True, order='id', min_risk=None, min_water_depth=None):
+        """
+        按游标分页查询实时预警数据，耗时与页码无关
+
+        Args:
+            size(int): 每页条数
+            cursor(str): 上一页返回的 next，为空时查询第一页；游标中保存了排序和筛选条件
+            total(bool): 是否返回总数，总数缓存到数据变化为止
+            order(str): id: 按 id 倒序；severity: 按风险等级、水深倒序
+            min_risk(int): 最小风险等级
+            min_water_depth(float): 最小水深
+
+        Returns:
+            dict: {'items', 'size', 'next': 下一页的游标，没有下一页时为 None, 'total'}
+        """
+        if size <= 0:
+            raise ValueError('每页条数必须大于0')
+        if cursor:
+            state = decode_cursor(cursor, {'project': int, 'minRisk': int, 'minWaterDepth': float, 'id': int,
+                                           'before': severity_key})
+            project = self.repository.get_project_by_id(state.get('project'))
+        else:
+            state = {'order': order, 'minRisk': min_risk, 'minWaterDepth': min_water_depth}
+            project = self.repository.get_latest_project()
+        order, min_risk, min_water_depth = state.get('order', 'id'), state.get('minRisk'), state.get('minWaterDepth')
+        geometry = self.repository.get_mesh_geometry(project.mesh_id)
+
+        if order == 'severity':
+            before = state.get('before')
+            rows = self.repository.forewarning_severity(project, before, size, min_risk, min_water_depth)
+        elif order == 'id':
+            rows = self.repository.forewarning_keyset(project, state.get('id'), size, min_risk, min_water_depth)
+        else:
+            raise ValueError(f'不支持的排序方式：{order}')
+        items = rows[:size]
+
+        next_cursor = None
+        if len(rows) > size:
+            last = items[-1]
+            next_state = {'project': project.id, 'order': order, 'minRisk': min_risk, 'minWaterDepth': min_water_depth}
+            if order == 'severity':
+                next_state['before'] = [last[3], str(last[2]), last[0]]
+            else:
+                next_state['id'] = last[0]
+            next_cursor = encode_cursor(next_state)
+        data = {
+            'items': [convert_forewarning_to_json(elem, geometry) for elem in items],
+            'size': size,
+            'next': next_cursor,
+        }
+        if total:
+            data['total'] = response_cache.get_or_set(
+                'forewarning_total', {'project_id': project.id, 'min_risk': min_risk, 'min_water_depth': min_water_depth},
+                TAG_PROJECT, lambda: self.repository.count_map_data(project, min_risk, min_water_depth))
+        return data
+
+    def map_risk_summary(self, project_id=None, min_risk=None):
+        """
+        每个时刻各风险等级的网格数，读取处理网格数据时生成的统计表，与网格数量无关
+
+        Returns:
+            list: [{'time': 时间, 'counts': {风险等级: 网格数}, 'total': 网格数}]，按时间排序
+        """
+        if project_id is None:
+            project_id = self.repository.get_latest_project().id
+        project = self.repository.get_project_by_id(project_id)
+        return response_cache.get_or_set('map_risk_summary', {'project_id': project.id, 'min_risk': min_risk},
+                                         TAG_PROJECT, lambda: self.query_map_risk_summary(project, min_risk))
+
+    def query_map_risk_summary(self, project, min_risk=None):
+        self.ensure_map_risk_summary(project)
+
+        json_arr = []
+        for timestamp, rows in groupby(self.repository.get_map_risk_summary(project, min_risk), key=itemgetter(0)):
+            counts = {risk: count for _, risk, count in rows}
+            json_arr.append({
+                'time': timestamp_to_datetime(timestamp),
+                'counts': counts,
+                'total': sum(counts.values()),
+            })
+        return json_arr
+
+    def ensure_map_risk_summary(self, project):
+        """
+        统计表生成之前处理的方案，第一次查询时补充统计
+        """
+        if not self.repository.has_map_risk_summary(project) and self.repository.has_map_data(project):
+            self.repository.rebuild_map_risk_summary(project)
+
+    def map_point(self, req):
+        """
+        查询任意位置所在网格所有时刻的水深和风险等级
+
+        Args:
+            req(MapPointRequest)
+
+        Returns:
+            dict: {'face': 网格序号, 'coordinates': [[纬度, 经度], ...],
+                   'times': [{'time': 时间, 'waterDepth': 水深, 'risk': 风险等级}]}，
+                   水深低于处理网格数据时 min_water_depth 的时刻水深和风险等级为0
+        """
+        if req.project_id is None:
+            req.project_id = self.repository.get_latest_project().id
+        project = self.repository.get_project_by_id(req.project_id)
+        geometry = self.repository.get_mesh_geometry(project.mesh_id)
+        face = geometry.locate(req.lon, req.lat)
+        if face < 0:
+            raise ValueError(f'位置({req.lon}, {req.lat})不在网格范围内')
+
+        self.ensure_map_risk_summary(project)
+        series = {timestamp: (water_depth, risk)
+                  for timestamp, water_depth, risk in self.repository.get_map_face_series(project, face)}
+        times = []
+        for timestamp in self.repository.get_map_timestamps(project):
+            water_depth, risk = series.get(timestamp, (0, 0))
+            times.append({'time': timestamp_to_datetime(timestamp), 'waterDepth': float(water_depth), 'risk': risk})
+        lon, lat = geometry.coordinates(face)
+        return {'face': face, 'coordinates': [[y, x] for x, y in zip(lon, lat)], 'times': times}
+
+    def map_extent(self, req):
+        """
+        某一时刻的淹没范围，相邻且风险等级相同的网格合并为多边形，按方案和时刻缓存
+
+        Args:
+            req(MapExtentRequest)
+
+        Returns:
+            dict: GeoJSON FeatureCollection，每个风险等级一个 MultiPolygon 要素，
+                  属性 risk(风险等级)、faces(网格数)、time(时间)，坐标为 [经度, 纬度]
+        """
+        if req.project_id is None:
+            req.project_id = self.repository.get_latest_project().id
+        project = self.repository.get_project_by_id(req.project_id)
+        if req.time is None:
+            timestamp = self.repository.get_map_times(project)[0]['timestamp']
+        else:
+            time = str(req.time)
+            timestamp = int(time) if time.isdigit() else datetime_to_timestamp(time)
+        params = {'project_id': project.id, 'timestamp': timestamp, 'min_risk': req.min_risk}
+        return response_cache.get_or_set('map_extent', params, TAG_PROJECT,
+                                         lambda: self.query_map_extent(project, timestamp, req.min_risk))
+
+    def query_map_extent(self, project, timestamp, min_risk=None):
+        geometry = self.repository.get_mesh_geometry(project.mesh_id)
+        columns = self.repository.get_map_columns(project, timestamp)
+        return extent_feature_collection(geometry, columns['face'], columns['risk'], min_risk,
+                                         {'time': timestamp_to_datetime(timestamp)})
+
+    def project_cursor(self, size, cursor=None, total=True):
+        """
+        按游标分页查询方案信息，参数和返回值同 forewarning_cursor
+        """
+        if size <= 0:
+            raise ValueError('每页条数必须大于0')
+        before_id = decode_cursor(cursor, {'id': int}).get('id') if cursor else None
+        rows = self.repository.project_keyset(before_id, size)
+        items = rows[:size]
+        data = {
+            'items': items,
+            'size': size,
+            'next': encode_cursor({'id': items[-1][0]}) if len(rows) > size else None,
+        }
+        if total:
+            data['total'] = response_cache.get_or_set('project_total', {}, TAG_PROJECT, self.repository.count_projects)
+        return data
+
     def representation_station(self, req):
+        return response_cache.get_or_set('representation_station', {'project_id': req.project_id}, TAG_PROJECT,
+                                         lambda: self.query_representation_station(req))
+
+    def query_representation_station(self, req):
         if req.project_id is None:
             req.project_id = self.repository.get_latest_project().id
-        data = self.repository.representation_station(req.project_id)
+        project = self.repository.get_project_by_id(req.project_id)
+        # 统计表在处理站点数据时生成，之前导入的方案在第一次查询时生成
+        if not self.repository.has_station_summary(project) and self.repository.has_station_data(project):
+            self.repository.rebuild_station_summary(project)
+        data = self.repository.representation_station(project.id)
 
         json_arr = []
         for elem in data:
@@ -275,8 +865,39 @@ class AppService:
             json_arr.append(json_data)
         return json_arr
 
-    def trend_station(self, name):
-        data = self.repository.trend_station(name)
+    def trend_station(self, name, req=None):
+        project_id = self.station_project_id(req.project_id if req is not None else None)
+        if project_id is None:
+            return []
+        return response_cache.get_or_set('trend_station', {'name': name, 'project_id': project_id}, TAG_PROJECT,
+                                         lambda: self.query_trend_station(name, project_id))
+
+    def station_project_id(self, project_id=None):
+        """
+        站点趋势查询的方案，查询、接口缓存和 ETag 使用同一个方案
+
+        Args:
+            project_id(int): 方案编号，为空时使用最近写入站点数据的方案
+
+        Returns:
+            int: 方案编号，没有站点数据时返回 None
+        """
+        if project_id is None:
+            return self.repository.get_latest_station_project_id()
+        return project_id
+
+    def query_trend_station(self, name, project_id=None):
+        """
+        查询站点所有时刻的数据
+
+        Args:
+            name(str): 站点名称
+            project_id(int): 方案编号，为空时使用最近写入站点数据的方案
+        """
+        project_id = self.station_project_id(project_id)
+        if project_id is None:
+            return []
+        data = self.repository.trend_station(project_id, name)
 
         json_arr = []
         for elem in data:
@@ -292,6 +913,10 @@ class AppService:
         return json_arr
 
     def latest_water_information(self, start_time=None):
+        return response_cache.get_or_set('latest_water_information', {'start_time': start_time}, TAG_WATER,
+                                         lambda: self.query_latest_water_information(start_time))
+
+    def query_latest_water_information(self, start_time=None):
         rainfall = self.repository.get_latest_rainfall(start_time)
         upstream_water_level = self.repository.get_latest_upstream_water_level(start_time)
         downstream_water_level = self.repository.get_latest_downstream_water_level(start_time)
@@ -320,14 +945,112 @@ class AppService:
         project_arr = [2, 3, 4, 5, 6]
         for i, column in enumerate(data.iloc[:, 1:].values.T):  # .values.T 将 DataFrame 转置，便于逐列遍历
             project = self.repository.get_project_by_id(project_arr[i])
-            for elem in column:
-                self.repository.upsert_rainfall_series(project, elem)
+            self.repository.bulk_upsert_rainfall_series(project, column.tolist())
 
     def get_rainfall_series(self, project_id):
         project = self.repository.get_project_by_id(project_id)
         return self.repository.get_rainfall_series(project)
 
 
+class NoTimer:
+    """
+    同步运行模型时使用，不记录任务状态
+    """
+
+    def __call__(self, name):
+        return nullcontext()
+
+    def set_project(self, project_id):
+        pass
+
+
+no_timer = NoTimer()
+
+
+def convert_job_to_json(job):
+    return {
+        'id': job.id,
+        'status': job.status,
+        'stage': job.stage,
+        'stages': job.stages,
+        'projectId': job.project_id,
+        'error': job.error,
+        'createdAt': job.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'startedAt': job.started_at.strftime('%Y-%m-%d %H:%M:%S') if job.started_at else None,
+        'finishedAt': job.finished_at.strftime('%Y-%m-%d %H:%M:%S') if job.finished_at else None,
+    }
+
+
+# 模型时间的起点，timestamp 为相对该时间的秒数
+TIMESTAMP_EPOCH = '2001-01-01 00:00:00'
+
+
+def convert_forewarning_to_json(elem, geometry):
+    return {
+        'id': elem[0],
+        'coordinates': geometry.lat_lon(elem[1]),
+        'waterDepth': elem[2],
+        'riskLevel': elem[3],
+        'warningLevel': WARNING_RISK_DICT[elem[3]],
+        'time': timestamp_to_datetime(elem[4]),
+        'createdAt': elem[5].strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def severity_key(value):
+    """
+    预警游标中上一页最后一行的 (风险等级, 水深, id)
+    """
+    if not isinstance(value, list) or len(value) != 3:
+        raise ValueError(f'无效的排序键：{value}')
+    risk, water_depth, pk = value
+    # 水深保留原始的字符串，只检查能否转换
+    float(water_depth)
+    return [int(risk), water_depth, int(pk)]
+
+
+def aggregate_map_columns(level, columns):
+    """
+    按时刻把网格数据合并到细节层级的格子，取最大水深和最大风险等级
+
+    Args:
+        level(MeshLevel): 细节层级
+        columns(dict): get_map_columns 的结果，按时间倒序
+
+    Returns:
+        dict: 与 columns 的列相同，face 为格子序号
+    """
+    if level.lod == 0:
+        return columns
+    timestamps = columns['timestamp']
+    starts = np.flatnonzero(np.r_[True, timestamps[1:] != timestamps[:-1]]) if len(timestamps) else np.empty(0, int)
+    parts = []
+    for start, stop in zip(starts, np.r_[starts[1:], len(timestamps)]):
+        cells, water_depth, risk = level.aggregate(
+            columns['face'][start:stop], columns['waterDepth'][start:stop], columns['risk'][start:stop])
+        parts.append((cells, water_depth, risk, np.full(len(cells), timestamps[start])))
+    return {
+        name: np.concatenate([part[i] for part in parts]).astype(dtype) if parts else np.empty(0, dtype)
+        for i, (name, dtype) in enumerate(MAP_COLUMNS)
+    }
+
+
+def iter_map_columns(columns):
+    """
+    把列式网格数据转换为 (id, face_index, water_depth, risk, timestamp) 的行，id 为网格序号
+    """
+    names = ('face', 'waterDepth', 'risk', 'timestamp')
+    for face, water_depth, risk, timestamp in zip(*(columns[name].tolist() for name in names)):
+        yield face, face, Decimal(f'{water_depth:.2f}'), risk, timestamp
+
+
+def column_meta(project):
+    """
+    列式数据的元数据
+    """
+    return {'projectId': project.id, 'meshId': project.mesh_id, 'epoch': TIMESTAMP_EPOCH}
+
+
 WARNING_RISK_DICT = {
     1: "较低风险",
     2: "中等风险",
@@ -336,7 +1059,7 @@ WARNING_RISK_DICT = {
 }
 
 
-def write_downstream_water_level(downstream_water_level):
+def write_downstream_water_level(downstream_water_level, input_dir=None):
     data_str = ""
     times = [
         649296000, 649299600, 649303200, 649306800, 649310400, 649314000, 649317600, 649321200, 649324800,
@@ -368,7 +1091,8 @@ Quantity                        = waterlevelbnd
 Unit                            = m
 {data_str}"""
 
-    input_dir = config['model']['script']['input']
+    if input_dir is None:
+        input_dir = config['model']['script']['input']
     path = os.path.join(input_dir, "WaterLevel.bc")
     if os.path.exists(path):
         os.remove(path)
@@ -377,7 +1101,7 @@ Unit                            = m
         file.write(content)
 
 
-def write_upstream_water_level(upstream_water_level):
+def write_upstream_water_level(upstream_water_level, input_dir=None):
     data_str = ""
     times = [
         649296000, 649299600, 649303200, 649306800, 649310400, 649314000, 649317600, 649321200, 649324800,
@@ -409,7 +1133,8 @@ Quantity                        = dischargebnd
 Unit                            = m3/s
 {data_str}"""
 
-    input_dir = config['model']['script']['input']
+    if input_dir is None:
+        input_dir = config['model']['script']['input']
     path = os.path.join(input_dir, "Discharge.bc")
     if os.path.exists(path):
         os.remove(path)
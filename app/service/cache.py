@@ -0,0 +1,382 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from collections.abc import Iterator
+
+from hydrologic_forecasting.settings import config
+
+# 缓存的分组，写入数据后按分组失效
+TAG_PROJECT = 'project'
+TAG_WATER = 'water'
+
+MISSING = object()
+
+
+def cache_key(endpoint, params):
+    """
+    由接口名称和参数生成缓存键
+
+    Returns:
+        str: sha256
+    """
+    text = json.dumps([endpoint, params], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class MemoryCache:
+    """
+    进程内的 LRU 缓存，保存 pickle 后的结果，占用空间即为其长度；读取时反序列化，调用方修改结果不影响缓存
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        # 每个分组失效的次数，生成结果期间分组失效时不保存结果
+        self.generations = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def get(self, tag, key):
+        with self.lock:
+            entry = self.entries.get((tag, key))
+            if entry is None:
+                return MISSING
+            created_at, size, content = entry
+            if self.ttl and time.time() - created_at > self.ttl:
+                self.remove((tag, key))
+                return MISSING
+            self.entries.move_to_end((tag, key))
+        return pickle.loads(content)
+
+    def generation(self, tag):
+        with self.lock:
+            return self.generations[tag]
+
+    def set(self, tag, key, value, generation):
+        content = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        size = len(content)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if generation != self.generations[tag]:
+                return
+            self.remove((tag, key))
+            self.entries[(tag, key)] = (time.time(), size, content)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, item):
+        entry = self.entries.pop(item, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def invalidate(self, tag):
+        with self.lock:
+            self.generations[tag] += 1
+            for item in [item for item in self.entries if item[0] == tag]:
+                self.remove(item)
+
+
+class FileCache:
+    """
+    文件缓存，多个进程可以共用；每个分组一个目录，按文件修改时间淘汰最久未使用的缓存
+
+    每个分组的版本保存在 root/分组.generation 中，失效时写入新的版本，其他进程生成结果期间分组失效时不保存结果
+    """
+
+    def __init__(self, root, max_bytes, ttl):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+    def path(self, tag, key):
+        return os.path.join(self.root, tag, f'{key}.pkl')
+
+    def generation_path(self, tag):
+        return os.path.join(self.root, f'{tag}.generation')
+
+    def generation(self, tag):
+        try:
+            with open(self.generation_path(tag), 'r') as file:
+                return file.read()
+        except FileNotFoundError:
+            return ''
+
+    def get(self, tag, key):
+        path = self.path(tag, key)
+        try:
+            with open(path, 'rb') as file:
+                created_at, value = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return MISSING
+        if self.ttl and time.time() - created_at > self.ttl:
+            self.remove(path)
+            return MISSING
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def set(self, tag, key, value, generation):
+        content = pickle.dumps((time.time(), value), protocol=pickle.HIGHEST_PROTOCOL)
+        if len(content) > self.max_bytes or generation != self.generation(tag):
+            return
+        directory = os.path.join(self.root, tag)
+        os.makedirs(directory, exist_ok=True)
+        # 先写临时文件再替换，其他进程不会读到不完整的文件
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(content)
+        path = self.path(tag, key)
+        os.replace(temp_path, path)
+        # 写入期间其他进程使分组失效时删除刚写入的结果；失效时先写版本再删除目录，两种顺序都不会留下旧结果
+        if generation != self.generation(tag):
+            self.remove(path)
+            return
+        self.evict()
+
+    def evict(self):
+        files = []
+        for current, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith('.pkl'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(current, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(current, name)))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, tag):
+        os.makedirs(self.root, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            file.write(uuid.uuid4().hex)
+        os.replace(temp_path, self.generation_path(tag))
+        shutil.rmtree(os.path.join(self.root, tag), ignore_errors=True)
+
+
+class ResponseCache:
+    """
+    查询接口的结果缓存，按接口名称和参数缓存，写入数据后按分组失效
+
+    Example:
+        response_cache.get_or_set('project_list', {}, TAG_PROJECT, repository.project_list)
+        response_cache.invalidate(TAG_PROJECT)
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_or_set(self, endpoint, params, tag, build):
+        """
+        读取缓存，不存在时调用 build 生成并保存
+
+        Args:
+            endpoint(str): 接口名称
+            params(dict): 接口参数
+            tag(str): 分组
+            build(callable): 生成结果，返回迭代器时转换为列表后缓存
+
+        Returns:
+            缓存的结果，未启用缓存时直接返回 build() 的结果
+        """
+        if self.backend is None:
+            return build()
+        key = cache_key(endpoint, params)
+        value = self.backend.get(tag, key)
+        if value is MISSING:
+            # 生成结果期间分组失效(包括其他进程)时不保存结果
+            generation = self.backend.generation(tag)
+            value = build()
+            if isinstance(value, Iterator):
+                value = list(value)
+            try:
+                self.backend.set(tag, key, value, generation)
+            except Exception as e:
+                logging.warning("保存接口缓存失败：%s", e)
+        return value
+
+    def get_or_stream(self, endpoint, params, tag, build):
+        """
+        读取缓存的响应体，不存在时调用 build 生成分块，边输出边保存，完整输出后缓存
+
+        Args:
+            endpoint(str): 接口名称
+            params(dict): 接口参数
+            tag(str): 分组
+            build(callable): 返回 bytes 分块的迭代器，在返回前完成查询，出错时直接抛出异常
+
+        Returns:
+            bytes 分块的迭代器
+        """
+        if self.backend is None:
+            return build()
+        key = cache_key(endpoint, params)
+        value = self.backend.get(tag, key)
+        if value is not MISSING:
+            return iter([value])
+        generation = self.backend.generation(tag)
+        return self.tee(tag, key, build(), generation)
+
+    def tee(self, tag, key, chunks, generation):
+        """
+        输出分块的同时保存，输出中断或超过最大占用空间时不保存
+        """
+        buffer = []
+        length = 0
+        for chunk in chunks:
+            if buffer is not None:
+                buffer.append(chunk)
+                length += len(chunk)
+                if length > self.backend.max_bytes:
+                    buffer = None
+            yield chunk
+        if buffer is None:
+            return
+        try:
+            self.backend.set(tag, key, b''.join(buffer), generation)
+        except Exception as e:
+            logging.warning("保存接口缓存失败：%s", e)
+
+    def invalidate(self, *tags):
+        if self.backend is None:
+            return
+        for tag in tags:
+            self.backend.invalidate(tag)
+
+
+class TileCache:
+    """
+    矢量切片的磁盘缓存，路径为 root/方案编号/数据版本/键.mvt
+
+    方案数据变化后数据版本不同，不会读到旧的切片；重新处理方案时删除该方案的所有切片
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        # 距离上次淘汰写入的字节数，超过最大占用空间的 1/16 时淘汰一次，避免每次写入都遍历目录
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def path(self, project_id, version, key):
+        return os.path.join(self.root, str(project_id), version, f'{key}.mvt')
+
+    def get_or_set(self, project_id, version, key, build):
+        """
+        读取切片，不存在时调用 build 生成并保存
+
+        Args:
+            project_id(int): 方案编号
+            version(str): 方案数据版本
+            key(str): 切片，如 649382400/12/3410/1653
+            build(callable): 生成切片，返回 bytes
+        """
+        if not self.max_bytes:
+            return build()
+        path = self.path(project_id, version, key)
+        try:
+            with open(path, 'rb') as file:
+                content = file.read()
+            os.utime(path)
+            return content
+        except FileNotFoundError:
+            pass
+
+        content = build()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                file.write(content)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning("保存矢量切片失败：%s", e)
+            return content
+        with self.lock:
+            self.written += len(content)
+            evict = self.written > self.max_bytes // 16
+            if evict:
+                self.written = 0
+        if evict:
+            self.evict()
+        return content
+
+    def evict(self):
+        files = []
+        for current, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith('.mvt'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(current, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(current, name)))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            FileCache.remove(path)
+            total -= size
+
+    def invalidate(self, project_id):
+        shutil.rmtree(os.path.join(self.root, str(project_id)), ignore_errors=True)
+
+
+def create_tile_cache(settings):
+    """
+    根据配置 response.tiles 创建矢量切片缓存
+
+    Args:
+        settings(dict): {'root': 缓存目录, 'max_bytes': 最大占用空间}
+    """
+    root = settings['root'] or os.path.join(tempfile.gettempdir(), 'hydrologic_forecasting_tiles')
+    return TileCache(root, settings['max_bytes'])
+
+
+def create_cache(settings):
+    """
+    根据配置 response.cache 创建缓存
+
+    Args:
+        settings(dict): {'backend': memory/file/none, 'root': 文件缓存目录, 'max_bytes': 最大占用空间, 'ttl': 有效期(秒)}
+    """
+    backend = settings['backend']
+    if backend == 'memory':
+        return ResponseCache(MemoryCache(settings['max_bytes'], settings['ttl']))
+    if backend == 'file':
+        root = settings['root'] or os.path.join(tempfile.gettempdir(), 'hydrologic_forecasting_cache')
+        return ResponseCache(FileCache(root, settings['max_bytes'], settings['ttl']))
+    if backend == 'none':
+        return ResponseCache(None)
+    raise ValueError(f'不支持的接口缓存：{backend}')
+
+
+response_cache = create_cache(config['response']['cache'])
+tile_cache = create_tile_cache(config['response']['tiles'])
@@ -0,0 +1,236 @@
+import math
+from collections import defaultdict
+from itertools import chain
+
+import numpy as np
+
+# 输出坐标保留的小数位数，约 0.1 米
+EXTENT_PRECISION = 6
+
+
+def dissolve(geometry, faces):
+    """
+    合并相邻网格为多边形：共用同一条边(两个顶点)的网格视为相邻，只在一个网格中出现的边为边界，
+    边界首尾相连得到环，逆时针的环为外环，顺时针的环为内环(洞)
+
+    Args:
+        geometry(FaceGeometry): 网格几何数据
+        faces(ndarray): 需要合并的网格序号
+
+    Returns:
+        list: [[外环, 内环, ...]]，每个环为 [[经度, 纬度], ...]，首尾相同
+    """
+    faces = np.asarray(faces)
+    faces = faces[geometry.counts[faces] >= 3]
+    if len(faces) == 0:
+        return []
+    start, end = boundary_edges(geometry, faces)
+    rings = chain_rings(geometry, start, end)
+    if not rings:
+        return []
+    rings, areas = ring_coordinates(geometry, rings)
+
+    exteriors, holes = [], []
+    for ring, area in zip(rings, areas.tolist()):
+        if area > 0:
+            exteriors.append((area, ring))
+        elif area < 0:
+            holes.append(ring)
+    # 面积小的外环在前，洞属于包含它的最小外环
+    exteriors.sort(key=lambda item: item[0])
+    exteriors = [ring for _, ring in exteriors]
+    polygons = [[ring] for ring in exteriors]
+    if holes:
+        bounds = np.array([(ring[:, 0].min(), ring[:, 0].max(), ring[:, 1].min(), ring[:, 1].max())
+                           for ring in exteriors]).reshape(-1, 4)
+        for hole in holes:
+            # 内环可能与外环在格点处相接，但不会共用边，用第一条边的中点判断
+            x, y = (hole[0] + hole[1]) / 2
+            candidates = np.flatnonzero((bounds[:, 0] <= x) & (x <= bounds[:, 1])
+                                        & (bounds[:, 2] <= y) & (y <= bounds[:, 3]))
+            for i in candidates.tolist():
+                if ring_contains(exteriors[i], x, y):
+                    polygons[i].append(hole)
+                    break
+    return [[close_ring(ring) for ring in polygon] for polygon in polygons]
+
+
+def boundary_edges(geometry, faces):
+    """
+    网格的边界边，网格顶点统一为逆时针后，边界边的方向使合并后的区域在左侧
+
+    Returns:
+        tuple: (起点, 终点)，格点序号数组
+    """
+    node = geometry.nodes[faces]
+    counts = geometry.counts[faces, None]
+    vertex = np.arange(node.shape[1])
+    valid = vertex < counts
+    following = np.where(vertex + 1 < counts, vertex + 1, 0)
+    x = np.where(valid, geometry.node_x[node], 0)
+    y = np.where(valid, geometry.node_y[node], 0)
+    area = (x * np.take_along_axis(y, following, axis=1) - np.take_along_axis(x, following, axis=1) * y).sum(axis=1)
+    # 顺时针的网格反转顶点顺序
+    reverse = area < 0
+    reversed_order = np.where(valid, counts - 1 - vertex, vertex)
+    node[reverse] = np.take_along_axis(node[reverse], reversed_order[reverse], axis=1)
+
+    start = node[valid]
+    end = np.take_along_axis(node, following, axis=1)[valid]
+    # 无向边只出现一次的为边界
+    size = len(geometry.node_x)
+    keys = np.minimum(start, end).astype(np.int64) * size + np.maximum(start, end)
+    _, inverse, occurrences = np.unique(keys, return_inverse=True, return_counts=True)
+    boundary = occurrences[inverse] == 1
+    return start[boundary], end[boundary]
+
+
+def chain_rings(geometry, start, end):
+    """
+    把边界边首尾相连为环；一个格点有多条出边时(区域在该格点相接)选择向左转得最多的边，沿同一块区域继续，
+    同一个环经过该格点两次时在该格点拆分，得到外环和与之相接的内环
+
+    Returns:
+        list: [[格点序号, ...]]，首尾不重复
+    """
+    start = start.tolist()
+    end = end.tolist()
+    outgoing = defaultdict(list)
+    for edge, node in enumerate(start):
+        outgoing[node].append(edge)
+    node_x = geometry.node_x
+    node_y = geometry.node_y
+
+    used = [False] * len(start)
+    rings = []
+    for first in range(len(start)):
+        if used[first]:
+            continue
+        ring = [start[first]]
+        edge = first
+        while True:
+            used[edge] = True
+            node = end[edge]
+            candidates = [candidate for candidate in outgoing[node] if candidate == first or not used[candidate]]
+            if not candidates:
+                # 网格数据不完整时边界可能不闭合，丢弃该环
+                ring = None
+                break
+            if len(candidates) > 1:
+                dx, dy = node_x[node] - node_x[start[edge]], node_y[node] - node_y[start[edge]]
+                candidates.sort(key=lambda candidate: turn(dx, dy, node_x[end[candidate]] - node_x[node],
+                                                           node_y[end[candidate]] - node_y[node]))
+            edge = candidates[-1]
+            if edge == first:
+                break
+            ring.append(node)
+        if ring is None:
+            continue
+        rings.extend(nodes for nodes in split_ring(ring) if len(nodes) >= 3)
+    return rings
+
+
+def turn(dx, dy, next_dx, next_dy):
+    """
+    从方向 (dx, dy) 转到 (next_dx, next_dy) 的角度，向左为正
+    """
+    return math.atan2(dx * next_dy - dy * next_dx, dx * next_dx + dy * next_dy)
+
+
+def split_ring(ring):
+    """
+    在重复的格点处拆分环，每个环只经过每个格点一次
+    """
+    stack = []
+    position = {}
+    for node in ring:
+        if node in position:
+            index = position[node]
+            loop = stack[index:]
+            del stack[index:]
+            for item in loop:
+                del position[item]
+            yield loop
+        position[node] = len(stack)
+        stack.append(node)
+    yield stack
+
+
+def ring_coordinates(geometry, rings):
+    """
+    所有环一起计算有向面积(逆时针为正)并去掉共线的中间顶点
+
+    Args:
+        geometry(FaceGeometry): 网格几何数据
+        rings(list): [[格点序号, ...]]
+
+    Returns:
+        tuple: ([ndarray [n, 2]] 环的顶点, [R] 有向面积)
+    """
+    sizes = np.array([len(ring) for ring in rings])
+    nodes = np.fromiter(chain.from_iterable(rings), dtype=np.int64, count=sizes.sum())
+    ring_id = np.repeat(np.arange(len(rings)), sizes)
+    first = (np.cumsum(sizes) - sizes)[ring_id]
+    last = np.cumsum(sizes)[ring_id] - 1
+    index = np.arange(len(nodes))
+    previous = np.where(index == first, last, index - 1)
+    following = np.where(index == last, first, index + 1)
+    x = geometry.node_x[nodes]
+    y = geometry.node_y[nodes]
+    areas = np.bincount(ring_id, weights=x * y[following] - x[following] * y, minlength=len(rings)) / 2
+
+    ax, ay = x - x[previous], y - y[previous]
+    bx, by = x[following] - x, y[following] - y
+    keep = np.abs(ax * by - ay * bx) > 1e-9 * np.hypot(ax, ay) * np.hypot(bx, by)
+    keep |= (np.bincount(ring_id, weights=keep, minlength=len(rings)) < 3)[ring_id]
+    counts = np.bincount(ring_id[keep], minlength=len(rings))
+    coordinates = np.split(np.column_stack([x[keep], y[keep]]), np.cumsum(counts)[:-1])
+    return coordinates, areas
+
+
+def ring_contains(ring, x, y):
+    """
+    射线法判断点是否在环内
+    """
+    x1, y1 = ring[:, 0], ring[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crosses = ((y1 > y) != (y2 > y)) & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+    return crosses.sum() % 2 == 1
+
+
+def close_ring(ring):
+    coordinates = np.round(ring, EXTENT_PRECISION).tolist()
+    coordinates.append(coordinates[0])
+    return coordinates
+
+
+def extent_feature_collection(geometry, faces, risk, min_risk=None, properties=None):
+    """
+    按风险等级合并网格，每个风险等级一个 MultiPolygon 要素
+
+    Args:
+        geometry(FaceGeometry): 网格几何数据
+        faces(ndarray): [F] 网格序号
+        risk(ndarray): [F] 风险等级
+        min_risk(int): 最小风险等级，为空时包含所有风险等级
+        properties(dict): 每个要素的其他属性
+
+    Returns:
+        dict: GeoJSON FeatureCollection，要素属性 risk(风险等级)、faces(网格数)
+    """
+    faces = np.asarray(faces)
+    risk = np.asarray(risk)
+    valid = faces >= 0
+    faces, risk = faces[valid], risk[valid]
+    features = []
+    for level in np.unique(risk).tolist():
+        if min_risk is not None and level < min_risk:
+            continue
+        selected = faces[risk == level]
+        features.append({
+            'type': 'Feature',
+            'properties': {'risk': level, 'faces': len(selected), **(properties or {})},
+            'geometry': {'type': 'MultiPolygon', 'coordinates': dissolve(geometry, selected)},
+        })
+    return {'type': 'FeatureCollection', 'features': features}
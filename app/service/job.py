@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from app.models import ProjectJob
+from app.repository.app_repository import AppRepository
+from hydrologic_forecasting.settings import config
+
+
+class StageTimer:
+    """
+    记录任务各阶段的耗时，每个阶段开始和结束时更新任务状态
+
+    Example:
+        with timer('model'):
+            ...
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.stages = {}
+
+    @contextmanager
+    def __call__(self, name):
+        AppRepository.update_job(self.job_id, stage=name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = round(time.perf_counter() - start, 3)
+            AppRepository.update_job(self.job_id, stages=self.stages)
+
+    def set_project(self, project_id):
+        """
+        方案创建后立即记录到任务中，之后的步骤失败时也能找到已经创建的方案
+        """
+        AppRepository.update_job(self.job_id, project_id=project_id)
+
+
+class JobRunner:
+    """
+    在后台线程池中执行模型运行任务，提交后立即返回任务编号
+    """
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='project-job')
+        self.started_at = timezone.now()
+        self.recovered = False
+        self.lock = threading.Lock()
+
+    def recover(self):
+        """
+        任务只在当前进程的线程池中执行，服务重启后之前等待中、运行中的任务不会再继续，
+        第一次访问任务时将启动前创建的这些任务标记为失败
+        """
+        with self.lock:
+            if self.recovered:
+                return
+            count = AppRepository.fail_unfinished_jobs(self.started_at, '服务重启，任务已中断')
+            if count:
+                logging.warning("%s 个未完成的模型运行任务已标记为失败", count)
+            self.recovered = True
+
+    def submit(self, request, task):
+        """
+        提交任务
+
+        Args:
+            request(dict): 任务参数，保存在任务记录中
+            task(callable): task(timer) 执行任务，返回 (project_id, output)
+
+        Returns:
+            int: 任务编号
+        """
+        self.recover()
+        job_id = AppRepository.insert_job(request)
+        self.executor.submit(self.run, job_id, task)
+        return job_id
+
+    @staticmethod
+    def run(job_id, task):
+        close_old_connections()
+        try:
+            AppRepository.update_job(job_id, status=ProjectJob.STATUS_RUNNING, started_at=timezone.now())
+            project_id, output = task(StageTimer(job_id))
+            AppRepository.update_job(job_id, status=ProjectJob.STATUS_SUCCEEDED, project_id=project_id,
+                                     output=output or '', finished_at=timezone.now())
+        except Exception as e:
+            logging.error("模型运行任务 %s 失败：%s", job_id, traceback.format_exc())
+            AppRepository.update_job(job_id, status=ProjectJob.STATUS_FAILED, error=str(e),
+                                     finished_at=timezone.now())
+        finally:
+            close_old_connections()
+
+
+job_runner = JobRunner(config['model']['job']['workers'])
@@ -0,0 +1,420 @@
+import hashlib
+from dataclasses import dataclass, field
+
+import numpy as np
+from shapely import MultiPoint
+
+# 网格索引平均每个格子包含的网格数
+FACES_PER_CELL = 4
+# 最大的细节层级，层级 n 的格子边长为网格典型边长的 2^n 倍
+MAX_LOD = 16
+
+
+def sort_vertices(lon, lat):
+    """
+    排序四角网格的顶点
+
+    Args:
+        lon(ndarray): 经度数组
+        lat(ndarray): 纬度数组
+
+    Returns:
+        ndarray: [3 0 1 2]
+
+    Example:
+        sort_vertices([22.52566799 22.52892391 22.52876978 22.52475916], [113.86085031 113.86083196 113.85659267 113.8577512 ])
+    """
+    # 计算质心
+    centroid = MultiPoint(list(zip(lon, lat))).centroid
+    cx, cy = centroid.x, centroid.y
+
+    # 计算每个顶点相对于质心的角度
+    angles = np.arctan2(lat - cy, lon - cx)
+
+    # 根据角度排序顶点
+    sort_order = np.argsort(angles)
+
+    # 返回排序后的顶点索引
+    return sort_order
+
+
+def sort_vertices_batch(node_x, node_y, nodes, counts):
+    """
+    批量排序网格的顶点，与 sort_vertices 的结果一致：按顶点相对质心的角度从小到大排列
+
+    三角网格保持原始顺序，四角及以上的网格排序
+
+    Args:
+        node_x(ndarray): [M] 格点经度
+        node_y(ndarray): [M] 格点纬度
+        nodes(ndarray): [N*K] 顶点序号（从0开始），有效顶点在前，缺省为-1
+        counts(ndarray): [N] 每个网格的顶点数
+
+    Returns:
+        ndarray: [N*K] 排序后的顶点序号
+    """
+    polygons = np.flatnonzero(counts >= 4)
+    if len(polygons) == 0:
+        return nodes
+
+    node = nodes[polygons]
+    valid = node >= 0
+    lon = np.where(valid, node_x[node], 0)
+    lat = np.where(valid, node_y[node], 0)
+
+    # 质心
+    cx = lon.sum(axis=1, keepdims=True) / counts[polygons, None]
+    cy = lat.sum(axis=1, keepdims=True) / counts[polygons, None]
+
+    # 缺省顶点排在最后
+    angles = np.where(valid, np.arctan2(lat - cy, lon - cx), np.inf)
+    sorted_nodes = nodes.copy()
+    sorted_nodes[polygons] = np.take_along_axis(node, np.argsort(angles, axis=1), axis=1)
+    return sorted_nodes
+
+
+@dataclass
+class FaceGeometry:
+    """
+    网格几何数据，由 mesh2d_face_nodes 一次性解析得到
+
+    Attributes:
+        node_x(ndarray): [M] 格点经度
+        node_y(ndarray): [M] 格点纬度
+        nodes(ndarray): [N*K] 每个网格排序后的顶点序号（从0开始），缺省为-1
+        counts(ndarray): [N] 每个网格的顶点数
+    """
+    node_x: np.ndarray
+    node_y: np.ndarray
+    nodes: np.ndarray
+    counts: np.ndarray
+    _lat_lon: list = field(default=None, init=False, repr=False)
+    _grid: 'FaceGrid' = field(default=None, init=False, repr=False)
+    _levels: dict = field(default_factory=dict, init=False, repr=False)
+    _face_size: float = field(default=None, init=False, repr=False)
+
+    @property
+    def valid(self):
+        """
+        只处理三角网格和四角网格
+        """
+        return (self.counts == 3) | (self.counts == 4)
+
+    @property
+    def lon(self):
+        return np.where(self.nodes >= 0, self.node_x[self.nodes], np.nan)
+
+    @property
+    def lat(self):
+        return np.where(self.nodes >= 0, self.node_y[self.nodes], np.nan)
+
+    def bounds(self):
+        """
+        每个网格的外接矩形
+
+        Returns:
+            tuple: (faces, min_x, max_x, min_y, max_y)，faces 为有顶点的网格序号，其余为对应的 [N] 数组
+        """
+        faces = np.flatnonzero(self.counts > 0)
+        lon = self.lon[faces]
+        lat = self.lat[faces]
+        return faces, np.nanmin(lon, axis=1), np.nanmax(lon, axis=1), np.nanmin(lat, axis=1), np.nanmax(lat, axis=1)
+
+    def level(self, lod):
+        """
+        细节层级：按网格中心把相邻网格合并为正方形格子，层级越高格子越大；每个层级在第一次使用时生成
+
+        Args:
+            lod(int): 0 为原始网格
+
+        Returns:
+            MeshLevel
+        """
+        if not 0 <= lod <= MAX_LOD:
+            raise ValueError(f'细节层级必须在0到{MAX_LOD}之间')
+        level = self._levels.get(lod)
+        if level is None:
+            level = self._levels[lod] = MeshLevel.build(self, lod)
+        return level
+
+    def face_size(self):
+        """
+        网格的典型边长：外接矩形长边的中位数
+        """
+        if self._face_size is None:
+            _, min_x, max_x, min_y, max_y = self.bounds()
+            self._face_size = float(np.median(np.maximum(max_x - min_x, max_y - min_y)))
+        return self._face_size
+
+    def locate(self, lon, lat):
+        """
+        查找包含该点的网格，先由格网索引取出候选网格，只对候选网格判断点是否在多边形内；
+        索引在第一次调用时生成
+
+        Args:
+            lon(float): 经度
+            lat(float): 纬度
+
+        Returns:
+            int: 网格序号，不在任何网格内时为-1
+        """
+        if self._grid is None:
+            self._grid = FaceGrid.build(self)
+        candidates = self._grid.candidates(lon, lat)
+        if len(candidates) == 0:
+            return -1
+        hits = candidates[self.contains(candidates, lon, lat)]
+        return int(hits[0]) if len(hits) else -1
+
+    def contains(self, faces, lon, lat):
+        """
+        射线法判断点是否在网格内
+
+        Args:
+            faces(ndarray): [C] 网格序号
+
+        Returns:
+            ndarray: [C] bool
+        """
+        node = self.nodes[faces]
+        counts = self.counts[faces, None]
+        vertex = np.arange(node.shape[1])
+        valid = vertex < counts
+        x1 = np.where(valid, self.node_x[node], np.nan)
+        y1 = np.where(valid, self.node_y[node], np.nan)
+        # 每条边的终点，最后一个顶点连回第一个顶点
+        following = np.where(vertex + 1 < counts, vertex + 1, 0)
+        x2 = np.take_along_axis(x1, following, axis=1)
+        y2 = np.take_along_axis(y1, following, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crosses = ((y1 > lat) != (y2 > lat)) & (lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1)
+        return (crosses & valid).sum(axis=1) % 2 == 1
+
+    def coordinates(self, face):
+        """
+        获取单个网格的顶点坐标
+
+        Args:
+            face(int): 网格序号
+
+        Returns:
+            tuple: (经度列表, 纬度列表)
+        """
+        node = self.nodes[face, :self.counts[face]]
+        return self.node_x[node].tolist(), self.node_y[node].tolist()
+
+    def lat_lon(self, face):
+        """
+        获取单个网格的顶点坐标，所有网格的坐标在第一次调用时生成
+
+        Args:
+            face(int): 网格序号
+
+        Returns:
+            list: [[纬度, 经度], ...]
+        """
+        if self._lat_lon is None:
+            lon = self.lon.tolist()
+            lat = self.lat.tolist()
+            self._lat_lon = [
+                [[y, x] for x, y in zip(lon[i][:count], lat[i][:count])]
+                for i, count in enumerate(self.counts.tolist())
+            ]
+        return self._lat_lon[face]
+
+
+@dataclass
+class FaceGrid:
+    """
+    网格的均匀格网索引，每个格子记录与之相交的网格（按外接矩形）
+
+    Attributes:
+        x0(float): 格网左下角经度
+        y0(float): 格网左下角纬度
+        size(float): 格子边长
+        nx(int): 经度方向的格子数
+        ny(int): 纬度方向的格子数
+        offsets(ndarray): [nx*ny+1] 每个格子的网格在 faces 中的起止位置
+        faces(ndarray): 按格子排列的网格序号
+    """
+    x0: float
+    y0: float
+    size: float
+    nx: int
+    ny: int
+    offsets: np.ndarray
+    faces: np.ndarray
+
+    @classmethod
+    def build(cls, geometry):
+        faces, min_x, max_x, min_y, max_y = geometry.bounds()
+        x0, y0 = float(min_x.min()), float(min_y.min())
+        width, height = float(max_x.max()) - x0, float(max_y.max()) - y0
+        # 格子边长使平均每个格子包含 FACES_PER_CELL 个网格
+        size = np.sqrt(max(width * height, 1e-12) / len(faces) * FACES_PER_CELL)
+        nx, ny = int(width // size) + 1, int(height // size) + 1
+
+        ix0 = ((min_x - x0) // size).astype(np.int64)
+        iy0 = ((min_y - y0) // size).astype(np.int64)
+        spans_x = np.minimum(((max_x - x0) // size).astype(np.int64), nx - 1) - ix0 + 1
+        spans_y = np.minimum(((max_y - y0) // size).astype(np.int64), ny - 1) - iy0 + 1
+        # 展开每个网格覆盖的所有格子
+        cells_per_face = spans_x * spans_y
+        local = np.arange(cells_per_face.sum()) - np.repeat(np.cumsum(cells_per_face) - cells_per_face, cells_per_face)
+        spans_x = np.repeat(spans_x, cells_per_face)
+        cell = (np.repeat(iy0, cells_per_face) + local // spans_x) * nx + np.repeat(ix0, cells_per_face) + local % spans_x
+
+        order = np.argsort(cell, kind='stable')
+        offsets = np.zeros(nx * ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell, minlength=nx * ny), out=offsets[1:])
+        return cls(x0=x0, y0=y0, size=size, nx=nx, ny=ny, offsets=offsets,
+                   faces=np.repeat(faces, cells_per_face)[order])
+
+    def candidates(self, lon, lat):
+        """
+        点所在格子的网格序号
+        """
+        ix = int((lon - self.x0) // self.size)
+        iy = int((lat - self.y0) // self.size)
+        if not (0 <= ix < self.nx and 0 <= iy < self.ny):
+            return np.empty(0, dtype=self.faces.dtype)
+        cell = iy * self.nx + ix
+        return self.faces[self.offsets[cell]:self.offsets[cell + 1]]
+
+
+@dataclass
+class MeshLevel:
+    """
+    网格的一个细节层级
+
+    Attributes:
+        lod(int): 层级
+        geometry(FaceGeometry): 格子的几何数据，每个格子为正方形
+        cells(ndarray): [N] 每个原始网格所在的格子，没有顶点的网格为-1
+    """
+    lod: int
+    geometry: FaceGeometry
+    cells: np.ndarray
+
+    @classmethod
+    def build(cls, geometry, lod):
+        if lod == 0:
+            return cls(lod=0, geometry=geometry, cells=np.arange(len(geometry.counts)))
+
+        faces, min_x, _, min_y, _ = geometry.bounds()
+        size = geometry.face_size() * 2 ** lod
+        x0, y0 = float(min_x.min()), float(min_y.min())
+        with np.errstate(invalid='ignore'):
+            cx = np.nanmean(geometry.lon[faces], axis=1)
+            cy = np.nanmean(geometry.lat[faces], axis=1)
+        ix = ((cx - x0) // size).astype(np.int64)
+        iy = ((cy - y0) // size).astype(np.int64)
+        nx = int(ix.max()) + 2
+
+        keys, inverse = np.unique(iy * nx + ix, return_inverse=True)
+        cells = np.full(len(geometry.counts), -1, dtype=np.int64)
+        cells[faces] = inverse
+
+        # 格子的四个角按逆时针排列，与 sort_vertices 的顺序一致
+        corner_x = (keys % nx)[:, None] + np.array([0, 1, 1, 0])
+        corner_y = (keys // nx)[:, None] + np.array([0, 0, 1, 1])
+        corners, nodes = np.unique(corner_y * nx + corner_x, return_inverse=True)
+        level_geometry = FaceGeometry(
+            node_x=x0 + (corners % nx) * size,
+            node_y=y0 + (corners // nx) * size,
+            nodes=nodes.reshape(-1, 4),
+            counts=np.full(len(keys), 4),
+        )
+        return cls(lod=lod, geometry=level_geometry, cells=cells)
+
+    def aggregate(self, faces, water_depth, risk):
+        """
+        把原始网格的数据合并到格子，取最大水深和最大风险等级
+
+        Args:
+            faces(ndarray): [F] 网格序号
+            water_depth(ndarray): [F] 水深
+            risk(ndarray): [F] 风险等级
+
+        Returns:
+            tuple: (格子序号, 最大水深, 最大风险等级)，只包含有数据的格子
+        """
+        faces = np.asarray(faces)
+        if self.lod == 0:
+            return faces, np.asarray(water_depth), np.asarray(risk)
+        cells = self.cells[faces]
+        valid = (faces >= 0) & (cells >= 0)
+        cells = cells[valid]
+        max_depth = np.full(len(self.geometry.counts), -np.inf, dtype=np.float64)
+        max_risk = np.full(len(self.geometry.counts), np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(max_depth, cells, np.asarray(water_depth, dtype=np.float64)[valid])
+        np.maximum.at(max_risk, cells, np.asarray(risk, dtype=np.int64)[valid])
+        used = np.flatnonzero(max_risk > np.iinfo(np.int64).min)
+        return used, max_depth[used], max_risk[used]
+
+
+def tile_lod(geometry, z, pixels=256):
+    """
+    切片缩放级别对应的细节层级：格子边长不小于 2 个像素，网格本身大于 2 个像素时使用原始网格
+    """
+    pixel = 360 / (2 ** z * pixels)
+    size = geometry.face_size()
+    if size <= 0 or size >= 2 * pixel:
+        return 0
+    return min(int(np.ceil(np.log2(2 * pixel / size))), MAX_LOD)
+
+
+def build_geometry(node_x, node_y, nodes):
+    """
+    由排序后的顶点序号生成网格几何数据
+
+    Args:
+        node_x(ndarray): 格点经度
+        node_y(ndarray): 格点纬度
+        nodes(ndarray): [N*K] 顶点序号（从0开始），缺省为-1
+
+    Returns:
+        FaceGeometry
+    """
+    return FaceGeometry(node_x=node_x, node_y=node_y, nodes=nodes, counts=(nodes >= 0).sum(axis=1))
+
+
+def mesh_signature(node_x, node_y, face_nodes):
+    """
+    计算网格的摘要，用于判断不同方案是否共用同一个网格
+
+    Returns:
+        str: sha256
+    """
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(np.ma.getdata(node_x), dtype='<f8').tobytes())
+    digest.update(np.ascontiguousarray(np.ma.getdata(node_y), dtype='<f8').tobytes())
+    digest.update(np.ascontiguousarray(np.ma.filled(face_nodes, -1), dtype='<i4').tobytes())
+    return digest.hexdigest()
+
+
+def resolve_faces(node_x, node_y, face_nodes):
+    """
+    解析所有网格的顶点，四角网格的顶点按照 sort_vertices_batch 的顺序排列
+
+    Args:
+        node_x(ndarray): mesh2d_node_x
+        node_y(ndarray): mesh2d_node_y
+        face_nodes(MaskedArray): mesh2d_face_nodes，序号从1开始，缺省值被屏蔽
+
+    Returns:
+        FaceGeometry
+    """
+    node_x = np.ma.getdata(node_x).astype(np.float64)
+    node_y = np.ma.getdata(node_y).astype(np.float64)
+    raw = np.ma.getdata(face_nodes).astype(np.int64)
+    missing = np.ma.getmaskarray(face_nodes) | (raw <= 0)
+
+    # 与 compressed() 一致：保持顺序，把有效顶点移到每行前面
+    order = np.argsort(missing, axis=1, kind='stable')
+    nodes = np.take_along_axis(raw - 1, order, axis=1)
+    nodes[np.take_along_axis(missing, order, axis=1)] = -1
+    counts = (~missing).sum(axis=1)
+    nodes = sort_vertices_batch(node_x, node_y, nodes, counts)
+
+    return FaceGeometry(node_x=node_x, node_y=node_y, nodes=nodes, counts=counts)
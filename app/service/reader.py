@@ -0,0 +1,264 @@
+import decimal
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import netCDF4 as nc
+import numpy as np
+
+# 与 MapData.water_depth(DecimalField(max_digits=5, decimal_places=2)) 保存时的转换一致
+WATER_DEPTH_CONTEXT = decimal.Context(prec=5)
+WATER_DEPTH_QUANTUM = decimal.Decimal('0.01')
+
+
+def first_time_index(project_type):
+    """
+    方案需要处理的第一个时刻
+
+    计算好的模型(type=0)只需要最后1个小时，从第23个时刻开始；
+    实时计算的模型(type=1)需要取[24:47]，从第24个时刻开始
+
+    Args:
+        project_type(int): 方案类型
+
+    Returns:
+        int
+    """
+    if project_type == 0:
+        return 23
+    if project_type == 1:
+        return 24
+    return 0
+
+
+class MapReader:
+    """
+    网格结果文件的读取器，按时间分块读取水深和风险等级，只读取需要的时刻
+
+    Example:
+        with MapReader(nc_file, risk_nc_file) as reader:
+            for start, water_depth, risk in reader.iter_chunks(24, 48, 6):
+                ...
+    """
+
+    def __init__(self, map_path, risk_path):
+        self.map_path = map_path
+        self.risk_path = risk_path
+        self.dataset = None
+        self.risk_ds = None
+
+    def __enter__(self):
+        self.dataset = nc.Dataset(self.map_path)
+        try:
+            self.risk_ds = nc.Dataset(self.risk_path)
+        except Exception:
+            self.dataset.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.risk_ds.close()
+        self.dataset.close()
+
+    def mesh(self):
+        """
+        Returns:
+            tuple: (mesh2d_node_x, mesh2d_node_y, mesh2d_face_nodes)
+        """
+        variables = self.dataset.variables
+        return variables['mesh2d_node_x'][:], variables['mesh2d_node_y'][:], variables['mesh2d_face_nodes'][:]
+
+    def times(self):
+        return self.dataset.variables['time'][:]
+
+    @property
+    def time_count(self):
+        return self.dataset.variables['mesh2d_waterdepth'].shape[0]
+
+    def read(self, start, stop):
+        """
+        读取[start, stop)时刻的水深和风险等级，被屏蔽的值按0处理
+
+        Returns:
+            tuple: (水深 [T*N], 风险等级 [T*N])
+        """
+        water_depth = np.ma.filled(self.dataset.variables['mesh2d_waterdepth'][start:stop, :], 0)
+        risk = np.ma.filled(self.risk_ds.variables['mesh2d_waterdepth'][start:stop, :], 0)
+        return water_depth, risk.astype(np.int32)
+
+    def iter_chunks(self, start, stop, chunk_size):
+        """
+        按时间分块读取，每次只有一个分块在内存中
+
+        Args:
+            start(int): 第一个时刻
+            stop(int): 结束时刻（不包含）
+            chunk_size(int): 每块的时刻数
+
+        Yields:
+            tuple: (分块的第一个时刻, 水深 [T*N], 风险等级 [T*N])
+        """
+        stop = min(stop, self.time_count)
+        for chunk_start in range(start, stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            water_depth, risk = self.read(chunk_start, chunk_stop)
+            yield chunk_start, water_depth, risk
+
+
+class StationReader:
+    """
+    站点结果文件(his.nc)的读取器
+
+    Example:
+        with StationReader(nc_file) as reader:
+            names, lon, lat = reader.stations()
+            water_depth, water_level, velocity_magnitude = reader.read(24, 48)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dataset = None
+
+    def __enter__(self):
+        self.dataset = nc.Dataset(self.path)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.dataset.close()
+
+    def stations(self):
+        """
+        读取站点名称和经纬度，站点名称只解码一次
+
+        Returns:
+            tuple: (站点名称列表, 经度 [S], 纬度 [S])
+        """
+        variables = self.dataset.variables
+        names = [
+            ''.join([name.strip() for name in station_name.compressed().astype(str) if name])
+            for station_name in variables['station_name'][:]
+        ]
+        lon = np.ma.getdata(variables['station_x_coordinate'][:])
+        lat = np.ma.getdata(variables['station_y_coordinate'][:])
+        return names, lon, lat
+
+    def times(self):
+        return self.dataset.variables['time'][:]
+
+    @property
+    def time_count(self):
+        return self.dataset.variables['waterdepth'].shape[0]
+
+    def read(self, start, stop):
+        """
+        读取[start, stop)时刻所有站点的数据
+
+        Returns:
+            tuple: (水深 [T*S], 水位 [T*S], 流速 [T*S])
+        """
+        variables = self.dataset.variables
+        return tuple(
+            np.ma.filled(variables[name][start:stop, :], 0)
+            for name in ('waterdepth', 'waterlevel', 'velocity_magnitude')
+        )
+
+
+def format_water_depth(value):
+    """
+    水深转换为保存到数据库的字符串，与 Django 保存 DecimalField 的结果相同
+
+    Args:
+        value(float): 水深
+
+    Returns:
+        str: 如 1.23
+    """
+    depth = WATER_DEPTH_CONTEXT.create_decimal_from_float(value)
+    return '{:f}'.format(depth.quantize(WATER_DEPTH_QUANTUM, context=WATER_DEPTH_CONTEXT))
+
+
+def wet_face_rows(water_depth, risk, min_water_depth, valid, project_id, timestamps):
+    """
+    筛选每个时刻满足水深条件的网格，生成可以直接写入 app_mapdata 的行
+
+    Args:
+        water_depth(ndarray): 水深 [T*N]
+        risk(ndarray): 风险等级 [T*N]
+        min_water_depth(float): 最小水深
+        valid(ndarray): [N] 需要处理的网格
+        project_id(int): 方案编号
+        timestamps(list): [T] 各时刻的时间戳
+
+    Returns:
+        list: 每个时刻一项，为 [(方案编号, 网格序号, 水深, 风险等级, 时间戳)]
+    """
+    result = []
+    for offset, timestamp in enumerate(timestamps):
+        faces = np.flatnonzero((water_depth[offset] > min_water_depth) & valid)
+        depths = [format_water_depth(value) for value in water_depth[offset, faces].tolist()]
+        rows = [(project_id, face, depth, level, timestamp)
+                for face, depth, level in zip(faces.tolist(), depths, risk[offset, faces].tolist())]
+        result.append(rows)
+    return result
+
+
+def read_wet_face_rows(map_path, risk_path, start, min_water_depth, valid, project_id, timestamps):
+    """
+    进程池任务：在子进程中打开文件，读取从 start 开始 len(timestamps) 个时刻的数据并生成写入的行
+    """
+    with MapReader(map_path, risk_path) as reader:
+        water_depth, risk = reader.read(start, start + len(timestamps))
+    return wet_face_rows(water_depth, risk, min_water_depth, valid, project_id, timestamps)
+
+
+def iter_wet_face_rows(map_path, risk_path, start, min_water_depth, valid, project_id, timestamps, chunk_size,
+                       workers=1):
+    """
+    按时间顺序逐个时刻返回满足水深条件的网格，已转换为写入 app_mapdata 的行
+
+    workers 大于 1 时，各时间分块分发到进程池读取、筛选和格式化，调用方在当前进程按时间顺序写入数据库，
+    生成下一块的同时写入当前块；同时最多有 2*workers 个分块在内存中。
+    进程池使用 spawn 方式启动，在后台任务线程中创建也是安全的
+
+    Args:
+        map_path(str): 网格结果文件
+        risk_path(str): 风险等级文件
+        start(int): 第一个时刻
+        min_water_depth(float): 最小水深
+        valid(ndarray): [N] 需要处理的网格
+        project_id(int): 方案编号
+        timestamps(list): 所有时刻的时间戳，处理[start, len(timestamps))时刻
+        chunk_size(int): 每块的时刻数
+        workers(int): 进程数，1 表示在当前进程中顺序处理
+
+    Yields:
+        tuple: (时间戳, 行)
+    """
+    with MapReader(map_path, risk_path) as reader:
+        stop = min(len(timestamps), reader.time_count)
+        if workers <= 1:
+            for chunk_start, water_depth, risk in reader.iter_chunks(start, stop, chunk_size):
+                chunk_timestamps = timestamps[chunk_start:chunk_start + len(water_depth)]
+                yield from zip(chunk_timestamps, wet_face_rows(
+                    water_depth, risk, min_water_depth, valid, project_id, chunk_timestamps))
+            return
+
+    chunk_starts = iter(range(start, stop, chunk_size))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        pending = deque()
+
+        def submit():
+            chunk_start = next(chunk_starts, None)
+            if chunk_start is not None:
+                chunk_timestamps = timestamps[chunk_start:min(chunk_start + chunk_size, stop)]
+                pending.append((chunk_timestamps, executor.submit(
+                    read_wet_face_rows, map_path, risk_path, chunk_start, min_water_depth, valid, project_id,
+                    chunk_timestamps)))
+
+        for _ in range(2 * workers):
+            submit()
+        while pending:
+            chunk_timestamps, future = pending.popleft()
+            rows = future.result()
+            submit()
+            yield from zip(chunk_timestamps, rows)
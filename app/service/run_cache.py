@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from functools import lru_cache
+
+from app.service.workspace import is_subpath
+from hydrologic_forecasting.settings import config
+
+# 模型的边界条件文件
+BOUNDARY_FILES = ('Discharge.bc', 'WaterLevel.bc')
+
+
+def run_signature(input_dir, date_times, project_type):
+    """
+    计算模型运行的摘要：边界条件文件 + 模型配置文件的内容 + 模型配置 + 时间 + 方案类型
+
+    Args:
+        input_dir(str): 写入边界条件文件的目录
+        date_times(list): 各时刻对应的时间
+        project_type(int): 方案类型
+
+    Returns:
+        str: sha256
+    """
+    digest = hashlib.sha256()
+    for name in BOUNDARY_FILES:
+        with open(os.path.join(input_dir, name), 'rb') as file:
+            digest.update(file.read())
+    script = config['model']['script']
+    # 修改 .mdu 等模型配置文件后摘要不同，不会复用旧的结果
+    for path in model_files(script):
+        stat = os.stat(path)
+        digest.update(path.encode('utf-8'))
+        digest.update(file_digest(path, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    digest.update(json.dumps({
+        'bat_path': script['bat_path'],
+        'bat_workspace': script['bat_workspace'],
+        'input': script['input'],
+        'date_times': [str(date_time) for date_time in date_times],
+        'type': project_type,
+    }, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def model_files(script):
+    """
+    模型配置文件：bat_workspace 和输入目录中的文件以及 bat 脚本，不包括输出目录和每次写入的边界条件文件
+
+    Returns:
+        list: 排序后的文件路径
+    """
+    paths = set()
+    for directory in (script['bat_workspace'], script['input']):
+        if not directory or not os.path.isdir(directory):
+            continue
+        for current, directories, files in os.walk(directory):
+            directories[:] = [name for name in directories
+                              if not is_subpath(os.path.join(current, name), script['output'])]
+            for name in files:
+                if name in BOUNDARY_FILES and is_subpath(current, script['input']):
+                    continue
+                paths.add(os.path.join(current, name))
+    if script['bat_path'] and os.path.isfile(script['bat_path']):
+        paths.add(script['bat_path'])
+    return sorted(paths)
+
+
+@lru_cache(maxsize=4096)
+def file_digest(path, size, mtime_ns):
+    """
+    文件内容的摘要，按文件大小和修改时间缓存，未修改的文件不重复读取
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def directory_size(path):
+    size = 0
+    for current, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(current, name))
+    return size
+
+
+def store_outputs(signature, output_dir):
+    """
+    复制模型输出文件到缓存目录，未配置 model.cache.root 时不缓存文件
+
+    Returns:
+        tuple: (缓存目录, 占用的字节数)
+    """
+    root = config['model']['cache']['root']
+    if not root:
+        return '', 0
+    path = os.path.join(root, signature)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    shutil.copytree(output_dir, path)
+    return path, directory_size(path)
+
+
+def remove_outputs(path):
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        logging.info("删除模型输出缓存：%s", path)
@@ -0,0 +1,211 @@
+import math
+import struct
+
+import numpy as np
+
+# 切片坐标范围，网格顶点取整到 TILE_EXTENT * TILE_EXTENT 的格点上，缩放级别越小，合并的顶点越多
+TILE_EXTENT = 4096
+# 切片四周多查询的范围(切片坐标)，避免相邻切片接缝处缺少网格
+TILE_BUFFER = 64
+TILE_LAYER = 'flood'
+TILE_MAX_ZOOM = 24
+
+# MVT 几何命令
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+POLYGON = 3
+
+
+def check_tile(z, x, y):
+    if not 0 <= z <= TILE_MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise ValueError(f'无效的切片：{z}/{x}/{y}')
+
+
+def tile_bounds(z, x, y, buffer=TILE_BUFFER):
+    """
+    Web 墨卡托切片的经纬度范围
+
+    Args:
+        z(int): 缩放级别
+        x(int): 列号
+        y(int): 行号，从北向南
+        buffer(int): 四周扩展的范围(切片坐标)
+
+    Returns:
+        tuple: (最小经度, 最小纬度, 最大经度, 最大纬度)
+    """
+    n = 2 ** z
+    pad = buffer / TILE_EXTENT
+    return (
+        (x - pad) / n * 360 - 180,
+        tile_latitude(min(y + 1 + pad, n), n),
+        (x + 1 + pad) / n * 360 - 180,
+        tile_latitude(max(y - pad, 0), n),
+    )
+
+
+def tile_latitude(y, n):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+
+def project_to_tile(lon, lat, z, x, y):
+    """
+    经纬度转换为切片坐标并取整
+
+    Returns:
+        tuple: (列坐标, 行坐标)，int64 数组，行坐标向下为正
+    """
+    n = 2 ** z
+    px = ((lon + 180) / 360 * n - x) * TILE_EXTENT
+    py = ((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * n - y) * TILE_EXTENT
+    return np.rint(px).astype(np.int64), np.rint(py).astype(np.int64)
+
+
+def encode_tile(geometry, faces, water_depth, risk, z, x, y):
+    """
+    把网格数据编码为 Mapbox 矢量切片，每个网格一个多边形要素，属性为 waterDepth 和 risk
+
+    顶点取整到切片坐标后，去掉重合的相邻顶点，面积为0的网格不输出
+
+    Args:
+        geometry(FaceGeometry): 网格几何数据
+        faces(ndarray): [F] 网格序号
+        water_depth(ndarray): [F] 水深
+        risk(ndarray): [F] 风险等级
+        z, x, y: 切片
+
+    Returns:
+        bytes: 没有要素时为空
+    """
+    node = geometry.nodes[faces]
+    valid = node >= 0
+    px, py = project_to_tile(geometry.node_x[node], geometry.node_y[node], z, x, y)
+
+    # 去掉与前一个顶点(首个顶点的前一个是最后一个顶点)重合的顶点
+    counts = valid.sum(axis=1)
+    vertex = np.arange(node.shape[1])
+    previous = np.where(vertex > 0, vertex - 1, counts[:, None] - 1)
+    repeated = (px == np.take_along_axis(px, previous, axis=1)) & (py == np.take_along_axis(py, previous, axis=1))
+    keep = valid & ~repeated
+    order = np.argsort(~keep, axis=1, kind='stable')
+    px = np.take_along_axis(px, order, axis=1)
+    py = np.take_along_axis(py, order, axis=1)
+    counts = keep.sum(axis=1)
+    keep = vertex < counts[:, None]
+
+    # 面积为正(切片坐标中顺时针)的环为外环，面积为负的网格反转顶点顺序
+    following = np.where(vertex + 1 < counts[:, None], vertex + 1, 0)
+    area = np.where(keep, px * np.take_along_axis(py, following, axis=1)
+                    - np.take_along_axis(px, following, axis=1) * py, 0).sum(axis=1)
+    reverse = area < 0
+    reversed_order = np.where(keep, counts[:, None] - 1 - vertex, vertex)
+    px[reverse] = np.take_along_axis(px[reverse], reversed_order[reverse], axis=1)
+    py[reverse] = np.take_along_axis(py[reverse], reversed_order[reverse], axis=1)
+
+    selected = np.flatnonzero((counts >= 3) & (area != 0))
+    if len(selected) == 0:
+        return b''
+    px, py, counts, keep = px[selected], py[selected], counts[selected], keep[selected]
+
+    # 几何命令：MoveTo 第一个顶点，LineTo 其余顶点，ClosePath；坐标为与前一个顶点的差值
+    dx = np.diff(px, axis=1, prepend=0)
+    dy = np.diff(py, axis=1, prepend=0)
+    commands = np.zeros((len(selected), 2 * node.shape[1] + 3), dtype=np.int64)
+    mask = np.zeros(commands.shape, dtype=bool)
+    commands[:, 0] = command(MOVE_TO, 1)
+    commands[:, 1] = zigzag(dx[:, 0])
+    commands[:, 2] = zigzag(dy[:, 0])
+    commands[:, 3] = command(LINE_TO, counts - 1)
+    commands[:, 4:-1:2] = zigzag(dx[:, 1:])
+    commands[:, 5:-1:2] = zigzag(dy[:, 1:])
+    mask[:, :4] = True
+    mask[:, 4:-1:2] = keep[:, 1:]
+    mask[:, 5:-1:2] = keep[:, 1:]
+    # ClosePath 放在最后一个顶点之后
+    end = 2 * counts + 2
+    commands[np.arange(len(selected)), end] = command(CLOSE_PATH, 1)
+    mask[np.arange(len(selected)), end] = True
+    values = commands[mask]
+    sizes = mask.sum(axis=1)
+
+    encoded, lengths = encode_varints(values)
+    boundaries = np.concatenate([[0], np.cumsum(np.add.reduceat(lengths, np.cumsum(sizes) - sizes))])
+
+    depths, depth_index = np.unique(np.asarray(water_depth, dtype=np.float32)[selected], return_inverse=True)
+    risks, risk_index = np.unique(np.asarray(risk, dtype=np.int64)[selected], return_inverse=True)
+    feature_ids = np.asarray(faces)[selected].tolist()
+    depth_index = depth_index.tolist()
+    risk_index = (risk_index + len(depths)).tolist()
+
+    features = []
+    for i, start in enumerate(boundaries[:-1].tolist()):
+        tags = varint(0) + varint(depth_index[i]) + varint(1) + varint(risk_index[i])
+        geometry_bytes = encoded[start:boundaries[i + 1]]
+        feature = (b'\x08' + varint(feature_ids[i])
+                   + b'\x12' + varint(len(tags)) + tags
+                   + b'\x18' + varint(POLYGON)
+                   + b'\x22' + varint(len(geometry_bytes)) + geometry_bytes)
+        features.append(b'\x12' + varint(len(feature)) + feature)
+
+    values = [b'\x15' + struct.pack('<f', depth) for depth in depths.tolist()]
+    values += [b'\x28' + varint(value) for value in risks.tolist()]
+    layer = b''.join([
+        b'\x78' + varint(2),
+        string_field(1, TILE_LAYER),
+        *features,
+        string_field(3, 'waterDepth'),
+        string_field(3, 'risk'),
+        *(b'\x22' + varint(len(value)) + value for value in values),
+        b'\x28' + varint(TILE_EXTENT),
+    ])
+    return b'\x1a' + varint(len(layer)) + layer
+
+
+def command(command_id, count):
+    return (count << 3) | command_id
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def varint(value):
+    """
+    protobuf 无符号变长整数
+    """
+    result = bytearray()
+    while value > 0x7f:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def encode_varints(values):
+    """
+    批量编码变长整数
+
+    Args:
+        values(ndarray): 非负整数
+
+    Returns:
+        tuple: (拼接后的 bytes, [N] 每个整数的字节数)
+    """
+    remaining = np.asarray(values, dtype=np.uint64)
+    groups = np.zeros((len(remaining), 10), dtype=np.uint8)
+    lengths = np.ones(len(remaining), dtype=np.int64)
+    for i in range(10):
+        groups[:, i] = remaining & np.uint64(0x7f)
+        remaining = remaining >> np.uint64(7)
+        more = remaining > 0
+        if not more.any():
+            break
+        groups[more, i] |= 0x80
+        lengths += more
+    return groups[np.arange(10) < lengths[:, None]].tobytes(), lengths
+
+
+def string_field(number, value):
+    data = value.encode('utf-8')
+    return varint((number << 3) | 2) + varint(len(data)) + data
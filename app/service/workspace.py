@@ -0,0 +1,169 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from hydrologic_forecasting.settings import config
+
+# 模板文件中的配置路径会被替换为工作空间中的路径
+TEMPLATE_SUFFIXES = ('.bat', '.cmd', '.sh', '.mdu', '.ext')
+
+_semaphore = threading.BoundedSemaphore(config['model']['workspace']['max_concurrency'])
+
+
+def is_subpath(path, directory):
+    if not path or not directory:
+        return False
+    path = os.path.abspath(path)
+    directory = os.path.abspath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+
+def render_templates(directory, replacements):
+    """
+    替换目录中模板文件里的路径
+
+    Args:
+        directory(str): 目录
+        replacements(dict): {原路径: 新路径}
+    """
+    pairs = []
+    for source, target in replacements.items():
+        if source:
+            pairs.append((source, target))
+            if os.path.normpath(source) != source:
+                pairs.append((os.path.normpath(source), target))
+    # 先替换较长的路径，避免父目录先被替换
+    pairs.sort(key=lambda pair: len(pair[0]), reverse=True)
+
+    for current, _, files in os.walk(directory):
+        for name in files:
+            if not name.lower().endswith(TEMPLATE_SUFFIXES):
+                continue
+            path = os.path.join(current, name)
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    content = file.read()
+            except UnicodeDecodeError:
+                logging.warning("模板文件不是UTF-8编码，跳过：%s", path)
+                continue
+            rendered = content
+            for source, target in pairs:
+                rendered = rendered.replace(source, target)
+            if rendered != content:
+                with open(path, 'w', encoding='utf-8') as file:
+                    file.write(rendered)
+
+
+class Workspace:
+    """
+    单次模型运行的独立工作空间，多个模型可以同时运行而不互相覆盖输入输出文件
+
+    目录结构：
+        work: bat 工作空间(bat_workspace)的副本，bat 脚本在此目录中执行
+        input: 模型输入目录的副本，位于 bat_workspace 内时使用 work 中的对应目录
+        output: 空的模型输出目录，位于 bat_workspace 内时使用 work 中的对应目录
+
+    同时存在的工作空间数量受 model.workspace.max_concurrency 限制，退出时自动删除
+
+    Example:
+        with Workspace() as workspace:
+            write_upstream_water_level(data, workspace.input_dir)
+            subprocess.run([workspace.bat_path], cwd=workspace.work_dir, env=workspace.env)
+    """
+
+    def __init__(self):
+        self.root = None
+        self.work_dir = None
+        self.input_dir = None
+        self.output_dir = None
+        self.bat_path = None
+
+    def __enter__(self):
+        _semaphore.acquire()
+        try:
+            self.create()
+        except Exception:
+            self.cleanup()
+            _semaphore.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.cleanup()
+        finally:
+            _semaphore.release()
+
+    def create(self):
+        settings = config['model']['workspace']
+        script = config['model']['script']
+        bat_workspace = script['bat_workspace']
+
+        root = settings['root'] or None
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+        self.root = tempfile.mkdtemp(prefix='run-', dir=root)
+
+        self.work_dir = os.path.join(self.root, 'work')
+        if bat_workspace:
+            shutil.copytree(bat_workspace, self.work_dir)
+        else:
+            os.makedirs(self.work_dir)
+
+        self.input_dir = self.place(script['input'], 'input', copy=True)
+        self.output_dir = self.place(script['output'], 'output', copy=False)
+        self.bat_path = script['bat_path']
+        if is_subpath(self.bat_path, bat_workspace):
+            self.bat_path = os.path.join(self.work_dir, os.path.relpath(self.bat_path, bat_workspace))
+
+        replacements = {
+            bat_workspace: self.work_dir,
+            script['input']: self.input_dir,
+            script['output']: self.output_dir,
+        }
+        render_templates(self.work_dir, replacements)
+        if not is_subpath(self.input_dir, self.work_dir):
+            render_templates(self.input_dir, replacements)
+
+    def place(self, path, name, copy):
+        """
+        确定工作空间中对应的目录
+
+        Args:
+            path(str): 配置的目录
+            name(str): 不在 bat_workspace 内时使用的目录名
+            copy(bool): 是否复制原目录的内容
+        """
+        bat_workspace = config['model']['script']['bat_workspace']
+        if is_subpath(path, bat_workspace):
+            directory = os.path.join(self.work_dir, os.path.relpath(path, bat_workspace))
+            if not copy and os.path.exists(directory):
+                shutil.rmtree(directory)
+            os.makedirs(directory, exist_ok=True)
+            return directory
+
+        directory = os.path.join(self.root, name)
+        if copy and path and os.path.isdir(path):
+            shutil.copytree(path, directory)
+        else:
+            os.makedirs(directory)
+        return directory
+
+    @property
+    def env(self):
+        """
+        bat 脚本的环境变量，脚本也可以通过环境变量获取工作空间中的目录
+        """
+        return dict(
+            os.environ,
+            HF_WORK_DIR=self.work_dir,
+            HF_INPUT_DIR=self.input_dir,
+            HF_OUTPUT_DIR=self.output_dir,
+        )
+
+    def cleanup(self):
+        if self.root is None or config['model']['workspace']['keep']:
+            return
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -1,4 +1,1043 @@
+import json
+import os
+import stat
+import struct
 import subprocess
+import tempfile
+from dataclasses import asdict
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+import netCDF4 as nc
+import numpy as np
+from django.db.models import Count
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from app.models import MapData, MapRiskSummary, ModelRunCache, Project, ProjectJob, StationData
+from app.repository.app_repository import AppRepository, load_mesh_geometry, ensure_mesh_face_index
+from app.renderers import iter_json_bytes, json_response
+from app.request import ExportHistoryMapRequest, ExportMapRequest, ExportStationRequest, HandleMapRequest, \
+    RunProjectRequest
+from app.service.app_service import AppService
+from app.service.cache import response_cache, TAG_PROJECT
+from app.service.extent import extent_feature_collection
+from app.service.job import JobRunner
+from app.service.mesh import MAX_LOD, sort_vertices, sort_vertices_batch, build_geometry, tile_lod
+from app.service.reader import MapReader, iter_wet_face_rows
+from app.service.tiles import project_to_tile, tile_bounds
+from app.tools import encode_cursor, timestamp_to_datetime, to_timestamp
+from hydrologic_forecasting.settings import config
+
+
+def write_map_files(output_dir, nx=6, ny=5, times=26, seed=0):
+    """
+    生成模型输出的网格结果文件和风险等级文件：三角网格和顶点顺序打乱的四角网格
+    """
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.linspace(119.0, 119.05, nx), np.linspace(32.0, 32.04, ny))
+    node_x = (x + rng.normal(0, 1e-4, x.shape)).ravel()
+    node_y = (y + rng.normal(0, 1e-4, y.shape)).ravel()
+    faces = []
+    for row in range(ny - 1):
+        for col in range(nx - 1):
+            a, b, c, d = row * nx + col + 1, row * nx + col + 2, (row + 1) * nx + col + 2, (row + 1) * nx + col + 1
+            if (row + col) % 3 == 0:
+                faces.extend([[a, b, c, -999], [a, c, d, -999]])
+            else:
+                faces.append(rng.permutation([a, b, c, d]).tolist())
+    faces = np.array(faces)
+    water_depth = np.clip(rng.normal(0.2, 0.3, (times, len(faces))), 0, None)
+    risk = np.digitize(water_depth, [0.27, 0.4, 0.6]) + 1
+
+    with nc.Dataset(os.path.join(output_dir, 'FlowFM_map.nc'), 'w') as dataset:
+        dataset.createDimension('time', times)
+        dataset.createDimension('nNodes', len(node_x))
+        dataset.createDimension('nFaces', len(faces))
+        dataset.createDimension('maxNodes', 4)
+        dataset.createVariable('mesh2d_node_x', 'f8', ('nNodes',))[:] = node_x
+        dataset.createVariable('mesh2d_node_y', 'f8', ('nNodes',))[:] = node_y
+        dataset.createVariable('mesh2d_face_nodes', 'i4', ('nFaces', 'maxNodes'), fill_value=-999)[:] = \
+            np.ma.masked_equal(faces, -999)
+        dataset.createVariable('time', 'f8', ('time',))[:] = 649296000 + 3600 * np.arange(times)
+        dataset.createVariable('mesh2d_waterdepth', 'f8', ('time', 'nFaces'))[:] = water_depth
+    with nc.Dataset(os.path.join(output_dir, 'Modified_FlowFM_clm.nc'), 'w') as dataset:
+        dataset.createDimension('time', times)
+        dataset.createDimension('nFaces', len(faces))
+        dataset.createVariable('mesh2d_waterdepth', 'f8', ('time', 'nFaces'))[:] = risk
+
+
+def write_station_file(output_dir, stations=3, times=26, seed=0):
+    """
+    生成模型输出的站点结果文件
+    """
+    rng = np.random.default_rng(seed)
+    with nc.Dataset(os.path.join(output_dir, 'FlowFM_his.nc'), 'w') as dataset:
+        dataset.createDimension('time', times)
+        dataset.createDimension('stations', stations)
+        dataset.createDimension('nameLength', 8)
+        dataset.createVariable('station_x_coordinate', 'f8', ('stations',))[:] = rng.uniform(119.0, 119.05, stations)
+        dataset.createVariable('station_y_coordinate', 'f8', ('stations',))[:] = rng.uniform(32.0, 32.04, stations)
+        dataset.createVariable('station_name', 'S1', ('stations', 'nameLength'))[:] = \
+            np.array([list(f'ST {i:02d}'.ljust(8)) for i in range(stations)], dtype='S1')
+        dataset.createVariable('time', 'f8', ('time',))[:] = 649296000 + 3600 * np.arange(times)
+        for name in ('waterdepth', 'waterlevel', 'velocity_magnitude'):
+            dataset.createVariable(name, 'f8', ('time', 'stations'))[:] = rng.uniform(0, 5, (times, stations))
+
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def decode_fields(data):
+    """
+    解码 protobuf 消息，返回 [(字段号, 值)]，长度分隔的字段为 bytes，32位字段为 float
+    """
+    fields = []
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value, pos = bytes(data[pos:pos + length]), pos + length
+        elif wire_type == 5:
+            value, pos = struct.unpack('<f', data[pos:pos + 4])[0], pos + 4
+        else:
+            raise ValueError(f'不支持的类型：{wire_type}')
+        fields.append((number, value))
+    return fields
+
+
+def read_packed(data):
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def decode_tile_geometry(data):
+    """
+    把矢量切片的几何命令还原为环的顶点坐标
+    """
+    values = read_packed(data)
+    rings = []
+    x = y = i = 0
+    while i < len(values):
+        command_id, count = values[i] & 7, values[i] >> 3
+        i += 1
+        if command_id == 7:
+            continue
+        if command_id == 1:
+            rings.append([])
+        for _ in range(count):
+            dx, dy = values[i], values[i + 1]
+            x += (dx >> 1) ^ -(dx & 1)
+            y += (dy >> 1) ^ -(dy & 1)
+            rings[-1].append((x, y))
+            i += 2
+    return rings
+
+
+class SortVerticesBatchTest(SimpleTestCase):
+    """
+    sort_vertices_batch 与逐个网格调用 sort_vertices 的结果一致
+    """
+
+    def assert_same_as_sort_vertices(self, node_x, node_y, nodes):
+        counts = (nodes >= 0).sum(axis=1)
+        result = sort_vertices_batch(node_x, node_y, nodes, counts)
+        for i, (face_node, count) in enumerate(zip(nodes, counts)):
+            node = face_node[:count]
+            # 原来逐个网格处理时，三角网格保持原始顺序，四角网格用 sort_vertices 排序
+            expected = node[sort_vertices(node_x[node], node_y[node])] if count == 4 else node
+            with self.subTest(face=i, nodes=node.tolist()):
+                np.testing.assert_array_equal(node_x[result[i, :count]], node_x[expected])
+                np.testing.assert_array_equal(node_y[result[i, :count]], node_y[expected])
+                np.testing.assert_array_equal(result[i, count:], -1)
+
+    def test_mixed_mesh(self):
+        node_x = np.array([0, 1, 1, 0, 2, 2, 3, 0.5, 4, 5, 6, 7,
+                           113.86085031, 113.86083196, 113.85659267, 113.8577512])
+        node_y = np.array([0, 0, 1, 1, 0, 1, 0, 0.5, 4, 5, 6, 7,
+                           22.52566799, 22.52892391, 22.52876978, 22.52475916])
+        nodes = np.array([
+            [0, 1, 2, 3],  # 逆时针四角网格
+            [1, 4, 5, 2],
+            [3, 2, 1, 0],  # 顺时针四角网格
+            [0, 2, 1, 3],  # 自相交的顶点顺序
+            [15, 13, 12, 14],  # 实际坐标
+            [4, 6, 5, -1],  # 三角网格
+            [0, 2, 3, -1],
+            [2, 0, 1, -1],
+            [0, 0, 1, 2],  # 重复顶点
+            [3, 3, 3, 3],  # 所有顶点相同
+            [8, 10, 9, 11],  # 共线
+            [0, 7, 2, 1],  # 质心与顶点重合
+            [0, 1, 4, -1],  # 共线的三角网格
+        ])
+        self.assert_same_as_sort_vertices(node_x, node_y, nodes)
+
+    def test_random_mesh(self):
+        rng = np.random.default_rng(0)
+        node_x = rng.uniform(113.8, 113.9, 200)
+        node_y = rng.uniform(22.5, 22.6, 200)
+        nodes = np.stack([rng.choice(200, 4, replace=False) for _ in range(500)])
+        nodes[rng.random(500) < 0.3, 3] = -1
+        self.assert_same_as_sort_vertices(node_x, node_y, nodes)
+
+
+def signed_area(ring):
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:])) / 2
+
+
+class ExtentDissolveTest(SimpleTestCase):
+    """
+    相邻且风险等级相同的网格合并为一个环，风险等级不同的网格单独输出
+    """
+
+    @staticmethod
+    def grid(columns, rows):
+        node_x, node_y = np.meshgrid(np.arange(columns + 1.0), np.arange(rows + 1.0))
+        nodes = np.array([[row * (columns + 1) + col, row * (columns + 1) + col + 1,
+                           (row + 1) * (columns + 1) + col + 1, (row + 1) * (columns + 1) + col]
+                          for row in range(rows) for col in range(columns)])
+        # 部分网格顶点为顺时针
+        nodes[::2] = nodes[::2, ::-1]
+        return build_geometry(node_x.ravel(), node_y.ravel(), nodes)
+
+    def test_merge_same_risk(self):
+        geometry = self.grid(3, 1)
+        collection = extent_feature_collection(geometry, np.arange(3), np.array([2, 2, 3]))
+        features = {feature['properties']['risk']: feature for feature in collection['features']}
+        self.assertEqual(sorted(features), [2, 3])
+        self.assertEqual(features[2]['properties']['faces'], 2)
+        self.assertEqual(features[3]['properties']['faces'], 1)
+
+        polygons = features[2]['geometry']['coordinates']
+        self.assertEqual(len(polygons), 1)
+        self.assertEqual(len(polygons[0]), 1)
+        ring = polygons[0][0]
+        # 共线的中间顶点去掉，只剩矩形的四个角
+        self.assertEqual(ring[0], ring[-1])
+        self.assertEqual(sorted(ring[:-1]), [[0.0, 0.0], [0.0, 1.0], [2.0, 0.0], [2.0, 1.0]])
+        self.assertEqual(signed_area(ring), 2)
+
+        polygons = features[3]['geometry']['coordinates']
+        self.assertEqual(len(polygons), 1)
+        self.assertEqual(sorted(polygons[0][0][:-1]), [[2.0, 0.0], [2.0, 1.0], [3.0, 0.0], [3.0, 1.0]])
+        self.assertEqual(signed_area(polygons[0][0]), 1)
+
+    def test_hole(self):
+        geometry = self.grid(3, 3)
+        risk = np.full(9, 1)
+        risk[4] = 2
+        collection = extent_feature_collection(geometry, np.arange(9), risk, min_risk=1)
+        polygons = collection['features'][0]['geometry']['coordinates']
+        self.assertEqual(len(polygons), 1)
+        exterior, hole = polygons[0]
+        self.assertEqual(signed_area(exterior), 9)
+        self.assertEqual(signed_area(hole), -1)
+        self.assertEqual(sorted(hole[:-1]), [[1.0, 1.0], [1.0, 2.0], [2.0, 1.0], [2.0, 2.0]])
+        center = collection['features'][1]['geometry']['coordinates']
+        self.assertEqual(len(center), 1)
+        self.assertEqual(sorted(center[0][0][:-1]), sorted(hole[:-1]))
+        self.assertEqual(signed_area(center[0][0]), 1)
+
+
+class MeshLevelTest(SimpleTestCase):
+    """
+    细节层级把相邻网格合并为边长 2**lod 倍的格子，格子取最大水深和最大风险等级
+    """
+
+    def setUp(self):
+        # 4*4 个边长为 1 的四角网格
+        node_x, node_y = np.meshgrid(np.arange(5.0), np.arange(5.0))
+        nodes = np.array([[row * 5 + col, row * 5 + col + 1, row * 5 + col + 6, row * 5 + col + 5]
+                          for row in range(4) for col in range(4)])
+        self.geometry = build_geometry(node_x.ravel(), node_y.ravel(), nodes)
+
+    def test_level(self):
+        self.assertIs(self.geometry.level(0).geometry, self.geometry)
+        level = self.geometry.level(1)
+        self.assertIs(self.geometry.level(1), level)
+        self.assertEqual(len(level.geometry.counts), 4)
+        # 同一个 2*2 块中的网格属于同一个格子
+        cells = level.cells.reshape(4, 4)
+        for row in range(0, 4, 2):
+            for col in range(0, 4, 2):
+                self.assertEqual(len(np.unique(cells[row:row + 2, col:col + 2])), 1)
+        self.assertEqual(len(np.unique(cells)), 4)
+        for cell in range(4):
+            lon, lat = level.geometry.coordinates(cell)
+            self.assertEqual(max(lon) - min(lon), 2)
+            self.assertEqual(max(lat) - min(lat), 2)
+            # 格子覆盖其中的原始网格
+            faces = np.flatnonzero(level.cells == cell)
+            self.assertTrue(np.all(self.geometry.lon[faces] >= min(lon)))
+            self.assertTrue(np.all(self.geometry.lon[faces] <= max(lon)))
+
+        self.assertEqual(len(self.geometry.level(2).geometry.counts), 1)
+        with self.assertRaises(ValueError):
+            self.geometry.level(-1)
+
+    def test_aggregate(self):
+        level = self.geometry.level(1)
+        faces = np.array([0, 1, 5, 15])
+        cells, water_depth, risk = level.aggregate(faces, np.array([0.2, 0.8, 0.4, 1.5]), np.array([3, 1, 2, 4]))
+        self.assertEqual(sorted(cells.tolist()), sorted({level.cells[0], level.cells[15]}))
+        result = dict(zip(cells.tolist(), zip(water_depth.tolist(), risk.tolist())))
+        self.assertEqual(result[level.cells[0]], (0.8, 3))
+        self.assertEqual(result[level.cells[15]], (1.5, 4))
+
+    def test_tile_lod(self):
+        self.assertEqual(self.geometry.face_size(), 1)
+        for z in range(0, 12):
+            lod = tile_lod(self.geometry, z)
+            pixel = 360 / (2 ** z * 256)
+            # 格子边长不小于 2 个像素，且是满足条件的最小层级
+            self.assertGreaterEqual(2 ** lod, min(2 * pixel, 2 ** MAX_LOD))
+            if lod > 0:
+                self.assertLess(2 ** (lod - 1), 2 * pixel)
+        self.assertEqual(tile_lod(self.geometry, 8), 0)
+        self.assertEqual(tile_lod(self.geometry, 0), 2)
+
+
+class HistoryMapQueryTest(TestCase):
+    """
+    网格时段数据用一次查询读取所有时刻，查询次数与时刻数无关
+    """
+
+    def setUp(self):
+        load_mesh_geometry.cache_clear()
+        ensure_mesh_face_index.cache_clear()
+        # 2*3 个四角网格
+        node_x, node_y = np.meshgrid(np.arange(4.0), np.arange(3.0))
+        nodes = np.array([[row * 4 + col, row * 4 + col + 1, row * 4 + col + 5, row * 4 + col + 4]
+                          for row in range(2) for col in range(3)])
+        mesh = AppRepository.insert_mesh('history-map', build_geometry(node_x.ravel(), node_y.ravel(), nodes))
+        self.project = Project.objects.create(name='history-map', description='', mesh=mesh)
+        self.timestamps = [1720000000 + 3600 * i for i in range(5)]
+        MapData.objects.bulk_create([
+            MapData(project=self.project, face_index=face, water_depth=0.1 * (face + 1), risk=face % 3,
+                    timestamp=timestamp)
+            for timestamp in self.timestamps for face in range(len(nodes))
+        ])
+        # 网格几何数据读取后缓存在内存中，不计入每次查询
+        AppRepository.get_mesh_geometry(mesh.id)
+        ensure_mesh_face_index(mesh.id)
+
+    def test_get_history_map(self):
+        for bbox in (None, (0.5, 0.5, 1.5, 1.5)):
+            with self.subTest(bbox=bbox), self.assertNumQueries(1):
+                data = AppRepository.get_history_map(self.project, bbox)
+            self.assertEqual(len(data), len(self.timestamps))
+
+    def test_get_history_map_indexed(self):
+        for bbox in (None, (0.5, 0.5, 1.5, 1.5)):
+            with self.subTest(bbox=bbox), self.assertNumQueries(1):
+                data = AppRepository.get_history_map_indexed(self.project, bbox)
+            self.assertEqual(len(data['times']), len(self.timestamps))
+            self.assertEqual(data['geometry']['faces'], list(range(6)) if bbox is None else [0, 1, 3, 4])
+
+
+class MapPointTest(TestCase):
+    """
+    查找点所在的网格：网格内、网格外、两个网格共用的边上
+    """
+
+    def setUp(self):
+        load_mesh_geometry.cache_clear()
+        ensure_mesh_face_index.cache_clear()
+        # 2*3 个四角网格，第 0 行顶点为顺时针
+        node_x, node_y = np.meshgrid(np.arange(4.0), np.arange(3.0))
+        nodes = np.array([[row * 4 + col, row * 4 + col + 1, row * 4 + col + 5, row * 4 + col + 4]
+                          for row in range(2) for col in range(3)])
+        nodes[:3] = nodes[:3, ::-1]
+        self.geometry = build_geometry(node_x.ravel(), node_y.ravel(), nodes)
+        mesh = AppRepository.insert_mesh('map-point', self.geometry)
+        self.project = Project.objects.create(name='map-point', description='', mesh=mesh)
+        self.timestamps = [649296000, 649299600]
+        MapData.objects.bulk_create([
+            MapData(project=self.project, face_index=4, water_depth=0.5, risk=2, timestamp=self.timestamps[0]),
+            MapData(project=self.project, face_index=0, water_depth=0.3, risk=1, timestamp=self.timestamps[1]),
+        ])
+
+    def point(self, lon, lat):
+        return self.client.post('/api/v1/map/point', content_type='application/json',
+                                data={'lon': lon, 'lat': lat, 'project_id': self.project.id}).json()
+
+    def test_locate(self):
+        self.assertEqual(self.geometry.locate(1.5, 1.5), 4)
+        self.assertEqual(self.geometry.locate(0.2, 0.7), 0)
+        self.assertEqual(self.geometry.locate(-0.5, 1.0), -1)
+        self.assertEqual(self.geometry.locate(1.5, 2.5), -1)
+        # 共用边上的点只属于其中一个网格
+        self.assertIn(self.geometry.locate(1.0, 0.5), (0, 1))
+        self.assertIn(self.geometry.locate(2.5, 1.0), (2, 5))
+
+    def test_point(self):
+        response = self.point(1.5, 1.5)
+        self.assertEqual(response['code'], 0)
+        data = response['data']
+        self.assertEqual(data['face'], 4)
+        self.assertEqual(sorted(data['coordinates']), [[1.0, 1.0], [1.0, 2.0], [2.0, 1.0], [2.0, 2.0]])
+        # 水深低于最小水深的时刻没有网格数据，水深和风险等级为0
+        self.assertEqual([(item['waterDepth'], item['risk']) for item in data['times']], [(0.5, 2), (0, 0)])
+
+    def test_point_outside(self):
+        response = self.point(5.0, 5.0)
+        self.assertEqual(response['code'], -1)
+        self.assertIn('不在网格范围内', response['error'])
+
+    def test_point_on_shared_edge(self):
+        data = self.point(1.5, 1.0)['data']
+        self.assertIn(data['face'], (1, 4))
+        self.assertEqual(data['face'], self.geometry.locate(1.5, 1.0))
+
+
+class HandleMapLegacyTest(TestCase):
+    """
+    handle_map 与逐网格处理的旧实现保存相同的网格数据
+    """
+
+    def setUp(self):
+        load_mesh_geometry.cache_clear()
+        self.service = AppService()
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.output_dir.cleanup)
+        write_map_files(self.output_dir.name)
+
+    def handle(self, method, date_times=None):
+        project = Project.objects.create(name=method, description='', type=0)
+        getattr(self.service, method)(HandleMapRequest(project_id=project.id), date_times,
+                                      output_dir=self.output_dir.name)
+        project.refresh_from_db()
+        return project
+
+    def legacy_rows(self, project):
+        rows = MapData.objects.filter(project=project).values_list('longitude', 'latitude', 'water_depth', 'risk',
+                                                                   'timestamp')
+        return sorted((tuple(zip(lon, lat)), water_depth, risk, timestamp)
+                      for lon, lat, water_depth, risk, timestamp in rows)
+
+    def indexed_rows(self, project):
+        geometry = AppRepository.get_mesh_geometry(project.mesh_id)
+        rows = MapData.objects.filter(project=project).values_list('face_index', 'water_depth', 'risk', 'timestamp')
+        result = []
+        for face, water_depth, risk, timestamp in rows:
+            nodes = geometry.nodes[face, :geometry.counts[face]]
+            result.append((tuple(zip(geometry.node_x[nodes].tolist(), geometry.node_y[nodes].tolist())),
+                           water_depth, risk, timestamp))
+        return sorted(result)
+
+    def test_same_rows(self):
+        legacy = self.legacy_rows(self.handle('handle_map_legacy'))
+        indexed = self.indexed_rows(self.handle('handle_map'))
+        self.assertGreater(len(legacy), 0)
+        # 类型 0 的方案从第 23 个时刻开始保存
+        self.assertEqual(len({row[3] for row in legacy}), 3)
+        self.assertEqual(legacy, indexed)
+
+    def test_same_rows_with_date_times(self):
+        date_times = [f'2021-08-01 {hour:02d}:00:00' for hour in range(24)] + ['2021-08-02 00:00:00',
+                                                                                 '2021-08-02 01:00:00']
+        legacy = self.legacy_rows(self.handle('handle_map_legacy', date_times))
+        indexed = self.indexed_rows(self.handle('handle_map', date_times))
+        self.assertEqual({row[3] for row in legacy}, {to_timestamp(time) for time in date_times[23:]})
+        self.assertEqual(legacy, indexed)
+
+
+class BulkInsertTest(TestCase):
+    def test_count_skips_duplicates(self):
+        project = Project.objects.create(name='bulk', description='')
+        rows = [(project.id, face, '0.50', 1, 649296000) for face in range(5)]
+        self.assertEqual(AppRepository.insert_map_rows(rows), 5)
+        rows = [(project.id, face, '0.50', 1, 649296000) for face in range(3, 8)]
+        self.assertEqual(AppRepository.insert_map_rows(rows), 3)
+        self.assertEqual(MapData.objects.filter(project=project).count(), 8)
+
+
+class WetFaceRowsTest(SimpleTestCase):
+    def test_pool_same_rows(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            write_map_files(output_dir)
+            paths = os.path.join(output_dir, 'FlowFM_map.nc'), os.path.join(output_dir, 'Modified_FlowFM_clm.nc')
+            with MapReader(*paths) as reader:
+                valid = np.ones(len(reader.mesh()[2]), dtype=bool)
+            timestamps = list(range(649296000, 649296000 + 3600 * 30, 3600))
+            rows = [list(iter_wet_face_rows(*paths, 20, 0.1, valid, 1, timestamps, 2, workers=workers))
+                    for workers in (1, 2)]
+        self.assertEqual([timestamp for timestamp, _ in rows[0]], timestamps[20:26])
+        self.assertEqual(rows[0], rows[1])
+
+
+class ReingestMapTest(TestCase):
+    """
+    重新处理网格文件后，网格数据只包含新的结果，风险等级统计与网格数据一致
+    """
+
+    def setUp(self):
+        load_mesh_geometry.cache_clear()
+        self.service = AppService()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+
+    def handle(self, project, seed):
+        output_dir = os.path.join(self.root, str(seed))
+        os.makedirs(output_dir, exist_ok=True)
+        write_map_files(output_dir, seed=seed)
+        self.service.handle_map(HandleMapRequest(project_id=project.id), output_dir=output_dir)
+
+    def test_reingest(self):
+        project = Project.objects.create(name='reingest', description='', type=0)
+        expected = Project.objects.create(name='expected', description='', type=0)
+        self.handle(project, 0)
+        self.handle(project, 1)
+        self.handle(expected, 1)
+
+        fields = ('face_index', 'water_depth', 'risk', 'timestamp')
+        rows = MapData.objects.filter(project=project).order_by(*fields).values_list(*fields)
+        self.assertEqual(list(rows),
+                         list(MapData.objects.filter(project=expected).order_by(*fields).values_list(*fields)))
+
+        counts = (MapData.objects.filter(project=project).values_list('timestamp', 'risk')
+                  .annotate(count=Count('id')).order_by('timestamp', 'risk'))
+        summary = (MapRiskSummary.objects.filter(project=project).order_by('timestamp', 'risk')
+                   .values_list('timestamp', 'risk', 'count'))
+        self.assertEqual(list(summary), list(counts))
+        self.assertEqual(sum(count for _, _, count in summary), len(rows))
+
+
+class TrendStationConditionalTest(TestCase):
+    """
+    不指定方案时，站点趋势的 ETag 与查询使用同一个方案(最近写入站点数据的方案)
+    """
+
+    def setUp(self):
+        response_cache.invalidate(TAG_PROJECT)
+        self.project = Project.objects.create(name='station', description='')
+        self.add_station_data(0, 2)
+        # 最新的方案没有站点数据
+        Project.objects.create(name='latest', description='')
+
+    def add_station_data(self, start, stop):
+        StationData.objects.bulk_create([
+            StationData(project=self.project, station_name='ST 01', longitude=119.0, latitude=32.0, water_depth=1,
+                        water_level=2, velocity_magnitude=0.5, timestamp=649296000 + 3600 * i)
+            for i in range(start, stop)
+        ])
+        response_cache.invalidate(TAG_PROJECT)
+
+    def trend(self, **headers):
+        return self.client.post('/api/v1/station/trend/ST 01', data=b'{}', content_type='application/json',
+                                headers=headers)
+
+    def test_etag_follows_station_project(self):
+        response = self.trend()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['data']), 2)
+        etag = response['ETag']
+        self.assertEqual(self.trend(if_none_match=etag).status_code, 304)
+
+        self.add_station_data(2, 3)
+        response = self.trend(if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['data']), 3)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_no_station_data(self):
+        StationData.objects.all().delete()
+        response = self.trend()
+        self.assertEqual(response.json(), {'code': 0, 'data': []})
+        self.assertNotIn('ETag', response)
+
+
+class ExportConditionalTest(TestCase):
+    """
+    删除最新的方案后，不指定方案的导出改用较早的方案，旧的 ETag 和 If-Modified-Since 都不会返回 304
+    """
+
+    def setUp(self):
+        response_cache.invalidate(TAG_PROJECT)
+        self.projects = [self.create_project(name, stations) for name, stations in [('old', 2), ('new', 3)]]
+        # 较早的方案最后修改时间更早
+        Project.objects.filter(pk=self.projects[0].pk).update(updated_at=self.projects[1].updated_at - timedelta(days=1))
+
+    @staticmethod
+    def create_project(name, stations):
+        project = Project.objects.create(name=name, description='')
+        StationData.objects.bulk_create([
+            StationData(project=project, station_name=f'ST {i:02d}', longitude=119.0, latitude=32.0, water_depth=1,
+                        water_level=2, velocity_magnitude=0.5, timestamp=649296000)
+            for i in range(stations)
+        ])
+        return project
+
+    def export(self, **headers):
+        response = self.client.post('/api/v1/station/export', data=b'{}', content_type='application/json',
+                                    headers=headers)
+        if response.status_code == 200:
+            response.data = json.loads(b''.join(response.streaming_content))['data']
+        return response
+
+    def test_etag(self):
+        response = self.export()
+        self.assertEqual(len(response.data), 3)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(self.export(if_none_match=etag).status_code, 304)
+        # 只有 If-Modified-Since 时不返回 304
+        self.assertEqual(self.export(if_modified_since=last_modified).status_code, 200)
+
+        self.projects[1].delete()
+        response_cache.invalidate(TAG_PROJECT)
+        for headers in [{'if_none_match': etag}, {'if_modified_since': last_modified},
+                        {'if_none_match': etag, 'if_modified_since': last_modified}]:
+            response = self.export(**headers)
+            self.assertEqual(response.status_code, 200, headers)
+            self.assertEqual(len(response.data), 2)
+            self.assertNotEqual(response['ETag'], etag)
+
+
+class ExportCacheTest(TestCase):
+    """
+    导出接口按方案、数据版本和查询条件缓存；其他进程写入数据(本进程的缓存没有失效)后数据版本变化，不会读到旧的结果
+    """
+
+    def setUp(self):
+        load_mesh_geometry.cache_clear()
+        ensure_mesh_face_index.cache_clear()
+        response_cache.invalidate(TAG_PROJECT)
+        node_x, node_y = np.meshgrid(np.arange(4.0), np.arange(3.0))
+        nodes = np.array([[row * 4 + col, row * 4 + col + 1, row * 4 + col + 5, row * 4 + col + 4]
+                          for row in range(2) for col in range(3)])
+        mesh = AppRepository.insert_mesh('export-cache', build_geometry(node_x.ravel(), node_y.ravel(), nodes))
+        self.project = Project.objects.create(name='export-cache', description='', mesh=mesh)
+        self.add_map_data(range(3))
+
+    def add_map_data(self, faces):
+        MapData.objects.bulk_create([
+            MapData(project=self.project, face_index=face, water_depth=0.1 * (face + 1), risk=face % 3,
+                    timestamp=1720000000)
+            for face in faces
+        ])
+
+    def export(self, **headers):
+        response = self.client.post('/api/v1/map/export', data=b'{}', content_type='application/json',
+                                    headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_stream(self):
+        query_map = AppService.query_map
+        with mock.patch.object(AppService, 'query_map', autospec=True, side_effect=query_map) as query:
+            first = self.export()
+            self.assertEqual(self.export(), first)
+            self.assertEqual(query.call_count, 1)
+
+            self.add_map_data([3, 4])
+            data = json.loads(self.export())['data']
+            self.assertEqual(query.call_count, 2)
+        self.assertEqual(len(json.loads(first)['data']), 3)
+        self.assertEqual(len(data), 5)
+
+    def test_binary(self):
+        query_map_columns = AppService.query_map_columns
+        with mock.patch.object(AppService, 'query_map_columns', autospec=True, side_effect=query_map_columns) as query:
+            first = self.export(accept='application/octet-stream')
+            self.assertEqual(self.export(accept='application/octet-stream'), first)
+            self.assertEqual(query.call_count, 1)
+
+            self.add_map_data([3, 4])
+            self.assertNotEqual(self.export(accept='application/octet-stream'), first)
+            self.assertEqual(query.call_count, 2)
+
+
+class MapTileTest(TestCase):
+    """
+    矢量切片解码后的图层、要素几何和属性与网格数据一致；没有网格的切片为空
+    """
+    z, x, y = 14, 13626, 6647
+
+    def setUp(self):
+        load_mesh_geometry.cache_clear()
+        ensure_mesh_face_index.cache_clear()
+        # 切片中间的两个相邻四角网格
+        west, south, east, north = tile_bounds(self.z, self.x, self.y, buffer=0)
+        lon = west + (east - west) * np.array([0.25, 0.5, 0.75])
+        lat = south + (north - south) * np.array([0.25, 0.75])
+        node_x, node_y = np.meshgrid(lon, lat)
+        nodes = np.array([[0, 1, 4, 3], [1, 2, 5, 4]])
+        self.geometry = build_geometry(node_x.ravel(), node_y.ravel(), nodes)
+        mesh = AppRepository.insert_mesh('map-tile', self.geometry)
+        self.project = Project.objects.create(name='map-tile', description='', mesh=mesh)
+        MapData.objects.bulk_create([
+            MapData(project=self.project, face_index=0, water_depth=0.35, risk=2, timestamp=649296000),
+            MapData(project=self.project, face_index=1, water_depth=1.2, risk=4, timestamp=649296000),
+        ])
+
+    def tile(self, x, y):
+        response = self.client.get(f'/api/v1/map/tiles/{self.project.id}/649296000/{self.z}/{x}/{y}')
+        self.assertEqual(response.status_code, 200)
+        return response.content
+
+    def test_tile(self):
+        tile = decode_fields(self.tile(self.x, self.y))
+        self.assertEqual([number for number, _ in tile], [3])
+        layer = decode_fields(tile[0][1])
+        self.assertIn((15, 2), layer)
+        self.assertIn((1, b'flood'), layer)
+        self.assertIn((5, 4096), layer)
+        keys = [value.decode() for number, value in layer if number == 3]
+        values = [decode_fields(value)[0][1] for number, value in layer if number == 4]
+        self.assertEqual(keys, ['waterDepth', 'risk'])
+
+        features = {}
+        for number, value in layer:
+            if number != 2:
+                continue
+            feature = dict(decode_fields(value))
+            self.assertEqual(feature[3], 3)
+            tags = read_packed(feature[2])
+            properties = {keys[key]: values[index] for key, index in zip(tags[::2], tags[1::2])}
+            features[feature[1]] = properties, decode_tile_geometry(feature[4])
+        self.assertEqual(sorted(features), [0, 1])
+
+        for face, depth, risk in [(0, 0.35, 2), (1, 1.2, 4)]:
+            properties, rings = features[face]
+            self.assertAlmostEqual(properties['waterDepth'], depth, places=5)
+            self.assertEqual(properties['risk'], risk)
+            self.assertEqual(len(rings), 1)
+            px, py = project_to_tile(self.geometry.node_x[self.geometry.nodes[face]],
+                                     self.geometry.node_y[self.geometry.nodes[face]], self.z, self.x, self.y)
+            self.assertEqual(sorted(rings[0]), sorted(zip(px.tolist(), py.tolist())))
+            # 外环在切片坐标(y 向下)中顺时针，面积为正
+            ring = rings[0]
+            area = sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1]))
+            self.assertGreater(area, 0)
+
+    def test_empty_tile(self):
+        self.assertEqual(self.tile(self.x + 4, self.y), b'')
+
+
+class ForewarningCursorTest(TestCase):
+    """
+    游标分页逐页读取所有数据，(风险等级, 水深) 相同的行不会遗漏或重复；无效的游标返回 400
+    """
+
+    def setUp(self):
+        load_mesh_geometry.cache_clear()
+        ensure_mesh_face_index.cache_clear()
+        response_cache.invalidate(TAG_PROJECT)
+        node_x, node_y = np.meshgrid(np.arange(4.0), np.arange(3.0))
+        nodes = np.array([[row * 4 + col, row * 4 + col + 1, row * 4 + col + 5, row * 4 + col + 4]
+                          for row in range(2) for col in range(3)])
+        mesh = AppRepository.insert_mesh('forewarning', build_geometry(node_x.ravel(), node_y.ravel(), nodes))
+        self.project = Project.objects.create(name='forewarning', description='', mesh=mesh)
+        # 只有两种水深和两种风险等级，大量的行排序键相同
+        MapData.objects.bulk_create([
+            MapData(project=self.project, face_index=face, water_depth=0.5 * (1 + (face + hour) % 2),
+                    risk=1 + face % 2, timestamp=649296000 + 3600 * hour)
+            for hour in range(5) for face in range(len(nodes))
+        ])
+
+    def page(self, **params):
+        return self.client.get('/api/v1/forewarning/pagination', params)
+
+    def walk(self, size, **params):
+        ids = []
+        cursor = None
+        while True:
+            response = self.page(size=size, **params, **({'cursor': cursor} if cursor else {}))
+            self.assertEqual(response.status_code, 200)
+            data = response.json()['data']
+            self.assertLessEqual(len(data['items']), size)
+            ids += [item['id'] for item in data['items']]
+            cursor = data['next']
+            if cursor is None:
+                return ids, data
+
+    def test_severity_pages(self):
+        expected = list(MapData.objects.filter(project=self.project)
+                        .order_by('-risk', '-water_depth', '-id').values_list('id', flat=True))
+        for size in (1, 4, 7, 30):
+            ids, data = self.walk(size, order='severity')
+            self.assertEqual(ids, expected)
+            self.assertEqual(data['total'], len(expected))
+
+        expected = list(MapData.objects.filter(project=self.project, risk__gte=2, water_depth__gte=1)
+                        .order_by('-risk', '-water_depth', '-id').values_list('id', flat=True))
+        self.assertEqual(self.walk(4, order='severity', min_risk=2, min_water_depth=1)[0], expected)
+
+    def test_id_pages(self):
+        expected = list(MapData.objects.filter(project=self.project).order_by('-id').values_list('id', flat=True))
+        self.assertEqual(self.walk(7)[0], expected)
+
+    def test_invalid_cursor(self):
+        for cursor in ['not a cursor', encode_cursor(['id', 1]), encode_cursor({'id': 'x'}),
+                       encode_cursor({'project': self.project.id, 'order': 'severity', 'before': [2, '1.0']}),
+                       encode_cursor({'project': self.project.id, 'order': 'severity', 'before': [2, 'deep', 1]})]:
+            response = self.page(size=4, cursor=cursor)
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertEqual(response.json()['code'], -1)
+        self.assertEqual(self.client.get('/api/v1/project/pagination', {'cursor': '%%%'}).status_code, 400)
+
+
+def decode_columns(content):
+    """
+    解码 encode_columns 生成的列式数据包
+
+    Returns:
+        tuple: (头部, {列名: ndarray})
+    """
+    assert content[:4] == b'HFC1'
+    length = struct.unpack('<I', content[4:8])[0]
+    header = json.loads(content[8:8 + length])
+    start = (8 + length + 7) // 8 * 8
+    columns = {
+        column['name']: np.frombuffer(content, dtype=column['dtype'], count=int(np.prod(column['shape'])),
+                                      offset=start + column['offset']).reshape(column['shape'])
+        for column in header['columns']
+    }
+    return header, columns
+
+
+class ExportFormatTest(TestCase):
+    """
+    二进制格式(列式数据包、Arrow)解码后、流式输出的 JSON 与一次性编码的 JSON 的行相同
+    """
+
+    def setUp(self):
+        load_mesh_geometry.cache_clear()
+        ensure_mesh_face_index.cache_clear()
+        response_cache.invalidate(TAG_PROJECT)
+        node_x, node_y = np.meshgrid(119.0 + np.arange(4.0) * 0.01, 32.0 + np.arange(3.0) * 0.01)
+        nodes = np.array([[row * 4 + col, row * 4 + col + 1, row * 4 + col + 5, row * 4 + col + 4]
+                          for row in range(2) for col in range(3)])
+        self.geometry = build_geometry(node_x.ravel(), node_y.ravel(), nodes)
+        mesh = AppRepository.insert_mesh('export-format', self.geometry)
+        self.project = Project.objects.create(name='export-format', description='', mesh=mesh)
+        MapData.objects.bulk_create([
+            MapData(project=self.project, face_index=face, water_depth=0.15 * (face + hour + 1), risk=1 + face % 4,
+                    timestamp=649296000 + 3600 * hour)
+            for hour in range(2) for face in range(len(nodes)) if (face + hour) % 3
+        ])
+        StationData.objects.bulk_create([
+            StationData(project=self.project, station_name=f'ST {i:02d}', longitude=119.0 + i * 0.01, latitude=32.0,
+                        water_depth=0.25 * i, water_level=2 + 0.5 * i, velocity_magnitude=0.1 * i,
+                        timestamp=649296000 + 3600 * hour)
+            for hour in range(2) for i in range(3)
+        ])
+
+    def post(self, path, accept=None):
+        return self.client.post(path, data=json.dumps({'project_id': self.project.id}),
+                                content_type='application/json', headers={'accept': accept} if accept else {})
+
+    def json_rows(self, export, clazz):
+        """
+        一次性编码的 JSON 结果
+        """
+        data = export(clazz(project_id=self.project.id))
+        return json.loads(json_response({'code': 0, 'data': data}).content)['data']
+
+    def map_rows(self, rows):
+        return sorted((tuple(map(tuple, row['coordinates'])), round(float(row['waterDepth']), 2), row['risk'],
+                       row['time']) for row in rows)
+
+    def map_column_rows(self, columns):
+        return sorted((tuple(map(tuple, self.geometry.lat_lon(face))), round(float(depth), 2), risk,
+                       timestamp_to_datetime(timestamp))
+                      for face, depth, risk, timestamp in zip(columns['face'].tolist(), columns['waterDepth'].tolist(),
+                                                              columns['risk'].tolist(), columns['timestamp'].tolist()))
+
+    @staticmethod
+    def station_rows(rows):
+        return sorted((row['stationName'], row['lon'], row['lat'], round(float(row['waterDepth']), 2),
+                       round(float(row['waterLevel']), 2), round(float(row['velocityMagnitude']), 2), row['time'])
+                      for row in rows)
+
+    @staticmethod
+    def station_column_rows(stations, columns):
+        return sorted((stations[station], lon, lat, round(depth, 2), round(level, 2), round(velocity, 2),
+                       timestamp_to_datetime(timestamp))
+                      for station, lon, lat, depth, level, velocity, timestamp in zip(
+                          *(columns[name].tolist() for name in ('station', 'lon', 'lat', 'waterDepth', 'waterLevel',
+                                                                'velocityMagnitude', 'timestamp'))))
+
+    def test_columns(self):
+        expected = self.json_rows(AppService().export_map, ExportMapRequest)
+        self.assertEqual(len(expected), 4)
+        response = self.post('/api/v1/map/export', 'application/octet-stream')
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        header, columns = decode_columns(response.content)
+        self.assertEqual(header['projectId'], self.project.id)
+        self.assertEqual(self.map_column_rows(columns), self.map_rows(expected))
+
+        expected = self.json_rows(AppService().export_station, ExportStationRequest)
+        self.assertEqual(len(expected), 3)
+        header, columns = decode_columns(self.post('/api/v1/station/export', 'application/octet-stream').content)
+        self.assertEqual(self.station_column_rows(header['stations'], columns), self.station_rows(expected))
+
+    def test_stream(self):
+        for path, export, clazz in [('/api/v1/map/export', AppService().export_map, ExportMapRequest),
+                                    ('/api/v1/station/export', AppService().export_station, ExportStationRequest)]:
+            response = self.post(path)
+            self.assertTrue(response.streaming)
+            content = b''.join(response.streaming_content)
+            self.assertEqual(json.loads(content), {'code': 0, 'data': self.json_rows(export, clazz)})
+
+        response = self.post('/api/v1/map/history/export')
+        self.assertTrue(response.streaming)
+        data = AppService().export_history_map(ExportHistoryMapRequest(project_id=self.project.id))
+        self.assertEqual(json.loads(b''.join(response.streaming_content)),
+                         json.loads(json_response({'code': 0, 'data': data}).content))
+
+    def test_iter_json(self):
+        value = {'a': iter([1, {'b': iter([2.5, None])}, 'c']), 'd': lambda: iter(range(3)), 'e': [Decimal('1.20')]}
+        expected = {'a': [1, {'b': [2.5, None]}, 'c'], 'd': [0, 1, 2], 'e': [Decimal('1.20')]}
+        self.assertEqual(json.loads(b''.join(iter_json_bytes(value, chunk_size=4))),
+                         json.loads(json_response(expected).content))
+
+    def test_arrow(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            self.skipTest('没有安装pyarrow')
+        response = self.post('/api/v1/map/export', 'application/vnd.apache.arrow.stream')
+        table = pa.ipc.open_stream(response.content).read_all()
+        self.assertEqual(json.loads(table.schema.metadata[b'projectId']), self.project.id)
+        columns = {name: np.asarray(table.column(name)) for name in table.column_names}
+        expected = self.json_rows(AppService().export_map, ExportMapRequest)
+        self.assertEqual(self.map_column_rows(columns), self.map_rows(expected))
+
+
+class JobRunnerTest(TransactionTestCase):
+    """
+    用替代模型的脚本运行任务：脚本把预先生成的结果文件复制到输出目录
+    """
+
+    def setUp(self):
+        load_mesh_geometry.cache_clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.results = os.path.join(self.root, 'results')
+        os.makedirs(self.results)
+        os.makedirs(os.path.join(self.root, 'input'))
+        write_map_files(self.results)
+        write_station_file(self.results)
+
+        bat_path = os.path.join(self.root, 'run.sh')
+        with open(bat_path, 'w') as file:
+            file.write(f'#!/bin/sh\nset -e\ncp "{self.results}"/*.nc "$HF_OUTPUT_DIR"/\necho done\n')
+        os.chmod(bat_path, os.stat(bat_path).st_mode | stat.S_IEXEC)
+
+        for section, values in [
+            ('script', {'bat_path': bat_path, 'bat_workspace': '', 'input': os.path.join(self.root, 'input'),
+                        'output': os.path.join(self.root, 'output')}),
+            ('workspace', {'root': os.path.join(self.root, 'runs'), 'keep': False}),
+            ('cache', {'root': os.path.join(self.root, 'cache')}),
+        ]:
+            patcher = mock.patch.dict(config['model'][section], values)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_job(self):
+        service = AppService()
+        water_level = [{'datetime': f'2021-07-{1 + hour // 24:02d} {hour % 24:02d}:00:00', 'data': 1.5}
+                       for hour in range(48)]
+        req = RunProjectRequest(name='job', description='', forecast_period=24, start_time='2021-07-01 00:00:00',
+                                upstream_water_level=water_level, downstream_water_level=water_level)
+        job_id = AppRepository.insert_job(asdict(req))
+        JobRunner.run(job_id, lambda timer: service.run_project(req, timer))
+        return ProjectJob.objects.get(pk=job_id)
+
+    def test_run(self):
+        job = self.run_job()
+        self.assertEqual(job.status, ProjectJob.STATUS_SUCCEEDED, job.error)
+        self.assertEqual(job.output, 'done\n')
+        self.assertEqual(set(job.stages), {'input', 'model', 'map', 'station', 'cache'})
+        self.assertIsNotNone(job.finished_at)
+        self.assertGreater(MapData.objects.filter(project=job.project).count(), 0)
+        self.assertEqual(StationData.objects.filter(project=job.project).count(), 3 * 2)
+
+    def test_failed_job_keeps_project(self):
+        os.remove(os.path.join(self.results, 'FlowFM_his.nc'))
+        job = self.run_job()
+        self.assertEqual(job.status, ProjectJob.STATUS_FAILED)
+        self.assertEqual(job.stage, 'station')
+        # 方案在处理网格数据前已经创建，任务失败时也记录在任务中
+        self.assertIsNotNone(job.project)
+        self.assertGreater(MapData.objects.filter(project=job.project).count(), 0)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'runs')), [])
+
+    def test_workspace_removed(self):
+        self.assertEqual(self.run_job().status, ProjectJob.STATUS_SUCCEEDED)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'runs')), [])
+
+        with open(config['model']['script']['bat_path'], 'w') as file:
+            file.write('#!/bin/sh\necho failed >&2\nexit 1\n')
+        job = self.run_job()
+        self.assertEqual(job.status, ProjectJob.STATUS_FAILED)
+        self.assertEqual(job.stage, 'model')
+        self.assertEqual(job.error, 'failed\n')
+        self.assertEqual(os.listdir(os.path.join(self.root, 'runs')), [])
+
+    def test_cache_hit_clones_project(self):
+        first = self.run_job()
+        with mock.patch('app.service.app_service.subprocess.run') as run:
+            second = self.run_job()
+        run.assert_not_called()
+        self.assertEqual(second.status, ProjectJob.STATUS_SUCCEEDED, second.error)
+        self.assertEqual(second.output, 'done\n')
+        self.assertEqual(set(second.stages), {'input', 'cache'})
+        self.assertNotEqual(second.project_id, first.project_id)
+        fields = ('face_index', 'water_depth', 'risk', 'timestamp')
+        self.assertEqual(list(MapData.objects.filter(project=second.project).order_by('id').values_list(*fields)),
+                         list(MapData.objects.filter(project=first.project).order_by('id').values_list(*fields)))
+        self.assertEqual(os.listdir(os.path.join(self.root, 'runs')), [])
+
+    def test_cache_hit_reads_cached_files(self):
+        first = self.run_job()
+        first.project.delete()
+        with mock.patch('app.service.app_service.subprocess.run') as run:
+            second = self.run_job()
+        run.assert_not_called()
+        self.assertEqual(second.status, ProjectJob.STATUS_SUCCEEDED, second.error)
+        self.assertEqual(set(second.stages), {'input', 'map', 'station'})
+        self.assertGreater(MapData.objects.filter(project=second.project).count(), 0)
+        self.assertEqual(StationData.objects.filter(project=second.project).count(), 3 * 2)
+        self.assertEqual(ModelRunCache.objects.get().project_id, second.project_id)
+
+    def test_recover(self):
+        runner = JobRunner(1)
+        self.addCleanup(runner.executor.shutdown)
+        statuses = [ProjectJob.STATUS_PENDING, ProjectJob.STATUS_RUNNING, ProjectJob.STATUS_SUCCEEDED]
+        stale = [ProjectJob.objects.create(status=status) for status in statuses]
+        ProjectJob.objects.filter(pk__in=[job.pk for job in stale]).update(
+            created_at=runner.started_at - timedelta(minutes=1))
+        # 启动后创建的任务由当前进程执行，不受影响
+        current = ProjectJob.objects.create(status=ProjectJob.STATUS_RUNNING)
+
+        runner.recover()
+        runner.recover()
+        self.assertEqual([ProjectJob.objects.get(pk=job.pk).status for job in stale],
+                         [ProjectJob.STATUS_FAILED, ProjectJob.STATUS_FAILED, ProjectJob.STATUS_SUCCEEDED])
+        self.assertEqual(ProjectJob.objects.get(pk=stale[0].pk).error, '服务重启，任务已中断')
+        self.assertEqual(ProjectJob.objects.get(pk=current.pk).status, ProjectJob.STATUS_RUNNING)
+
 
 if __name__ == '__main__':
     bat_path = ''
@@ -1,8 +1,11 @@
+import base64
 import glob
+import json
 import logging
 import os.path
 import re
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 import requests
 
@@ -25,9 +28,26 @@ def datetime_to_timestamp(time_string):
     return int(time_diff.total_seconds())
 
 
+def to_timestamp(timestamp):
+    """
+    Converts a datetime string or a model time value to a timestamp.
+
+    Args:
+        timestamp (str or float): The datetime string or the seconds since 2001-01-01.
+
+    Returns:
+        int: The timestamp. Example: 649382400
+    """
+    if isinstance(timestamp, str):
+        return datetime_to_timestamp(timestamp)
+    return int(timestamp)
+
+
+@lru_cache(maxsize=4096)
 def timestamp_to_datetime(timestamp_seconds):
     """
     Converts a timestamp in seconds into a datetime string.
+    Results are memoized, an export only contains a few distinct timestamps.
 
     Args:
         timestamp_seconds (int): The timestamp in seconds.
@@ -40,6 +60,82 @@ def timestamp_to_datetime(timestamp_seconds):
     return target_time.strftime("%Y-%m-%d %H:%M:%S")
 
 
+def encode_cursor(data):
+    """
+    Encodes pagination state into an opaque url-safe cursor.
+
+    Args:
+        data (dict): The pagination state. Example: {'project': 1, 'id': 2048}
+
+    Returns:
+        str: The cursor.
+    """
+    text = json.dumps(data, separators=(',', ':'), sort_keys=True)
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+class InvalidCursorError(ValueError):
+    """
+    Raised when a pagination cursor cannot be decoded.
+    """
+
+
+def decode_cursor(cursor, fields=None):
+    """
+    Decodes a cursor created by encode_cursor.
+
+    Args:
+        cursor (str): The cursor.
+        fields (dict): Converters of the expected fields. Example: {'id': int}
+            Fields that are present and not null are converted, a converter raising ValueError or TypeError
+            makes the cursor invalid.
+
+    Returns:
+        dict: The pagination state.
+
+    Raises:
+        InvalidCursorError: The cursor is malformed.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise InvalidCursorError(f'无效的分页游标：{cursor}')
+    if not isinstance(data, dict):
+        raise InvalidCursorError(f'无效的分页游标：{cursor}')
+    for name, convert in (fields or {}).items():
+        if data.get(name) is None:
+            continue
+        try:
+            data[name] = convert(data[name])
+        except (ValueError, TypeError):
+            raise InvalidCursorError(f'无效的分页游标：{cursor}')
+    return data
+
+
+def parse_bbox(bbox):
+    """
+    Parses a bounding box given as a list or a comma separated string.
+
+    Args:
+        bbox (list or str): [min_lon, min_lat, max_lon, max_lat]. Example: '119.40,32.10,119.50,32.20'
+
+    Returns:
+        tuple: (min_lon, min_lat, max_lon, max_lat), None if bbox is empty.
+    """
+    if bbox is None or bbox == '':
+        return None
+    if isinstance(bbox, str):
+        bbox = bbox.split(',')
+    try:
+        min_x, min_y, max_x, max_y = (float(value) for value in bbox)
+    except (TypeError, ValueError):
+        raise ValueError(f'无效的范围：{bbox}')
+    if not min_x <= max_x or not min_y <= max_y:
+        raise ValueError(f'无效的范围：{bbox}')
+    return min_x, min_y, max_x, max_y
+
+
 def search_file(directory, pattern):
     """
     Search a directory for all files matching a pattern.
@@ -88,24 +184,28 @@ def download_png():
         raise e
 
 
-def convert_map_data_to_json(data):
-    json_array = []
+def convert_map_data_to_json(data, geometry):
+    return list(iter_map_data_json(data, geometry))
+
+
+def iter_map_data_json(data, geometry):
     for elem in data:
-        json_data = {
+        yield {
             'id': elem[0],
-            'coordinates': [[y, x] for x, y in zip(elem[1], elem[2])],
-            'waterDepth': elem[3],
-            'risk': elem[4],
-            'time': timestamp_to_datetime(elem[5])
+            'coordinates': geometry.lat_lon(elem[1]),
+            'waterDepth': elem[2],
+            'risk': elem[3],
+            'time': timestamp_to_datetime(elem[4])
         }
-        json_array.append(json_data)
-    return json_array
 
 
 def convert_station_data_to_json(data):
-    json_array = []
+    return list(iter_station_data_json(data))
+
+
+def iter_station_data_json(data):
     for elem in data:
-        json_data = {
+        yield {
             'id': elem[0],
             'lon': elem[1],
             'lat': elem[2],
@@ -115,8 +215,6 @@ def convert_station_data_to_json(data):
             'stationName': elem[6],
             'time': timestamp_to_datetime(elem[7]),
         }
-        json_array.append(json_data)
-    return json_array
 
 
 if __name__ == '__main__':
@@ -7,14 +7,25 @@ urlpatterns = [
     path('v1/map/handle', views.handle_map_controller, name='handle_map_controller'),
     path('v1/map/export', views.export_map_controller, name='export_map_controller'),
     path('v1/map/history/export', views.export_history_map_controller, name='export_history_map_controller'),
+    path('v1/map/mesh/<int:project_id>', views.mesh_controller, name='mesh_controller'),
+    path('v1/map/point', views.map_point_controller, name='map_point_controller'),
+    path('v1/map/extent', views.map_extent_controller, name='map_extent_controller'),
+    path('v1/map/tiles/<int:project_id>/<str:time>/<int:z>/<int:x>/<int:y>', views.map_tile_controller,
+         name='map_tile_controller'),
     path('v1/station/handle', views.handle_station_controller, name='handle_station_controller'),
     path('v1/station/export', views.export_station_controller, name='export station'),
     path('v1/station/history/export', views.export_history_station_controller, name='export history station'),
     path('v1/project/run', views.run_project_controller, name='create project'),
+    path('v1/project/submit', views.submit_project_controller, name='submit project'),
+    path('v1/project/job/<int:job_id>', views.job_controller, name='query project job'),
+    path('v1/project/job/list/<int:size>', views.job_list_controller, name='query project job list'),
     path('v1/project/list', views.project_list_controller, name='query project list'),
     path('v1/project/update', views.update_project_controller, name='update project'),
     path('v1/project/delete/<int:project_id>', views.delete_project_controller, name='delete project'),
     path('v1/project/pagination/<int:page>/<int:size>', views.project_pagination_controller, name='project pagination'),
+    path('v1/project/pagination', views.project_cursor_controller, name='project cursor pagination'),
+    path('v1/forewarning/pagination', views.forewarning_cursor_controller, name='forewarning cursor pagination'),
+    path('v1/forewarning/summary', views.forewarning_summary_controller, name='forewarning summary'),
     path('v1/forewarning/pagination/<int:page>/<int:size>', views.forewarning_pagination_controller,
          name='forewarning pagination'),
     path('v1/station/representation', views.representation_station_controller,
@@ -1,15 +1,20 @@
 # Create your views here.
 import json
 
-from django.http import JsonResponse
+from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from drf_spectacular.utils import extend_schema
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, renderer_classes
 
 from app.request import HandleMapRequest, RunProjectRequest, HandleStationRequest, \
     ExportMapRequest, ExportStationRequest, UpdateProjectRequest, ExportHistoryStationRequest, \
-    RepresentationStationRequest, ExportHistoryMapRequest
+    RepresentationStationRequest, ExportHistoryMapRequest, TrendStationRequest, MapPointRequest, \
+    MapExtentRequest
+from app.conditional import conditional
+from app.renderers import EXPORT_RENDERERS, MESH_RENDERERS, TILE_RENDERERS, TileRenderer, is_binary, \
+    binary_response, streaming_json_response, streaming_bytes_response, json_response
 from app.service.app_service import AppService
+from app.tools import InvalidCursorError
 
 service = AppService()
 
@@ -38,7 +43,7 @@ def request_to_object(request, clazz):
 @api_view(['GET'])
 @csrf_exempt
 def ping_controller(request):
-    return JsonResponse({'reply': '🎉🎉🎉 Congratulations! Success visited.'})
+    return json_response({'reply': '🎉🎉🎉 Congratulations! Success visited.'})
 
 
 @extend_schema(
@@ -51,9 +56,9 @@ def handle_map_controller(request):
         req = request_to_object(request, HandleMapRequest)
         service.handle_map(req)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0})
+        return json_response({'code': 0})
 
 
 @extend_schema(
@@ -66,9 +71,9 @@ def handle_station_controller(request):
         req = request_to_object(request, HandleStationRequest)
         service.handle_station(req)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0})
+        return json_response({'code': 0})
 
 
 @extend_schema(
@@ -82,11 +87,57 @@ def run_project_controller(request):
     """
     try:
         req = request_to_object(request, RunProjectRequest)
-        primary_key = service.run_project(req)
+        _, output = service.run_project(req)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': primary_key})
+        return json_response({'code': 0, 'data': output})
+
+
+@extend_schema(
+    summary="提交模型运行任务",
+)
+@api_view(['POST'])
+@csrf_exempt
+def submit_project_controller(request):
+    """
+    提交模型运行任务，立即返回任务编号
+    """
+    try:
+        req = request_to_object(request, RunProjectRequest)
+        job_id = service.submit_project(req)
+    except Exception as e:
+        return json_response({'code': -1, 'error': str(e)})
+    else:
+        return json_response({'code': 0, 'data': job_id})
+
+
+@extend_schema(
+    summary="查询模型运行任务",
+)
+@api_view(['GET'])
+@csrf_exempt
+def job_controller(request, job_id):
+    try:
+        data = service.get_job(job_id)
+    except Exception as e:
+        return json_response({'code': -1, 'error': str(e)})
+    else:
+        return json_response({'code': 0, 'data': data})
+
+
+@extend_schema(
+    summary="模型运行任务列表",
+)
+@api_view(['GET'])
+@csrf_exempt
+def job_list_controller(request, size):
+    try:
+        data = service.job_list(size)
+    except Exception as e:
+        return json_response({'code': -1, 'error': str(e)})
+    else:
+        return json_response({'code': 0, 'data': data})
 
 
 @extend_schema(
@@ -98,9 +149,9 @@ def project_list_controller(request):
     try:
         data = service.project_list()
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
 
 
 @extend_schema(
@@ -116,9 +167,9 @@ def update_project_controller(request):
         req = request_to_object(request, UpdateProjectRequest)
         service.update_project(req)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0})
+        return json_response({'code': 0})
 
 
 @extend_schema(
@@ -133,54 +184,142 @@ def delete_project_controller(request, project_id):
     try:
         service.delete_project(project_id)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0})
+        return json_response({'code': 0})
 
 
 @extend_schema(
     summary="查询网格数据",
 )
 @api_view(['POST'])
+@renderer_classes(EXPORT_RENDERERS)
 @csrf_exempt
+@conditional(service.data_version)
 def export_map_controller(request):
     try:
         req = request_to_object(request, ExportMapRequest)
-        data = service.export_map(req)
+        if is_binary(request):
+            columns, meta = service.export_map_columns(req)
+            return binary_response(request, columns, meta)
+        chunks = service.stream_map(req)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return streaming_bytes_response(chunks)
 
 
 @extend_schema(
     summary="查询网格时段数据",
 )
 @api_view(['POST'])
+@renderer_classes(EXPORT_RENDERERS)
 @csrf_exempt
+@conditional(service.data_version)
 def export_history_map_controller(request):
     try:
         req = request_to_object(request, ExportHistoryMapRequest)
-        data = service.export_history_map(req)
+        if is_binary(request):
+            columns, meta = service.export_history_map_columns(req)
+            return binary_response(request, columns, meta)
+        data = service.stream_history_map(req)
+    except Exception as e:
+        return json_response({'code': -1, 'error': str(e)})
+    else:
+        return streaming_json_response(data)
+
+
+@extend_schema(
+    summary="查询网格数据的矢量切片",
+)
+@api_view(['GET'])
+@renderer_classes(TILE_RENDERERS)
+@csrf_exempt
+@conditional(service.data_version)
+def map_tile_controller(request, project_id, time, z, x, y):
+    """
+    参数：time 时刻，2001-01-01 起的秒数或 2021-07-30 00:00:00 格式的时间；返回 Mapbox 矢量切片
+    """
+    try:
+        content = service.map_tile(project_id, time, z, x, y)
+    except Exception as e:
+        return json_response({'code': -1, 'error': str(e)})
+    else:
+        return HttpResponse(content, content_type=TileRenderer.media_type)
+
+
+@extend_schema(
+    summary="查询任意位置的网格时段数据",
+)
+@api_view(['POST'])
+@csrf_exempt
+@conditional(service.data_version)
+def map_point_controller(request):
+    try:
+        req = request_to_object(request, MapPointRequest)
+        data = service.map_point(req)
+    except Exception as e:
+        return json_response({'code': -1, 'error': str(e)})
+    else:
+        return json_response({'code': 0, 'data': data})
+
+
+@extend_schema(
+    summary="查询某一时刻按风险等级合并的淹没范围",
+)
+@api_view(['POST'])
+@csrf_exempt
+@conditional(service.data_version)
+def map_extent_controller(request):
+    try:
+        req = request_to_object(request, MapExtentRequest)
+        data = service.map_extent(req)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
 
 
 @extend_schema(
     summary="查询站点数据",
 )
 @api_view(['POST'])
+@renderer_classes(EXPORT_RENDERERS)
 @csrf_exempt
+@conditional(service.data_version)
 def export_station_controller(request):
     try:
         req = request_to_object(request, ExportStationRequest)
-        data = service.export_station(req)
+        if is_binary(request):
+            columns, meta = service.export_station_columns(req)
+            return binary_response(request, columns, meta)
+        chunks = service.stream_station(req)
+    except Exception as e:
+        return json_response({'code': -1, 'error': str(e)})
+    else:
+        return streaming_bytes_response(chunks)
+
+
+@extend_schema(
+    summary="查询方案的网格",
+)
+@api_view(['GET'])
+@renderer_classes(MESH_RENDERERS)
+@csrf_exempt
+@conditional(service.data_version)
+def mesh_controller(request, project_id):
+    """
+    参数：lod 细节层级，为空时返回原始网格
+    """
+    try:
+        columns, meta = service.export_mesh(project_id, optional_param(request, 'lod', int))
+        if is_binary(request):
+            return binary_response(request, columns, meta)
+        data = dict(meta, **{name: array.tolist() for name, array in columns.items()})
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
 
 
 @extend_schema(
@@ -188,14 +327,15 @@ def export_station_controller(request):
 )
 @api_view(['POST'])
 @csrf_exempt
+@conditional(service.data_version)
 def export_history_station_controller(request):
     try:
         req = request_to_object(request, ExportHistoryStationRequest)
         data = service.get_station_by_project_and_station_name(req)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
 
 
 @extend_schema(
@@ -207,9 +347,9 @@ def project_pagination_controller(request, page, size):
     try:
         data = service.project_pagination(page, size)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
 
 
 @extend_schema(
@@ -221,13 +361,96 @@ def forewarning_pagination_controller(request, page, size):
     分页查询实时预警数据
     """
     if request.method == 'POST':
-        return JsonResponse({'code': -1, 'error': 'Unsupported method'})
+        return json_response({'code': -1, 'error': 'Unsupported method'})
     try:
         data = service.forewarning_pagination(page, size)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
+    else:
+        return json_response({'code': 0, 'data': data})
+
+
+@extend_schema(
+    summary="按游标分页查询方案信息",
+)
+@api_view(['GET'])
+@csrf_exempt
+def project_cursor_controller(request):
+    try:
+        size, cursor, total = cursor_params(request)
+        data = service.project_cursor(size, cursor, total)
+    except InvalidCursorError as e:
+        return json_response({'code': -1, 'error': str(e)}, status=400)
+    except Exception as e:
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
+
+
+@extend_schema(
+    summary="按游标分页查询实时预警信息",
+)
+@api_view(['GET'])
+@csrf_exempt
+def forewarning_cursor_controller(request):
+    """
+    按游标分页查询实时预警数据
+
+    参数：size 每页条数，cursor 上一页返回的 next，total=false 时不返回总数，
+    order=severity 时按风险等级、水深倒序，min_risk 最小风险等级，min_water_depth 最小水深
+    """
+    try:
+        size, cursor, total = cursor_params(request)
+        data = service.forewarning_cursor(
+            size, cursor, total,
+            order=request.GET.get('order', 'id'),
+            min_risk=optional_param(request, 'min_risk', int),
+            min_water_depth=optional_param(request, 'min_water_depth', float),
+        )
+    except InvalidCursorError as e:
+        return json_response({'code': -1, 'error': str(e)}, status=400)
+    except Exception as e:
+        return json_response({'code': -1, 'error': str(e)})
+    else:
+        return json_response({'code': 0, 'data': data})
+
+
+@extend_schema(
+    summary="查询每个时刻各风险等级的网格数",
+)
+@api_view(['GET'])
+@csrf_exempt
+def forewarning_summary_controller(request):
+    """
+    参数：project_id 方案编号，为空时使用最新的方案，min_risk 最小风险等级
+    """
+    try:
+        data = service.map_risk_summary(optional_param(request, 'project_id', int),
+                                        optional_param(request, 'min_risk', int))
+    except Exception as e:
+        return json_response({'code': -1, 'error': str(e)})
+    else:
+        return json_response({'code': 0, 'data': data})
+
+
+def cursor_params(request):
+    """
+    读取游标分页的查询参数
+
+    Returns:
+        tuple: (size, cursor, total)
+    """
+    size = int(request.GET.get('size', 20))
+    cursor = request.GET.get('cursor') or None
+    total = request.GET.get('total', 'true').lower() not in ('false', '0')
+    return size, cursor, total
+
+
+def optional_param(request, name, clazz):
+    value = request.GET.get(name)
+    if value is None or value == '':
+        return None
+    return clazz(value)
 
 
 @extend_schema(
@@ -235,14 +458,15 @@ def forewarning_pagination_controller(request, page, size):
 )
 @api_view(['POST'])
 @csrf_exempt
+@conditional(service.data_version)
 def representation_station_controller(request):
     try:
         req = request_to_object(request, RepresentationStationRequest)
         data = service.representation_station(req)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
 
 
 @extend_schema(
@@ -250,13 +474,15 @@ def representation_station_controller(request):
 )
 @api_view(['POST'])
 @csrf_exempt
+@conditional(service.data_version, service.station_project_id)
 def trend_station_controller(request, name):
     try:
-        data = service.trend_station(name)
+        req = request_to_object(request, TrendStationRequest)
+        data = service.trend_station(name, req)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
 
 
 @extend_schema(
@@ -268,9 +494,9 @@ def latest_water_information_controller(request):
     try:
         data = service.latest_water_information()
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
 
 
 @extend_schema(
@@ -282,9 +508,9 @@ def rainfall_series_controller(request, project_id):
     try:
         data = service.get_rainfall_series(project_id=project_id)
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
 
 
 @extend_schema(
@@ -296,6 +522,6 @@ def handle_rainfall_series_controller(request):
     try:
         data = service.handle_rainfall_series()
     except Exception as e:
-        return JsonResponse({'code': -1, 'error': str(e)})
+        return json_response({'code': -1, 'error': str(e)})
     else:
-        return JsonResponse({'code': 0, 'data': data})
+        return json_response({'code': 0, 'data': data})
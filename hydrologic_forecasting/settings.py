@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 import logging
 import os.path
+import sys
+import tempfile
 from pathlib import Path
 
 import yaml
@@ -87,6 +89,12 @@ DATABASES = {
     }
 }
 
+# app 没有提交迁移文件，运行测试时直接按模型建表；接口缓存和切片缓存使用独立的临时目录，不读到上次运行的结果
+if sys.argv[1:2] == ['test']:
+    MIGRATION_MODULES = {'app': None}
+    config['response']['cache']['root'] = tempfile.mkdtemp(prefix='hydrologic_forecasting_cache_')
+    config['response']['tiles']['root'] = tempfile.mkdtemp(prefix='hydrologic_forecasting_tiles_')
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 